@@ -0,0 +1,123 @@
+import argparse
+import json
+import timeit
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List
+
+from app.src.delivery import PUSH_PATH, Delivery, MessagePayload
+from app.src.http_client import LineMessagingClient
+from app.src.outbox import PENDING, Outbox
+from linebot import LineBotApi
+from linebot.deprecations import LineBotSdkDeprecatedIn30
+from linebot.http_client import HttpClient
+from linebot.models import TextSendMessage
+
+# 1回の送信でHTTPクライアントに渡すまでのCPUコスト (通信は含めない) と、
+# 配信ジャーナルの保存にかかる時間を以前の形式と比べる
+
+
+@dataclass
+class LegacyOutboxEntry:
+    to: List[str]
+    messages: List[Dict[str, Any]]
+    multicast: bool
+    retry_key: str
+    state: str = PENDING
+
+
+@dataclass
+class LegacyOutbox:
+    entries: List[LegacyOutboxEntry]
+
+
+class NullResponse:
+    status_code = 200
+    headers: Any = {}
+
+
+# line-bot-sdkは型情報を持たないため、基底クラスがAnyになる
+class NullHttpClient(HttpClient):  # type: ignore[misc]
+    def __init__(self, timeout: Any = None) -> None:
+        super().__init__(timeout)
+
+    def get(self, *args: Any, **kwargs: Any) -> Any:
+        return NullResponse()
+
+    def post(self, *args: Any, **kwargs: Any) -> Any:
+        return NullResponse()
+
+    def put(self, *args: Any, **kwargs: Any) -> Any:
+        return NullResponse()
+
+    def delete(self, *args: Any, **kwargs: Any) -> Any:
+        return NullResponse()
+
+
+def make_messages(n: int) -> List[TextSendMessage]:
+    text = "引き換えコード: BENCH " + "デッドバイデイライト最新情報 " * 8
+    return [TextSendMessage(text=f"{text}{i}") for i in range(n)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # 警告の処理も含めて以前の送信のコストとして測る
+    warnings.simplefilter("ignore", LineBotSdkDeprecatedIn30)
+    messages = make_messages(args.messages)
+    message_dicts = [message.as_json_dict() for message in messages]
+    line_bot_api = LineBotApi("bench", http_client=NullHttpClient)
+    client = LineMessagingClient("bench", http_client=NullHttpClient())
+
+    print("recipients  legacy[us/send]  payload[us/send]  speedup")
+    for n in args.recipients:
+        sender_ids = [f"C{i:032x}" for i in range(n)]
+
+        def legacy() -> None:
+            # ジャーナルから宛先ごとにモデルを作り直し、SDKがJSONに変換していた
+            for sender_id in sender_ids:
+                models = [TextSendMessage.new_from_json_dict(m) for m in message_dicts]
+                line_bot_api.push_message(sender_id, messages=models, retry_key="k")
+
+        def prepared() -> None:
+            payload = MessagePayload(message_dicts)
+            for sender_id in sender_ids:
+                client.post(PUSH_PATH, payload.request_body(sender_id), "k")
+
+        legacy_s = min(timeit.repeat(legacy, number=1, repeat=args.repeat))
+        prepared_s = min(timeit.repeat(prepared, number=1, repeat=args.repeat))
+        print(
+            f"{n:>10}  {legacy_s / n * 1e6:>15.1f}  {prepared_s / n * 1e6:>16.1f}"
+            f"  {legacy_s / prepared_s:>6.1f}x"
+        )
+
+    print()
+    print("recipients  legacy dumps[ms]  outbox dumps[ms]  speedup")
+    for n in args.recipients:
+        sender_ids = [f"C{i:032x}" for i in range(n)]
+        payload = MessagePayload(message_dicts)
+        outbox = Outbox.from_deliveries(
+            [Delivery([s], payload, False, "k") for s in sender_ids]
+        )
+        # 以前のジャーナルは宛先ごとにメッセージを持ち、asdictで保存していた
+        legacy_outbox = LegacyOutbox(
+            [LegacyOutboxEntry([s], message_dicts, False, "k") for s in sender_ids]
+        )
+
+        def legacy_dumps() -> str:
+            return json.dumps(asdict(legacy_outbox), ensure_ascii=False)
+
+        legacy_s = min(timeit.repeat(legacy_dumps, number=1, repeat=args.repeat))
+        dumps_s = min(timeit.repeat(outbox.dumps, number=1, repeat=args.repeat))
+        print(
+            f"{n:>10}  {legacy_s * 1000:>16.1f}  {dumps_s * 1000:>16.1f}"
+            f"  {legacy_s / dumps_s:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, List
+from unittest import mock
+
+from app.src.env import STORAGE_BACKENDS
+
+from .fake_servers import (
+    FakeLineServer,
+    FakeOpenAIServer,
+    FakeServer,
+    FakeTwitterServer,
+    FaultConfig,
+    RedirectAdapter,
+)
+
+CHANNEL_SECRET = "bench"
+BUCKET = "bench"
+BASELINE_PATH = Path(__file__).parent / "load_baseline.json"
+ROOT = Path(__file__).parents[2]
+
+# 1リクエストに含まれるイベントの種類と割合
+EVENT_MIX = {"chat": 0.7, "shrine": 0.1, "chatgpt": 0.1, "join": 0.05, "leave": 0.05}
+PROMPTS = ["今日のシュラインおすすめは？", "おすすめのキラーは？", "BPの稼ぎ方は？"]
+
+
+def setup_env(storage: str, digest: bool = False) -> None:
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update(
+        {
+            "ENV_NAME": "bench",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            # 新しいbotocoreのaws-chunkedアップロードをmotoが解釈できないため
+            "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+            "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+            "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+            "OPENAI_API_KEY": "bench",
+            "S3_BUCKET_NAME": BUCKET,
+            "S3_KEY_NAME": "bench",
+            "TWITTER_BEARER_TOKEN": "bench",
+        }
+    )
+    if digest:
+        os.environ["BATCH_DIGEST"] = "true"
+    # S3はmotoで置き換え、それ以外はEnvを通して一時ディレクトリに保存する
+    os.environ.update({"STORAGE": storage, "STORAGE_DIR": tmpdir})
+
+
+def patch_upstreams(args: argparse.Namespace) -> None:
+    # 読み込みは本物のSDKのまま、通信先だけを偽サーバーに向ける
+    import openai
+    from app.src.http_client import LineMessagingClient
+    from linebot import LineBotApi
+    from tweepy import API
+
+    def twitter_api(*a: Any, **kw: Any) -> API:
+        api = API(*a, **kw)
+        api.session.mount("https://", RedirectAdapter(args.twitter_url))
+        return api
+
+    line_client = functools.partial(LineMessagingClient, endpoint=args.line_url)
+    mock.patch("app.src.lambda_batch.LineMessagingClient", line_client).start()
+    line_bot_api = functools.partial(LineBotApi, endpoint=args.line_url)
+    mock.patch("linebot.LineBotApi", line_bot_api).start()
+    for target in ("app.src.lambda_batch.API", "tweepy.API"):
+        mock.patch(target, twitter_api).start()
+    openai.api_base = args.openai_url + "/v1"
+
+
+def make_sender_ids(n: int, group_ratio: float) -> List[str]:
+    groups = int(n * group_ratio)
+    return [f"C{i:032x}" for i in range(groups)] + [
+        f"U{i:032x}" for i in range(n - groups)
+    ]
+
+
+def make_context() -> Any:
+    return mock.Mock(
+        invoked_function_arn="bench", get_remaining_time_in_millis=lambda: 900000
+    )
+
+
+def child_batch(args: argparse.Namespace) -> Dict[str, Any]:
+    from app.src.env import get_env
+    from app.src.lambda_batch import lambda_handler
+    from app.src.subscriber_store import get_subscriber_store
+
+    sender_ids = make_sender_ids(args.senders[0], args.group_ratio)
+    if args.storage == "s3":
+        import boto3
+
+        boto3.resource("s3").Object(BUCKET, "bench").put(Body=json.dumps(sender_ids))
+    else:
+        get_subscriber_store(get_env()).apply(sender_ids, [])
+
+    started_at = time.perf_counter()
+    result = lambda_handler({}, make_context())  # type: ignore
+    return {
+        "wall_s": time.perf_counter() - started_at,
+        "status_code": result["statusCode"],
+    }
+
+
+def make_webhook_request(rng: random.Random) -> Dict[str, Any]:
+    events = []
+    for _ in range(rng.choice([1, 1, 1, 2, 3])):
+        kind = rng.choices(list(EVENT_MIX), weights=list(EVENT_MIX.values()))[0]
+        event: Dict[str, Any] = {
+            "webhookEventId": f"{rng.getrandbits(64):016x}",
+            "replyToken": "bench",
+            "source": {"type": "group", "groupId": f"C{rng.randrange(100):032x}"},
+        }
+        if kind == "chat":
+            text = "おつかれさまです"
+        elif kind == "shrine":
+            text = "今週の聖堂"
+        elif kind == "chatgpt":
+            text = "/chatgpt " + rng.choice(PROMPTS)
+        else:
+            events.append({**event, "type": kind})
+            continue
+        events.append(
+            {**event, "type": "message", "message": {"type": "text", "text": text}}
+        )
+    body = json.dumps({"destination": "bench", "events": events})
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return {
+        "headers": {"x-line-signature": base64.b64encode(digest).decode()},
+        "body": body,
+    }
+
+
+def child_webhook(args: argparse.Namespace) -> Dict[str, Any]:
+    import boto3
+    from app.src.lambda_webhook_handler import lambda_handler
+
+    boto3.resource("s3").Object(BUCKET, "bench").put(Body=b"[]")
+
+    rng = random.Random(0)
+    requests = [make_webhook_request(rng) for _ in range(args.requests)]
+    latencies = []
+    errors = 0
+    started_at = time.perf_counter()
+    for request in requests:
+        request_started_at = time.perf_counter()
+        result = lambda_handler(request, make_context())  # type: ignore
+        latencies.append(time.perf_counter() - request_started_at)
+        errors += result["statusCode"] != 200
+    latencies.sort()
+    return {
+        "wall_s": time.perf_counter() - started_at,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": errors,
+    }
+
+
+def child(args: argparse.Namespace) -> None:
+    setup_env(args.storage, args.digest)
+    from moto import mock_s3
+
+    with mock_s3():
+        import boto3
+
+        boto3.resource("s3").Bucket(BUCKET).create()
+        patch_upstreams(args)
+        if args.child == "batch":
+            result = child_batch(args)
+        else:
+            result = child_webhook(args)
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run(
+    args: argparse.Namespace, servers: Dict[str, FakeServer], scenario: List[str]
+) -> Dict[str, Any]:
+    for server in servers.values():
+        server.reset()
+    command = [sys.executable, "-m", "app.benchmarks.bench_load", "--child"]
+    command += scenario + ["--storage", args.storage]
+    if args.digest:
+        command.append("--digest")
+    command += [f"--{name}-url={server.url}" for name, server in servers.items()]
+    process = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    if process.returncode != 0:
+        sys.exit(f"{' '.join(scenario)} failed:\n{process.stderr}")
+    result: Dict[str, Any] = json.loads(process.stdout.splitlines()[-1])
+    for name, server in servers.items():
+        stats = server.stats()
+        result[f"{name}_requests"] = sum(stats["requests"].values())
+        result[f"{name}_statuses"] = stats["statuses"]
+        if "usage" in stats:
+            result[f"{name}_usage"] = stats["usage"]
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", choices=["batch", "webhook"])
+    parser.add_argument("--senders", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--group-ratio", type=float, default=0.1)
+    parser.add_argument("--tweets", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--storage", choices=STORAGE_BACKENDS, default="s3")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    # ツイートを1つのメッセージにまとめ、残りの通数を確かめてから送る
+    parser.add_argument("--digest", action="store_true")
+    parser.add_argument("--quota", type=int)
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--line-url")
+    parser.add_argument("--twitter-url")
+    parser.add_argument("--openai-url")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    faults = FaultConfig(args.latency, args.error_rate, args.rate_limit_rate)
+    servers: Dict[str, FakeServer] = {
+        "line": FakeLineServer(faults, args.quota),
+        "twitter": FakeTwitterServer(args.tweets, faults=faults),
+        "openai": FakeOpenAIServer(faults),
+    }
+    scenarios = {
+        f"batch-{n}": ["batch", "--senders", str(n), "--tweets", str(args.tweets)]
+        for n in args.senders
+    }
+    scenarios["webhook-mix"] = ["webhook", "--requests", str(args.requests)]
+    with ExitStack() as stack:
+        for server in servers.values():
+            stack.enter_context(server)
+        results = {name: run(args, servers, s) for name, s in scenarios.items()}
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    regressions = []
+    for name, result in results.items():
+        for key in ("wall_s", "rss_mb", "line_requests", "twitter_requests"):
+            expected = baseline.get(name, {}).get(key)
+            if expected and result[key] > expected * (1 + args.tolerance):
+                regressions.append(f"{name}.{key}: {expected} -> {result[key]}")
+
+    if args.update_baseline:
+        rounded = {
+            name: {k: round(v, 3) if isinstance(v, float) else v for k, v in r.items()}
+            for name, r in results.items()
+        }
+        BASELINE_PATH.write_text(json.dumps(rounded, indent=2) + "\n")
+        return
+    if regressions:
+        print("regressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
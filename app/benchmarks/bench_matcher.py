@@ -0,0 +1,69 @@
+import argparse
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from app.src.lambda_batch import judge_output_status, output_cutoff
+from app.src.matcher import KeywordMatcher
+from tweepy.models import Status
+
+
+def legacy_judge_output_status(status: Status, filter_list: List[str]) -> bool:
+    return status.created_at >= datetime.now(timezone.utc) - timedelta(
+        hours=12
+    ) and bool(list(filter(lambda x: x in status.full_text, filter_list)))
+
+
+def make_keywords(n: int) -> List[str]:
+    return [f"キーワード{i}" for i in range(n)]
+
+
+def make_statuses(n: int, keywords: List[str], hit_rate: float) -> List[Status]:
+    now = datetime.now(timezone.utc)
+    statuses = []
+    for i in range(n):
+        text = "デッドバイデイライト最新情報 " * 8
+        if random.random() < hit_rate:
+            text += random.choice(keywords)
+        status = Status()
+        status.id = i
+        status.full_text = text
+        status.created_at = now
+        statuses.append(status)
+    return statuses
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keywords", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--statuses", type=int, default=2000)
+    parser.add_argument("--hit-rate", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print("keywords  statuses  legacy[ms]  matcher[ms]  speedup")
+    for n in args.keywords:
+        keywords = make_keywords(n)
+        statuses = make_statuses(args.statuses, keywords, args.hit_rate)
+
+        def legacy() -> List[Status]:
+            return [s for s in statuses if legacy_judge_output_status(s, keywords)]
+
+        def compiled() -> List[Status]:
+            matcher = KeywordMatcher(keywords)
+            cutoff = output_cutoff()
+            return [s for s in statuses if judge_output_status(s, matcher, cutoff)]
+
+        assert legacy() == compiled()
+        legacy_ms = min(timeit.repeat(legacy, number=1, repeat=args.repeat)) * 1000
+        matcher_ms = min(timeit.repeat(compiled, number=1, repeat=args.repeat)) * 1000
+        print(
+            f"{n:>8}  {args.statuses:>8}  {legacy_ms:>10.2f}  {matcher_ms:>11.2f}"
+            f"  {legacy_ms / matcher_ms:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+from unittest import mock
+
+CHANNEL_SECRET = "bench"
+BASELINE_PATH = Path(__file__).parent / "startup_baseline.json"
+ROOT = Path(__file__).parents[2]
+
+EVENTS: Dict[str, Any] = {
+    "warmup": None,
+    "text": {"type": "message", "message": {"type": "text", "text": "こんにちは"}},
+    "shrine": {"type": "message", "message": {"type": "text", "text": "今週の聖堂"}},
+    "shrine_cached": {
+        "type": "message",
+        "message": {"type": "text", "text": "今週の聖堂"},
+    },
+    "chatgpt": {
+        "type": "message",
+        "message": {"type": "text", "text": "/chatgpt おすすめのパークは？"},
+    },
+    "join": {"type": "join", "source": {"type": "group", "groupId": "Cbench"}},
+    "leave": {"type": "leave", "source": {"type": "group", "groupId": "Cbench"}},
+}
+
+
+def make_request(event_type: str) -> Dict[str, Any]:
+    event = EVENTS[event_type]
+    if event is None:
+        return {"warmup": True}
+    event = {**event, "replyToken": "dummy", "mode": "active", "timestamp": 0}
+    body = json.dumps({"destination": "dummy", "events": [event]})
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return {
+        "headers": {"x-line-signature": base64.b64encode(digest).decode()},
+        "body": body,
+    }
+
+
+def patch_upstreams(event_type: str) -> List[Any]:
+    # 外部APIへの通信だけを差し替える (読み込みのコストは計測に含める)
+    patches: List[Any] = []
+    if event_type in ("shrine", "shrine_cached", "chatgpt"):
+        patches.append(mock.patch("linebot.LineBotApi"))
+    if event_type == "shrine":
+        status = mock.Mock(
+            id=1,
+            full_text="シュライン・オブ・シークレット",
+            created_at=datetime.now(timezone.utc),
+        )
+        api = mock.Mock(**{"user_timeline.return_value": [status]})
+        patches.append(mock.patch("tweepy.API", return_value=api))
+    if event_type == "chatgpt":
+        response = {"choices": [{"message": {"content": "dummy"}}]}
+        patches.append(
+            mock.patch("openai.ChatCompletion.create", return_value=response)
+        )
+    return patches
+
+
+def write_shrine_snapshot(path: str) -> None:
+    # バッチが保存済みのシュライン
+    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
+    shrine = {"id": 1, "full_text": "シュライン・オブ・シークレット"}
+    snapshot = {"timelines": {}, "shrine": {**shrine, "expires_at": expires_at}}
+    Path(path).write_text(json.dumps(snapshot, default=datetime.isoformat))
+
+
+def child(event_type: str) -> None:
+    tmpdir = tempfile.mkdtemp()
+    os.environ.update(
+        {
+            "ENV_NAME": "bench",
+            "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+            "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+            "OPENAI_API_KEY": "bench",
+            "S3_BUCKET_NAME": "bench",
+            "S3_KEY_NAME": "bench",
+            "TWITTER_BEARER_TOKEN": "bench",
+            "STORAGE": "local",
+            "STORAGE_DIR": tmpdir,
+        }
+    )
+    if event_type == "shrine_cached":
+        write_shrine_snapshot(os.path.join(tmpdir, "bench.timeline.json"))
+    request = make_request(event_type)
+
+    started_at = time.perf_counter()
+    from app.src.lambda_webhook_handler import lambda_handler
+
+    imported_at = time.perf_counter()
+    for p in patch_upstreams(event_type):
+        p.start()
+    result = lambda_handler(request, mock.Mock())  # type: ignore
+    finished_at = time.perf_counter()
+    assert result["statusCode"] == 200, result
+
+    print(
+        json.dumps(
+            {
+                "import_ms": (imported_at - started_at) * 1000,
+                "invoke_ms": (finished_at - imported_at) * 1000,
+                "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "modules": len(sys.modules),
+            }
+        )
+    )
+
+
+def run(event_type: str) -> Dict[str, float]:
+    output = subprocess.run(
+        [sys.executable, "-m", "app.benchmarks.bench_startup", "--child", event_type],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result: Dict[str, float] = json.loads(output.splitlines()[-1])
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", choices=EVENTS.keys())
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    results = {}
+    for event_type in EVENTS:
+        runs = [run(event_type) for _ in range(args.repeat)]
+        results[event_type] = {
+            key: round(min(r[key] for r in runs), 1) for key in runs[0]
+        }
+
+    baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    regressions = []
+    print("event           import[ms]  invoke[ms]  rss[MB]  modules")
+    for event_type, r in results.items():
+        print(
+            f"{event_type:<14}  {r['import_ms']:>10.1f}  {r['invoke_ms']:>10.1f}"
+            f"  {r['rss_mb']:>7.1f}  {r['modules']:>7.0f}"
+        )
+        for key in ("import_ms", "rss_mb", "modules"):
+            expected = baseline.get(event_type, {}).get(key)
+            if expected and r[key] > expected * (1 + args.tolerance):
+                regressions.append(f"{event_type}.{key}: {expected} -> {r[key]}")
+
+    if args.update_baseline:
+        BASELINE_PATH.write_text(json.dumps(results, indent=2) + "\n")
+        return
+    if regressions:
+        print("regressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
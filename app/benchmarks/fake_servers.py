@@ -0,0 +1,239 @@
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+@dataclass
+class FaultConfig:
+    latency: float = 0.0  # sec
+    error_rate: float = 0.0  # 500を返す割合
+    rate_limit_rate: float = 0.0  # 429を返す割合
+    seed: int = 0
+
+
+class FakeServer:
+    # 127.0.0.1の空いているポートで立ち上げ、別スレッドで応答する
+    def __init__(self, faults: Optional[FaultConfig] = None) -> None:
+        self.faults = faults or FaultConfig()
+        self.random = random.Random(self.faults.seed)
+        self.requests: "Counter[str]" = Counter()
+        self.statuses: "Counter[int]" = Counter()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 接続を使い回すクライアントの挙動を再現する
+            protocol_version = "HTTP/1.1"
+            # ヘッダーとボディを分けて書くため、Nagleと遅延ACKで1回40ms待たされる
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                server._handle(self, None)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                server._handle(self, json.loads(self.rfile.read(length) or b"{}"))
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            }
+
+    def _handle(self, request: BaseHTTPRequestHandler, body: Any) -> None:
+        url = urlparse(request.path)
+        with self.lock:
+            self.requests[url.path] += 1
+            roll = self.random.random()
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+
+        if roll < self.faults.rate_limit_rate:
+            status, payload = 429, {"message": "Too Many Requests"}
+        elif roll < self.faults.rate_limit_rate + self.faults.error_rate:
+            status, payload = 500, {"message": "Internal Server Error"}
+        else:
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            status, payload = self.respond(url.path, query, body, request.headers)
+
+        with self.lock:
+            self.statuses[status] += 1
+        data = json.dumps(payload).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def respond(
+        self, path: str, query: Dict[str, str], body: Any, headers: Message
+    ) -> Tuple[int, Any]:
+        raise NotImplementedError
+
+
+class FakeLineServer(FakeServer):
+    # グループ・トークルームのメンバー数
+    GROUP_MEMBERS = 5
+
+    def __init__(
+        self, faults: Optional[FaultConfig] = None, quota: Optional[int] = None
+    ) -> None:
+        super().__init__(faults)
+        self.retry_keys: Set[str] = set()
+        self.quota = quota
+        self.usage = 0  # 課金対象のメッセージ数 (受け取る人ごとに1通)
+
+    def reset(self) -> None:
+        super().reset()
+        with self.lock:
+            self.usage = 0
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        with self.lock:
+            stats["usage"] = self.usage
+        return stats
+
+    def respond(
+        self, path: str, query: Dict[str, str], body: Any, headers: Message
+    ) -> Tuple[int, Any]:
+        if path == "/v2/bot/message/quota":
+            if self.quota is None:
+                return 200, {"type": "none"}
+            return 200, {"type": "limited", "value": self.quota}
+        if path == "/v2/bot/message/quota/consumption":
+            with self.lock:
+                return 200, {"totalUsage": self.usage}
+        if path.endswith("/members/count"):
+            return 200, {"count": self.GROUP_MEMBERS}
+        # 同じリトライキーのリクエストは受理済みとして409を返す
+        retry_key = headers.get("X-Line-Retry-Key")
+        with self.lock:
+            if retry_key is not None and retry_key in self.retry_keys:
+                return 409, {"message": "The retry key is already accepted"}
+            if retry_key is not None:
+                self.retry_keys.add(retry_key)
+            # 返信は数えない
+            if path.endswith("/multicast"):
+                self.usage += len(body["to"])
+            elif path.endswith("/push"):
+                # グループ・トークルームへのpushはメンバーの人数分になる
+                group = body["to"][:1] in ("C", "R")
+                self.usage += self.GROUP_MEMBERS if group else 1
+        return 200, {}
+
+
+class FakeTwitterServer(FakeServer):
+    def __init__(
+        self,
+        matched: int,
+        timeline_size: int = 50,
+        faults: Optional[FaultConfig] = None,
+    ) -> None:
+        super().__init__(faults)
+        self.matched = matched
+        self.timeline_size = max(timeline_size, matched)
+        self.now = datetime.now(timezone.utc)
+
+    def timeline(self, screen_name: str) -> List[Dict[str, Any]]:
+        # アカウントごとにidが重ならないようにする
+        offset = zlib.crc32(screen_name.encode("utf-8")) % 1000 * 10**6
+        statuses = []
+        # 新しい順に、先頭のmatched件だけがキーワードを含む (最初の1件はシュライン)
+        for i in range(self.timeline_size):
+            if i == 0 and self.matched:
+                text = "今週のシュライン・オブ・シークレット: BENCH"
+            elif i < self.matched:
+                text = f"引き換えコード: BENCH{i}"
+            else:
+                text = f"お知らせ{i}"
+            created_at = self.now - timedelta(minutes=i)
+            statuses.append(
+                {
+                    "id": offset + self.timeline_size - i,
+                    "full_text": text,
+                    "created_at": created_at.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+                }
+            )
+        return statuses
+
+    def respond(
+        self, path: str, query: Dict[str, str], body: Any, headers: Message
+    ) -> Tuple[int, Any]:
+        statuses = self.timeline(query.get("screen_name", ""))
+        if "since_id" in query:
+            statuses = [s for s in statuses if s["id"] > int(query["since_id"])]
+        if "max_id" in query:
+            statuses = [s for s in statuses if s["id"] <= int(query["max_id"])]
+        return 200, statuses[: int(query.get("count", 20))]
+
+
+class FakeOpenAIServer(FakeServer):
+    def respond(
+        self, path: str, query: Dict[str, str], body: Any, headers: Message
+    ) -> Tuple[int, Any]:
+        content = "ベンチマーク用の応答です"
+        return 200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}}
+            ],
+        }
+
+
+class RedirectAdapter(HTTPAdapter):
+    # tweepyはhttps://固定でURLを組み立てるため、偽サーバーに向け直す
+    def __init__(self, base_url: str) -> None:
+        super().__init__()
+        self.base_url = base_url
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Union[None, float, Tuple[Optional[float], Optional[float]]] = None,
+        verify: Union[bool, str] = True,
+        cert: Union[None, str, Tuple[str, str]] = None,
+        proxies: Optional[Dict[str, str]] = None,
+    ) -> requests.Response:
+        url = urlparse(request.url or "")
+        request.url = self.base_url + url.path + (f"?{url.query}" if url.query else "")
+        return super().send(request, stream, timeout, verify, cert, proxies)
@@ -0,0 +1,234 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Dict, Tuple
+
+from app.src import lambda_batch, lambda_webhook_handler
+from app.src.env import STORAGE_BACKENDS
+from app.src.lambda_types import EventBridgeEvent, LambdaResponse
+
+from .fake_servers import (
+    FakeLineServer,
+    FakeOpenAIServer,
+    FakeServer,
+    FakeTwitterServer,
+    FaultConfig,
+)
+
+# Lambdaの外でWebhookをHTTPで受け付け、バッチを定期的に起動する
+#
+#   STORAGE=sqlite STORAGE_DIR=/tmp/dbd python -m app.benchmarks.local_runtime \
+#       --workers 16 --batch-interval 600
+#
+# POST /       Webhook (LINEと同じ署名付きのリクエスト)
+# POST /batch  バッチをすぐに起動する
+
+WEBHOOK_TIMEOUT_MS = 30 * 1000
+BATCH_TIMEOUT_MS = 15 * 60 * 1000
+
+logger = logging.getLogger()
+
+
+@dataclass
+class LocalContext:
+    # Lambdaと同じく、起動してからの時間を制限時間から引いて残り時間とする
+    timeout_ms: int
+    function_name: str = "local"
+    function_version: str = "$LATEST"
+    invoked_function_arn: str = "local"
+    memory_limit_in_mb: str = ""
+    aws_request_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    log_group_name: str = ""
+    log_stream_name: str = ""
+    identity: object = None
+    client_context: object = None
+    started_at: float = field(default_factory=time.monotonic)
+
+    def get_remaining_time_in_millis(self) -> int:
+        elapsed_ms = (time.monotonic() - self.started_at) * 1000
+        return max(int(self.timeout_ms - elapsed_ms), 0)
+
+
+def make_schedule_event() -> EventBridgeEvent:
+    return EventBridgeEvent(
+        {
+            "version": "0",
+            "id": str(uuid.uuid4()),
+            "detail-type": "Scheduled Event",
+            "source": "local",
+            "account": "",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "region": "",
+            "resources": [],
+            "detail": {},
+        }
+    )
+
+
+class BatchRunner:
+    # EventBridgeから起動する時と同じく、バッチは同時に1つだけ動かす
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> LambdaResponse:
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("Batch is already running")
+        try:
+            context = LocalContext(BATCH_TIMEOUT_MS)
+            return lambda_batch.lambda_handler(make_schedule_event(), context)
+        finally:
+            self.lock.release()
+
+    def _loop(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run()
+            except Exception:
+                logger.exception("Scheduled batch failed")
+
+
+class PooledHTTPServer(HTTPServer):
+    # Lambdaの同時実行数の上限のように、決まった数のワーカーでだけ処理する。
+    # 1接続1リクエスト (HTTP/1.0) なので、待ち受け中の接続がワーカーを塞がない
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        workers: int,
+        batch: BatchRunner,
+    ) -> None:
+        super().__init__(address, LocalRuntimeHandler)
+        self.request_queue_size = max(workers * 4, 5)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.batch = batch
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request: Any, client_address: Any) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class LocalRuntimeHandler(BaseHTTPRequestHandler):
+    server: PooledHTTPServer
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        if self.path == "/batch":
+            try:
+                response = self.server.batch.run()
+            except RuntimeError as e:
+                self._respond(409, str(e))
+                return
+        else:
+            # Lambda関数URLと同じく、ヘッダー名は小文字で渡す
+            request: Dict[str, Any] = {
+                "headers": {k.lower(): v for k, v in self.headers.items()},
+                "body": body,
+            }
+            context = LocalContext(WEBHOOK_TIMEOUT_MS)
+            response = lambda_webhook_handler.lambda_handler(
+                request, context  # type: ignore[arg-type]
+            )
+        self._respond(response["statusCode"], response["body"])
+
+    def _respond(self, status: int, body: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def start_fake_upstreams(stack: ExitStack, tweets: int) -> Dict[str, FakeServer]:
+    # 本物のLINE/Twitter/OpenAIに送らずに負荷をかける
+    from .bench_load import patch_upstreams
+
+    servers: Dict[str, FakeServer] = {
+        "line": FakeLineServer(FaultConfig()),
+        "twitter": FakeTwitterServer(tweets),
+        "openai": FakeOpenAIServer(),
+    }
+    for server in servers.values():
+        stack.enter_context(server)
+    patch_upstreams(
+        argparse.Namespace(**{f"{n}_url": s.url for n, s in servers.items()})
+    )
+    return servers
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-interval", type=float, default=0.0)  # sec
+    parser.add_argument("--storage", choices=STORAGE_BACKENDS)
+    parser.add_argument("--storage-dir")
+    parser.add_argument("--fake-upstreams", action="store_true")
+    parser.add_argument("--tweets", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # 保存先はEnvを通して選ぶので、環境変数を上書きしてから読み込ませる
+    if args.storage:
+        os.environ["STORAGE"] = args.storage
+    if args.storage_dir:
+        os.environ["STORAGE_DIR"] = args.storage_dir
+
+    with ExitStack() as stack:
+        servers: Dict[str, FakeServer] = {}
+        if args.fake_upstreams:
+            servers = start_fake_upstreams(stack, args.tweets)
+        batch = BatchRunner(args.batch_interval)
+        httpd = PooledHTTPServer((args.host, args.port), args.workers, batch)
+        stack.callback(httpd.server_close)
+        stack.callback(batch.stop)
+        batch.start()
+        # --port 0 の時は割り当てられたポートを表示する
+        logger.info(
+            "http://%s:%d で待ち受け (ワーカー %d)"
+            % (args.host, httpd.server_port, args.workers)
+        )
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        stats = {name: server.stats() for name, server in servers.items()}
+        if stats:
+            print(json.dumps(stats, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+from typing import Any, Dict, List, Tuple
+
+from app.src.env import STORAGE_BACKENDS
+
+from .bench_load import (
+    BUCKET,
+    CHANNEL_SECRET,
+    make_context,
+    patch_upstreams,
+    setup_env,
+)
+from .fake_servers import (
+    FakeLineServer,
+    FakeOpenAIServer,
+    FakeServer,
+    FakeTwitterServer,
+    FaultConfig,
+)
+
+# 記録したWebhookのリクエストを、偽のLINE/Twitter/OpenAIに向けたハンドラーで再生する
+#
+#   python -m app.benchmarks.replay collect <bucket> <prefix> corpus.jsonl
+#   python -m app.benchmarks.replay run corpus.jsonl --rate 50 --concurrency 8
+
+
+def collect(args: argparse.Namespace) -> None:
+    # S3に1リクエストずつ保存された記録をJSONLにまとめる
+    import boto3
+
+    bucket = boto3.resource("s3").Bucket(args.bucket)
+    count = 0
+    with open(args.output, "w", encoding="utf-8") as f:
+        for summary in bucket.objects.filter(Prefix=args.prefix):
+            capture = json.loads(summary.get()["Body"].read())
+            f.write(json.dumps(capture, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"{count} requests -> {args.output}")
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        captures = [json.loads(line) for line in f if line.strip()]
+    return sorted(captures, key=lambda c: c["received_at"])
+
+
+def sign(body: str) -> str:
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def to_request(capture: Dict[str, Any]) -> Dict[str, Any]:
+    # 記録には署名が無いので、テスト用のチャネルシークレットで付け直す
+    headers = {**capture["headers"], "x-line-signature": sign(capture["body"])}
+    return {"headers": headers, "body": capture["body"]}
+
+
+def event_kind(event: Dict[str, Any]) -> str:
+    from app.src.lambda_webhook_handler import (
+        CHATGPT_COMMAND,
+        SHRINE_COMMAND,
+        TOPIC_COMMAND,
+    )
+
+    kind: str = event["type"]
+    if kind != "message":
+        return kind
+    message = event["message"]
+    if message["type"] != "text":
+        return f"message/{message['type']}"
+    words = message["text"].split()
+    if message["text"] == SHRINE_COMMAND:
+        return "message/shrine"
+    if words and words[0] == CHATGPT_COMMAND:
+        return "message/chatgpt"
+    if words and words[0] == TOPIC_COMMAND:
+        return "message/topic"
+    return "message/text"
+
+
+def request_kind(capture: Dict[str, Any]) -> str:
+    # 複数のイベントを含むリクエストは種類の組み合わせで集計する
+    events = json.loads(capture["body"])["events"]
+    return "+".join(sorted({event_kind(event) for event in events})) or "empty"
+
+
+def schedule(captures: List[Dict[str, Any]], rate: float, speed: float) -> List[float]:
+    # 送信する時刻 (開始からの秒数)。rateを指定しなければ記録した間隔を再現する
+    if rate > 0:
+        return [i / rate for i in range(len(captures))]
+    first = captures[0]["received_at"] if captures else 0.0
+    return [(c["received_at"] - first) / speed for c in captures]
+
+
+def percentile(values: List[float], p: float) -> float:
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def replay(
+    args: argparse.Namespace, captures: List[Dict[str, Any]]
+) -> Dict[str, Dict[str, float]]:
+    from app.src.event_queue import LocalEventQueue
+    from app.src.lambda_webhook_handler import lambda_handler
+    from app.src.runtime import get_runtime
+
+    offsets = schedule(captures, args.rate, args.speed)
+    results: List[Tuple[str, float, bool]] = []
+    lock = threading.Lock()
+
+    def send(capture: Dict[str, Any], scheduled_at: float) -> None:
+        request = to_request(capture)
+        result = lambda_handler(request, make_context())  # type: ignore
+        # 予定時刻から測り、詰まって送信が遅れた分も遅延に含める
+        latency = time.perf_counter() - scheduled_at
+        with lock:
+            results.append(
+                (request_kind(capture), latency, result["statusCode"] == 200)
+            )
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for capture, offset in zip(captures, offsets):
+            scheduled_at = started_at + offset
+            wait = scheduled_at - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(send, capture, scheduled_at)
+    queue = get_runtime().get("local_event_queue")
+    if isinstance(queue, LocalEventQueue):
+        queue.join()
+    wall_s = time.perf_counter() - started_at
+
+    grouped: Dict[str, List[Tuple[float, bool]]] = defaultdict(list)
+    for kind, latency, ok in results:
+        grouped[kind].append((latency, ok))
+        grouped["all"].append((latency, ok))
+    report = {}
+    for kind, items in sorted(grouped.items()):
+        latencies = sorted(latency * 1000 for latency, _ in items)
+        report[kind] = {
+            "requests": len(items),
+            "errors": sum(1 for _, ok in items if not ok),
+            "p50_ms": percentile(latencies, 0.5),
+            "p90_ms": percentile(latencies, 0.9),
+            "p99_ms": percentile(latencies, 0.99),
+            "max_ms": latencies[-1],
+        }
+    report["all"]["wall_s"] = wall_s
+    return report
+
+
+def run(args: argparse.Namespace) -> None:
+    captures = load_corpus(args.corpus)
+    if not captures:
+        sys.exit(f"{args.corpus} has no requests")
+
+    setup_env(args.storage)
+    if args.use_async:
+        os.environ["WEBHOOK_ASYNC"] = "true"
+    faults = FaultConfig(args.latency, args.error_rate, args.rate_limit_rate)
+    servers: Dict[str, FakeServer] = {
+        "line": FakeLineServer(faults),
+        "twitter": FakeTwitterServer(1, faults=faults),
+        "openai": FakeOpenAIServer(faults),
+    }
+    from moto import mock_s3
+
+    with ExitStack() as stack:
+        for server in servers.values():
+            stack.enter_context(server)
+        stack.enter_context(mock_s3())
+        # ハンドラーが標準出力に書くEMFは集計に使わないので捨てる
+        stack.enter_context(redirect_stdout(io.StringIO()))
+        import boto3
+
+        boto3.resource("s3").Bucket(BUCKET).create()
+        boto3.resource("s3").Object(BUCKET, "bench").put(Body=b"[]")
+        patch_upstreams(
+            argparse.Namespace(
+                **{f"{name}_url": server.url for name, server in servers.items()}
+            )
+        )
+        report = replay(args, captures)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    width = max(len(kind) for kind in report)
+    print("{:<{}}  requests  errors  p50[ms]  p90[ms]  p99[ms]".format("kind", width))
+    for kind, r in report.items():
+        print(
+            "{:<{}}  {:>8} {:>7} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                kind,
+                width,
+                r["requests"],
+                r["errors"],
+                r["p50_ms"],
+                r["p90_ms"],
+                r["p99_ms"],
+            )
+        )
+    print("wall: {:.2f}s".format(report["all"]["wall_s"]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    collect_parser = subparsers.add_parser("collect")
+    collect_parser.add_argument("bucket")
+    collect_parser.add_argument("prefix")
+    collect_parser.add_argument("output")
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("corpus")
+    run_parser.add_argument("--rate", type=float, default=0.0)  # requests/sec
+    run_parser.add_argument("--speed", type=float, default=1.0)
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--async", dest="use_async", action="store_true")
+    run_parser.add_argument("--storage", choices=STORAGE_BACKENDS, default="s3")
+    run_parser.add_argument("--latency", type=float, default=0.01)
+    run_parser.add_argument("--error-rate", type=float, default=0.0)
+    run_parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    run_parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "collect":
+        collect(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from .env import Env
+from .runtime import get_runtime
+
+# 再生に必要なヘッダーだけを残す (署名は再生時に付け直す)
+KEPT_HEADERS = ("content-type", "user-agent")
+SOURCE_ID_KEYS = ("userId", "groupId", "roomId")
+REDACTED = "redacted"
+
+Capture = Dict[str, Any]
+
+
+def pseudonymize(sender_id: str) -> str:
+    # 同じ送信元は同じidになるようにし、送信元ごとのキャッシュや履歴の効き方を残す
+    digest = hashlib.sha256(sender_id.encode("utf-8")).hexdigest()
+    return sender_id[:1] + digest[:32]
+
+
+def pseudonymize_ids(value: Any) -> None:
+    # 送信元の他にも参加/退室したメンバーやメンションの相手にidが入るので、全てを置き換える
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key in SOURCE_ID_KEYS and isinstance(child, str):
+                value[key] = pseudonymize(child)
+            else:
+                pseudonymize_ids(child)
+    elif isinstance(value, list):
+        for child in value:
+            pseudonymize_ids(child)
+
+
+def redact_event(event: Dict[str, Any], keep_text: Callable[[str], bool]) -> None:
+    if "replyToken" in event:
+        event["replyToken"] = REDACTED
+    pseudonymize_ids(event)
+    message = event.get("message", {})
+    # コマンド以外の発言は長さだけを残す
+    if message.get("type") == "text" and not keep_text(message["text"]):
+        message["text"] = "*" * len(message["text"])
+
+
+def redact_request(
+    headers: Mapping[str, object],
+    body: str,
+    keep_text: Callable[[str], bool],
+    received_at: Optional[float] = None,
+) -> Capture:
+    payload = json.loads(body)
+    if "destination" in payload:
+        payload["destination"] = pseudonymize(payload["destination"])
+    for event in payload.get("events", []):
+        redact_event(event, keep_text)
+    return {
+        "received_at": time.time() if received_at is None else received_at,
+        "headers": {
+            k.lower(): v for k, v in headers.items() if k.lower() in KEPT_HEADERS
+        },
+        "body": json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+    }
+
+
+class CaptureStore:
+    def put(self, capture: Capture) -> None:
+        raise NotImplementedError
+
+
+class S3CaptureStore(CaptureStore):
+    # 複数のコンテナから書き込むため、1リクエスト1オブジェクトで保存する
+    def __init__(self, bucket: str, prefix: str) -> None:
+        self.s3 = get_runtime().s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, capture: Capture) -> None:
+        # 受信時刻順に並ぶキーにして、まとめる時に並べ替えなくて済むようにする
+        key = f"{self.prefix}{int(capture['received_at'] * 1000):013d}-{uuid.uuid4()}"
+        self.s3.Object(self.bucket, key + ".json").put(
+            Body=json.dumps(capture, ensure_ascii=False).encode("utf-8")
+        )
+
+
+class FileCaptureStore(CaptureStore):
+    # 1行1リクエストのJSONLに追記する
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def put(self, capture: Capture) -> None:
+        line = json.dumps(capture, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def get_capture_store(env: Env) -> Optional[CaptureStore]:
+    path = os.getenv("WEBHOOK_CAPTURE_PATH", None)
+    if path is not None:
+        return get_runtime().client(
+            ("capture_store", path), lambda: FileCaptureStore(path)
+        )
+    if os.getenv("WEBHOOK_CAPTURE", "").lower() not in ("1", "true"):
+        return None
+    if os.getenv("ENV_NAME", None) != "prod":
+        return None
+    prefix = f"{env.S3_KEY_NAME}.captures/"
+    return get_runtime().client(
+        ("capture_store", env.S3_BUCKET_NAME, prefix),
+        lambda: S3CaptureStore(env.S3_BUCKET_NAME, prefix),
+    )
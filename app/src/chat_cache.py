@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Optional
+
+from .cache import TTLCache
+from .env import STORAGE_S3, Env
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store
+
+CHAT_CACHE_MAXSIZE = 256
+CHAT_CACHE_TTL = 10 * 60.0  # sec
+
+
+def normalize_prompt(prompt: str) -> str:
+    # 全角/半角や空白、大文字/小文字の違いだけの質問は同じものとして扱う
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+
+def cache_key(model: str, prompt: str) -> str:
+    text = f"{model}\n{normalize_prompt(prompt)}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    persisted_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+
+
+class ResponseStore:
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def put(self, key: str, response: str, expires_at: float) -> None:
+        raise NotImplementedError
+
+
+class BlobResponseStore(ResponseStore):
+    def __init__(
+        self, blobs: BlobStore, prefix: str, now: Callable[[], float] = time.time
+    ) -> None:
+        self.blobs = blobs
+        self.prefix = prefix
+        self.now = now
+
+    def get(self, key: str) -> Optional[str]:
+        body = self.blobs.get(f"{self.prefix}{key}.json")
+        if body is None:
+            return None
+        return read_entry(body, self.now())
+
+    def put(self, key: str, response: str, expires_at: float) -> None:
+        body = json.dumps({"response": response, "expires_at": expires_at})
+        self.blobs.put(f"{self.prefix}{key}.json", body.encode("utf-8"))
+
+
+def read_entry(body: bytes, now: float) -> Optional[str]:
+    entry = json.loads(body)
+    if entry["expires_at"] <= now:
+        return None
+    response: str = entry["response"]
+    return response
+
+
+# 同じ質問への応答を使い回す。プロセス内のLRUを先に引き、外れたら保存先を読む。
+# 同時に来た同じ質問は、最初の1件の応答を待って共有する。
+class ChatCache:
+    def __init__(
+        self,
+        store: Optional[ResponseStore] = None,
+        maxsize: int = CHAT_CACHE_MAXSIZE,
+        ttl: float = CHAT_CACHE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+        now: Callable[[], float] = time.time,
+    ) -> None:
+        self.store = store
+        self.ttl = ttl
+        self.now = now
+        self.local: TTLCache[str] = TTLCache(maxsize, ttl, clock)
+        self.stats = CacheStats()
+        self._inflight: Dict[str, "Future[str]"] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, model: str, prompt: str, create: Callable[[], str]) -> str:
+        key = cache_key(model, prompt)
+        with self._lock:
+            response = self.local.get(key)
+            if response is not None:
+                self.stats.hits += 1
+                return response
+            future = self._inflight.get(key)
+            leader = future is None
+            if future is None:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            response = self._load_or_create(key, create)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _load_or_create(self, key: str, create: Callable[[], str]) -> str:
+        response = self.store.get(key) if self.store is not None else None
+        if response is not None:
+            with self._lock:
+                self.stats.persisted_hits += 1
+        else:
+            with self._lock:
+                self.stats.misses += 1
+            response = create()
+            if self.store is not None:
+                self.store.put(key, response, self.now() + self.ttl)
+        self.local.set(key, response)
+        return response
+
+    def stats_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return asdict(self.stats)
+
+
+def get_chat_cache(env: Env) -> ChatCache:
+    def create() -> ChatCache:
+        prefix = f"{env.S3_KEY_NAME}.chatgpt/"
+        # 別のコンテナで処理された質問も使い回せるよう本番ではS3にも保存する
+        if env.STORAGE != STORAGE_S3 or os.getenv("ENV_NAME", None) == "prod":
+            return ChatCache(BlobResponseStore(get_blob_store(env), prefix))
+        return ChatCache()
+
+    return get_runtime().client(
+        (
+            "chat_cache",
+            env.STORAGE,
+            env.STORAGE_DIR,
+            env.S3_BUCKET_NAME,
+            env.S3_KEY_NAME,
+        ),
+        create,
+    )
@@ -0,0 +1,176 @@
+import json
+import os
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .cache import TTLCache
+from .env import STORAGE_S3, Env
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store
+
+# 履歴としてモデルに渡すトークン数の上限
+TOKEN_BUDGET = 1500
+MAX_TURNS = 20
+# しばらく会話が無ければ履歴を忘れる
+CONVERSATION_TTL = 30 * 60.0  # sec
+MEMORY_MAXSIZE = 256
+
+Message = Dict[str, str]
+# 保存する時は (u|a, 本文) の組で持ち、サイズを抑える
+ROLES = {"u": "user", "a": "assistant"}
+ROLE_CODES = {role: code for code, role in ROLES.items()}
+
+
+def estimate_tokens(text: str) -> int:
+    # 英数字はおよそ4文字で1トークン、日本語はおよそ1文字で1トークン
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class Conversation:
+    def __init__(self, turns: Optional[List[Tuple[str, str]]] = None) -> None:
+        # (質問, 応答) のリングバッファ
+        self.turns: Deque[Tuple[str, str]] = deque(turns or [], maxlen=MAX_TURNS)
+
+    def messages(self) -> List[Message]:
+        messages = []
+        for question, answer in self.turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    def append(self, question: str, answer: str, budget: int = TOKEN_BUDGET) -> None:
+        self.turns.append((question, answer))
+        # 予算に収まるまで古いやり取りから捨てる
+        while self.turns and self.tokens() > budget:
+            self.turns.popleft()
+
+    def tokens(self) -> int:
+        return sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+    def dumps(self) -> str:
+        body = [[ROLE_CODES[m["role"]], m["content"]] for m in self.messages()]
+        return json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, body: str) -> "Conversation":
+        contents = [content for _, content in json.loads(body)]
+        return cls(list(zip(contents[::2], contents[1::2])))
+
+
+class ConversationStore:
+    def load(self, sender_id: str) -> Optional[Conversation]:
+        raise NotImplementedError
+
+    def save(self, sender_id: str, conversation: Conversation) -> None:
+        raise NotImplementedError
+
+
+class S3ConversationStore(ConversationStore):
+    def __init__(self, bucket: str, prefix: str) -> None:
+        self.s3 = get_runtime().s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def load(self, sender_id: str) -> Optional[Conversation]:
+        from botocore.exceptions import ClientError
+
+        obj = self.s3.Object(self.bucket, f"{self.prefix}{sender_id}.json")
+        try:
+            response = obj.get()
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return None
+        age = time.time() - response["LastModified"].timestamp()
+        if age >= CONVERSATION_TTL:
+            return None
+        return Conversation.loads(response["Body"].read().decode("utf-8"))
+
+    def save(self, sender_id: str, conversation: Conversation) -> None:
+        obj = self.s3.Object(self.bucket, f"{self.prefix}{sender_id}.json")
+        obj.put(Body=conversation.dumps().encode("utf-8"))
+
+
+class BlobConversationStore(ConversationStore):
+    # 保存した時刻を一緒に書いておき、S3の更新日時の代わりにする
+    def __init__(
+        self, blobs: BlobStore, prefix: str, now: Callable[[], float] = time.time
+    ) -> None:
+        self.blobs = blobs
+        self.prefix = prefix
+        self.now = now
+
+    def load(self, sender_id: str) -> Optional[Conversation]:
+        body = self.blobs.get(f"{self.prefix}{sender_id}.json")
+        if body is None:
+            return None
+        entry = json.loads(body)
+        if self.now() - entry["saved_at"] >= CONVERSATION_TTL:
+            return None
+        return Conversation.loads(entry["conversation"])
+
+    def save(self, sender_id: str, conversation: Conversation) -> None:
+        entry = {"saved_at": self.now(), "conversation": conversation.dumps()}
+        body = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        self.blobs.put(f"{self.prefix}{sender_id}.json", body)
+
+
+# 送信元ごとの会話履歴。温まったコンテナではメモリから読み、外れたら保存先を読む
+class ConversationMemory:
+    def __init__(
+        self,
+        store: Optional[ConversationStore] = None,
+        budget: int = TOKEN_BUDGET,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.store = store
+        self.budget = budget
+        self.local: TTLCache[Conversation] = TTLCache(
+            MEMORY_MAXSIZE, CONVERSATION_TTL, clock
+        )
+
+    def history(self, sender_id: str) -> List[Message]:
+        return self._get(sender_id).messages()
+
+    def append(self, sender_id: str, question: str, answer: str) -> None:
+        conversation = self._get(sender_id)
+        conversation.append(question, answer, self.budget)
+        self.local.set(sender_id, conversation)
+        if self.store is not None:
+            self.store.save(sender_id, conversation)
+
+    def _get(self, sender_id: str) -> Conversation:
+        conversation = self.local.get(sender_id)
+        if conversation is None and self.store is not None:
+            conversation = self.store.load(sender_id)
+        return Conversation() if conversation is None else conversation
+
+
+def get_conversation_memory(env: Env) -> ConversationMemory:
+    def create() -> ConversationMemory:
+        prefix = f"{env.S3_KEY_NAME}.conversations/"
+        if env.STORAGE != STORAGE_S3:
+            store = BlobConversationStore(get_blob_store(env), prefix)
+            return ConversationMemory(store)
+        # 後続の実行が別のコンテナでも会話を続けられるよう本番ではS3にも保存する
+        if os.getenv("ENV_NAME", None) == "prod":
+            return ConversationMemory(S3ConversationStore(env.S3_BUCKET_NAME, prefix))
+        return ConversationMemory()
+
+    return get_runtime().client(
+        (
+            "conversation_memory",
+            env.STORAGE,
+            env.STORAGE_DIR,
+            env.S3_BUCKET_NAME,
+            env.S3_KEY_NAME,
+        ),
+        create,
+    )
+
+
+def format_messages(messages: List[Message]) -> str:
+    # 応答キャッシュのキーには履歴も含める
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
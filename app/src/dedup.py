@@ -0,0 +1,146 @@
+import os
+import time
+from typing import Callable, Iterable, Optional
+
+from .cache import TTLCache
+from .env import STORAGE_S3, Env
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store
+
+DEDUP_MAXSIZE = 4096
+# LINEの再送はこの期間内に届くものとして扱う
+DEDUP_TTL = 24 * 60 * 60.0  # sec
+DELETE_BATCH_SIZE = 1000  # S3の1回のリクエストで消せる上限
+
+
+class SeenStore:
+    def claim(self, event_id: str) -> bool:
+        raise NotImplementedError
+
+    def release(self, event_id: str) -> None:
+        raise NotImplementedError
+
+
+class S3SeenStore(SeenStore):
+    # S3の条件付き書き込みが使えないため、存在確認してから書き込む
+    def __init__(
+        self, bucket: str, prefix: str, now: Callable[[], float] = time.time
+    ) -> None:
+        self.s3 = get_runtime().s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.now = now
+
+    def claim(self, event_id: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        obj = self.s3.Object(self.bucket, self.prefix + event_id)
+        try:
+            age = self.now() - obj.last_modified.timestamp()
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+        else:
+            if age < DEDUP_TTL:
+                return False
+            obj.delete()
+        obj.put(Body=b"")
+        return True
+
+    def release(self, event_id: str) -> None:
+        self.s3.Object(self.bucket, self.prefix + event_id).delete()
+
+    def prune(self) -> int:
+        # 再送されなかったイベントの記録は claim で消えないため、期限が過ぎたものを消す
+        bucket = self.s3.Bucket(self.bucket)
+        now = self.now()
+        expired = [
+            {"Key": obj.key}
+            for obj in bucket.objects.filter(Prefix=self.prefix)
+            if now - obj.last_modified.timestamp() >= DEDUP_TTL
+        ]
+        count = len(expired)
+        while expired:
+            bucket.delete_objects(Delete={"Objects": expired[:DELETE_BATCH_SIZE]})
+            del expired[:DELETE_BATCH_SIZE]
+        return count
+
+
+class BlobSeenStore(SeenStore):
+    # 処理した時刻を本文に書いておき、期限が過ぎたものは作り直す
+    def __init__(
+        self, blobs: BlobStore, prefix: str, now: Callable[[], float] = time.time
+    ) -> None:
+        self.blobs = blobs
+        self.prefix = prefix
+        self.now = now
+
+    def claim(self, event_id: str) -> bool:
+        key = self.prefix + event_id
+        now = self.now()
+        body = self.blobs.get(key)
+        if body is not None and now - float(body) >= DEDUP_TTL:
+            self.blobs.delete(key)
+        # 同時に届いても1つだけが作成に成功する
+        return self.blobs.create(key, str(now).encode())
+
+    def release(self, event_id: str) -> None:
+        self.blobs.delete(self.prefix + event_id)
+
+
+# webhookEventIdで処理済みのイベントを覚えておき、再送されたイベントを捨てる
+class EventDeduplicator:
+    def __init__(
+        self,
+        store: Optional[SeenStore] = None,
+        maxsize: int = DEDUP_MAXSIZE,
+        ttl: float = DEDUP_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.store = store
+        self.local: TTLCache[bool] = TTLCache(maxsize, ttl, clock)
+
+    def claim(self, event_id: str) -> bool:
+        if self.local.get(event_id) is not None:
+            return False
+        self.local.set(event_id, True)
+        if self.store is not None and not self.store.claim(event_id):
+            return False
+        return True
+
+    def release(self, event_ids: Iterable[str]) -> None:
+        # 処理に失敗したイベントは再送された時にやり直す
+        for event_id in event_ids:
+            self.local.delete(event_id)
+            if self.store is not None:
+                self.store.release(event_id)
+
+
+def get_deduplicator(env: Env) -> EventDeduplicator:
+    def create() -> EventDeduplicator:
+        prefix = f"{env.S3_KEY_NAME}.events/"
+        if env.STORAGE != STORAGE_S3:
+            return EventDeduplicator(BlobSeenStore(get_blob_store(env), prefix))
+        # 再送は別のコンテナに届くことがあるため本番ではS3にも記録する
+        if os.getenv("ENV_NAME", None) == "prod":
+            return EventDeduplicator(S3SeenStore(env.S3_BUCKET_NAME, prefix))
+        return EventDeduplicator()
+
+    return get_runtime().client(
+        (
+            "deduplicator",
+            env.STORAGE,
+            env.STORAGE_DIR,
+            env.S3_BUCKET_NAME,
+            env.S3_KEY_NAME,
+        ),
+        create,
+    )
+
+
+def prune_seen_events(env: Env) -> int:
+    # 処理済みのイベントを本番でS3に記録している時だけ消す
+    store = get_deduplicator(env).store
+    if not isinstance(store, S3SeenStore):
+        return 0
+    return store.prune()
@@ -0,0 +1,212 @@
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+)
+
+import requests
+from linebot.exceptions import LineBotApiError
+from linebot.models import SendMessage
+from linebot.models.error import Error
+
+from .http_client import LineMessagingClient
+
+# LINE Messaging APIの上限
+MULTICAST_MAX_RECIPIENTS = 500
+MAX_MESSAGES_PER_REQUEST = 5
+PUSH_RATE_LIMIT = 2000  # requests/sec
+MULTICAST_RATE_LIMIT = 200  # requests/sec
+
+MAX_WORKERS = 16
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5  # sec
+BACKOFF_MAX = 8.0  # sec
+
+PUSH_PATH = "/v2/bot/message/push"
+MULTICAST_PATH = "/v2/bot/message/multicast"
+
+T = TypeVar("T")
+
+
+class MessagePayload:
+    # 同じメッセージを全宛先に送るため、JSONへの変換は1回だけにして使い回す
+    def __init__(self, messages: List[Dict[str, Any]]) -> None:
+        self.messages = messages
+        self.body = json.dumps(messages, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def from_messages(cls, messages: Sequence[SendMessage]) -> "MessagePayload":
+        return cls([message.as_json_dict() for message in messages])
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MessagePayload) and self.messages == other.messages
+
+    def request_body(self, to: Union[str, List[str]]) -> bytes:
+        # 宛先だけを差し込む
+        to_json = json.dumps(to, separators=(",", ":")).encode("utf-8")
+        return b'{"to":' + to_json + b',"messages":' + self.body + b"}"
+
+
+@dataclass
+class Delivery:
+    to: List[str]
+    payload: MessagePayload
+    multicast: bool
+    # リトライ時も同じキーを送り、LINE側で重複配信を防ぐ
+    retry_key: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+
+@dataclass
+class DeliveryResult:
+    delivery: Delivery
+    attempts: int
+    error: Optional[LineBotApiError] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+def is_user_id(sender_id: str) -> bool:
+    # multicastはユーザーIDのみ宛先にできる (グループはC, トークルームはR始まり)
+    return sender_id.startswith("U")
+
+
+# 応答を受け取れなかった (接続できない・タイムアウト) ことを表すステータスコード
+NO_RESPONSE = 0
+
+
+def is_retryable(e: LineBotApiError) -> bool:
+    return e.status_code in (NO_RESPONSE, 429) or e.status_code >= 500
+
+
+def no_response_error(e: Exception) -> LineBotApiError:
+    # 呼び出し側の扱いを揃えるため、LINEのエラーと同じ形にする
+    message = f"{type(e).__name__}: {e}"
+    return LineBotApiError(NO_RESPONSE, {}, error=Error(message=message))
+
+
+def backoff(attempt: int) -> float:
+    # full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def chunked(items: Sequence[T], size: int) -> Iterator[List[T]]:
+    for i in range(0, len(items), size):
+        yield list(items[i : i + size])
+
+
+def plan_deliveries(
+    messages: Sequence[SendMessage], sender_ids: Sequence[str]
+) -> List[Delivery]:
+    user_ids = [sender_id for sender_id in sender_ids if is_user_id(sender_id)]
+    other_ids = [sender_id for sender_id in sender_ids if not is_user_id(sender_id)]
+
+    deliveries = []
+    for message_chunk in chunked(messages, MAX_MESSAGES_PER_REQUEST):
+        payload = MessagePayload.from_messages(message_chunk)
+        for user_chunk in chunked(user_ids, MULTICAST_MAX_RECIPIENTS):
+            deliveries.append(Delivery(user_chunk, payload, multicast=True))
+        for sender_id in other_ids:
+            deliveries.append(Delivery([sender_id], payload, multicast=False))
+    return deliveries
+
+
+class DeliveryExecutor:
+    def __init__(
+        self,
+        client: LineMessagingClient,
+        max_workers: int = MAX_WORKERS,
+        max_retries: int = MAX_RETRIES,
+        sleep: Callable[[float], None] = time.sleep,
+        rate_share: float = 1.0,
+    ) -> None:
+        self.client = client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.sleep = sleep
+        # レート制限はチャネル単位なので、分割して送る時は上限を分け合う
+        self.limiters: Dict[bool, TokenBucket] = {
+            True: TokenBucket(MULTICAST_RATE_LIMIT * rate_share, sleep=sleep),
+            False: TokenBucket(PUSH_RATE_LIMIT * rate_share, sleep=sleep),
+        }
+
+    def run(self, deliveries: Sequence[Delivery]) -> List[DeliveryResult]:
+        if not deliveries:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self.send, deliveries))
+
+    def send(self, delivery: Delivery) -> DeliveryResult:
+        attempt = 0
+        while True:
+            self.limiters[delivery.multicast].acquire()
+            try:
+                self._request(delivery)
+                return DeliveryResult(delivery, attempt + 1)
+            except LineBotApiError as e:
+                error = e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 一時的な障害なので同じリトライキーで送り直す
+                error = no_response_error(e)
+            # 409: 同じリトライキーのリクエストが受理済み。
+            # リトライキーはジャーナルに保存するので、中断した配信を再開した時は
+            # 最初の送信でも返ってくる
+            if error.status_code == 409:
+                return DeliveryResult(delivery, attempt + 1)
+            if not is_retryable(error) or attempt >= self.max_retries:
+                return DeliveryResult(delivery, attempt + 1, error)
+            self.sleep(backoff(attempt))
+            attempt += 1
+
+    def _request(self, delivery: Delivery) -> None:
+        if delivery.multicast:
+            body = delivery.payload.request_body(delivery.to)
+            self.client.post(MULTICAST_PATH, body, retry_key=delivery.retry_key)
+        else:
+            body = delivery.payload.request_body(delivery.to[0])
+            self.client.post(PUSH_PATH, body, retry_key=delivery.retry_key)
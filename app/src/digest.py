@@ -0,0 +1,128 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence
+
+from linebot.exceptions import LineBotApiError
+
+from .cache import TTLCache
+from .delivery import Delivery
+from .http_client import LineMessagingClient
+from .runtime import get_runtime
+
+# LINE Messaging APIのテキストメッセージの上限
+TEXT_MAX_LENGTH = 5000
+DIGEST_SEPARATOR = "\n\n"
+ELLIPSIS = "…"
+
+QUOTA_PATH = "/v2/bot/message/quota"
+QUOTA_CONSUMPTION_PATH = "/v2/bot/message/quota/consumption"
+# 残りがこの割合を下回りそうなら重要なツイートだけを送る
+QUOTA_RESERVE_RATIO = 0.1
+
+MEMBER_COUNT_PATHS = {
+    "C": "/v2/bot/group/{}/members/count",
+    "R": "/v2/bot/room/{}/members/count",
+}
+# 人数を取得できなかったグループ・トークルームの見積もり
+DEFAULT_GROUP_SIZE = 10
+# 人数はそれほど変わらないので、温まったコンテナの間は使い回す
+MEMBER_COUNT_MAXSIZE = 4096
+MEMBER_COUNT_TTL = 60 * 60.0  # sec
+
+
+def is_digest_mode() -> bool:
+    return os.getenv("BATCH_DIGEST", "").lower() in ("1", "true")
+
+
+def build_digest(texts: Sequence[str], max_length: int = TEXT_MAX_LENGTH) -> List[str]:
+    # 1回の実行で一致したツイートを上限までつなげ、吹き出しの数を減らす
+    bubbles: List[str] = []
+    for text in texts:
+        if len(text) > max_length:
+            text = text[: max_length - len(ELLIPSIS)] + ELLIPSIS
+        if bubbles and len(bubbles[-1] + DIGEST_SEPARATOR + text) <= max_length:
+            bubbles[-1] += DIGEST_SEPARATOR + text
+        else:
+            bubbles.append(text)
+    return bubbles
+
+
+@dataclass
+class MessageQuota:
+    limit: Optional[int]  # 上限が無いプランではNone
+    used: int
+
+    @property
+    def remaining(self) -> Optional[int]:
+        if self.limit is None:
+            return None
+        return max(self.limit - self.used, 0)
+
+    @property
+    def reserve(self) -> int:
+        if self.limit is None:
+            return 0
+        return int(self.limit * QUOTA_RESERVE_RATIO)
+
+
+def get_message_quota(client: LineMessagingClient) -> MessageQuota:
+    quota = client.get(QUOTA_PATH)
+    consumption = client.get(QUOTA_CONSUMPTION_PATH)
+    limit = quota["value"] if quota["type"] == "limited" else None
+    return MessageQuota(limit, consumption["totalUsage"])
+
+
+def get_member_counts(
+    client: LineMessagingClient, sender_ids: Iterable[str]
+) -> Dict[str, int]:
+    cache: TTLCache[int] = get_runtime().client(
+        "member_counts", lambda: TTLCache(MEMBER_COUNT_MAXSIZE, MEMBER_COUNT_TTL)
+    )
+    counts = {}
+    for sender_id in sender_ids:
+        path = MEMBER_COUNT_PATHS.get(sender_id[:1])
+        if path is None:
+            continue
+        count = cache.get(sender_id)
+        if count is None:
+            try:
+                count = int(client.get(path.format(sender_id))["count"])
+            except LineBotApiError:
+                # 取得できなければ見積もりで数える
+                continue
+            cache.set(sender_id, count)
+        counts[sender_id] = count
+    return counts
+
+
+def recipient_messages(sender_id: str, member_counts: Mapping[str, int]) -> int:
+    if sender_id in member_counts:
+        return member_counts[sender_id]
+    return DEFAULT_GROUP_SIZE if sender_id[:1] in MEMBER_COUNT_PATHS else 1
+
+
+def delivery_messages(delivery: Delivery, member_counts: Mapping[str, int]) -> int:
+    # グループ・トークルームへのpushはメンバーの人数分の通数になる
+    return sum(recipient_messages(to, member_counts) for to in delivery.to)
+
+
+def billable_messages(
+    deliveries: Sequence[Delivery], member_counts: Mapping[str, int] = {}
+) -> int:
+    # 吹き出しの数に関わらず、受け取る人1人ごとに1通と数えられる
+    return sum(delivery_messages(d, member_counts) for d in deliveries)
+
+
+def within_quota(
+    deliveries: Sequence[Delivery],
+    remaining: int,
+    member_counts: Mapping[str, int] = {},
+) -> List[Delivery]:
+    # 上限を超えた配信はLINEに拒否されるので、収まる分だけを前から選ぶ
+    chosen = []
+    for delivery in deliveries:
+        required = delivery_messages(delivery, member_counts)
+        if required <= remaining:
+            chosen.append(delivery)
+            remaining -= required
+    return chosen
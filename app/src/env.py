@@ -3,11 +3,15 @@ import os
 import sys
 from dataclasses import dataclass
 
-import boto3
-
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
 
+# 状態の保存先。Lambdaの外で動かす時はS3の代わりにローカルへ保存できる
+STORAGE_S3 = "s3"
+STORAGE_LOCAL = "local"  # STORAGE_DIRの下のファイル
+STORAGE_SQLITE = "sqlite"  # STORAGE_DIRの下のSQLiteデータベース
+STORAGE_BACKENDS = (STORAGE_S3, STORAGE_LOCAL, STORAGE_SQLITE)
+
 
 @dataclass
 class Env:
@@ -17,10 +21,14 @@ class Env:
     S3_BUCKET_NAME: str = ""
     S3_KEY_NAME: str = ""
     TWITTER_BEARER_TOKEN: str = ""
+    STORAGE: str = STORAGE_S3
+    STORAGE_DIR: str = ""
 
 
 def get_env() -> Env:
     if os.getenv("ENV_NAME", None) == "prod":
+        import boto3
+
         ssm = boto3.client("ssm")
         response = ssm.get_parameters(
             Names=[
@@ -35,6 +43,10 @@ def get_env() -> Env:
         secrets = {store["Name"]: store["Value"] for store in response["Parameters"]}
         return Env(**secrets)
     else:
+        storage = os.getenv("STORAGE", STORAGE_S3)
+        if storage not in STORAGE_BACKENDS:
+            logger.error(f"STORAGE must be one of {', '.join(STORAGE_BACKENDS)}.")
+            sys.exit(1)
         return Env(
             S3_BUCKET_NAME=get_env_by_key("S3_BUCKET_NAME"),
             S3_KEY_NAME=get_env_by_key("S3_KEY_NAME"),
@@ -42,6 +54,10 @@ def get_env() -> Env:
             LINE_CHANNEL_ACCESS_TOKEN=get_env_by_key("LINE_CHANNEL_ACCESS_TOKEN"),
             OPENAI_API_KEY=get_env_by_key("OPENAI_API_KEY"),
             TWITTER_BEARER_TOKEN=get_env_by_key("TWITTER_BEARER_TOKEN"),
+            STORAGE=storage,
+            STORAGE_DIR=(
+                "" if storage == STORAGE_S3 else get_env_by_key("STORAGE_DIR")
+            ),
         )
 
 
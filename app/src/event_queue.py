@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from .runtime import get_runtime
+
+logger = logging.getLogger()
+
+WebhookEvents = List[Dict[str, Any]]
+
+
+def is_async_mode() -> bool:
+    return os.getenv("WEBHOOK_ASYNC", "").lower() in ("1", "true")
+
+
+class EventQueue:
+    def put(self, events: WebhookEvents) -> None:
+        raise NotImplementedError
+
+
+class LambdaEventQueue(EventQueue):
+    # 自身を非同期で呼び出し、後続の実行でイベントを処理する
+    def __init__(self, function_arn: str) -> None:
+        self.function_arn = function_arn
+
+    def put(self, events: WebhookEvents) -> None:
+        import boto3
+
+        client = get_runtime().client("lambda", lambda: boto3.client("lambda"))
+        client.invoke(
+            FunctionName=self.function_arn,
+            InvocationType="Event",
+            Payload=json.dumps({"webhookEvents": events}).encode("utf-8"),
+        )
+
+
+class LocalEventQueue(EventQueue):
+    # ローカル実行とテスト用に、同じプロセスのスレッドでイベントを処理する
+    def __init__(
+        self, worker: Callable[[WebhookEvents], Any], window: float = 0.0
+    ) -> None:
+        self.worker = worker
+        self.window = window
+        self._queue: "queue.Queue[WebhookEvents]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def put(self, events: WebhookEvents) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put(events)
+
+    def join(self) -> None:
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            batches = self._collect()
+            try:
+                self.worker([event for events in batches for event in events])
+            except Exception:
+                logger.exception("Failed to process webhook events")
+            finally:
+                for _ in batches:
+                    self._queue.task_done()
+
+    def _collect(self) -> List[WebhookEvents]:
+        # 待っている間に届いたイベントもまとめて処理し、購読者の更新を1回で済ませる
+        batches = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while True:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batches.append(self._queue.get(timeout=timeout))
+                else:
+                    batches.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batches
+
+
+def get_event_queue(
+    function_arn: str, worker: Callable[[WebhookEvents], Any]
+) -> EventQueue:
+    if os.getenv("ENV_NAME", None) == "prod":
+        return LambdaEventQueue(function_arn)
+    window = float(os.getenv("WEBHOOK_BATCH_WINDOW", "0"))
+    return get_runtime().client(
+        "local_event_queue", lambda: LocalEventQueue(worker, window)
+    )
@@ -0,0 +1,127 @@
+from typing import Any, Dict, Optional
+
+import requests
+from linebot import LineBotApi, __version__
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import (
+    HttpClient,
+    HttpResponse,
+    RequestsHttpClient,
+    RequestsHttpResponse,
+)
+from linebot.models.error import Error
+from requests.adapters import HTTPAdapter
+
+# 配信の並列数に合わせてコネクションを保持する
+POOL_MAXSIZE = 32
+
+
+# line-bot-sdkは型情報を持たないため、基底クラスがAnyになる
+class PooledHttpClient(RequestsHttpClient):  # type: ignore[misc]
+    # LineBotApi標準のクライアントはリクエストごとに接続し直すため、Sessionで使い回す
+    def __init__(self, timeout: Any = RequestsHttpClient.DEFAULT_TIMEOUT) -> None:
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+
+    def _request(
+        self, method: str, url: str, timeout: Any, **kwargs: Any
+    ) -> RequestsHttpResponse:
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.request(method, url, timeout=timeout, **kwargs)
+        return RequestsHttpResponse(response)
+
+    def get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+        timeout: Any = None,
+    ) -> RequestsHttpResponse:
+        return self._request(
+            "GET", url, timeout, headers=headers, params=params, stream=stream
+        )
+
+    def post(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        data: Any = None,
+        timeout: Any = None,
+    ) -> RequestsHttpResponse:
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def put(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        data: Any = None,
+        timeout: Any = None,
+    ) -> RequestsHttpResponse:
+        return self._request("PUT", url, timeout, headers=headers, data=data)
+
+    def delete(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        data: Any = None,
+        timeout: Any = None,
+    ) -> RequestsHttpResponse:
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+
+class LineMessagingClient:
+    # 組み立て済みのリクエストボディをそのまま送り、SDKによる宛先ごとの変換を省く。
+    # LineBotApiと違い、リトライキーを共有のヘッダーに書き込まないので並列に送れる
+    def __init__(
+        self,
+        channel_access_token: str,
+        endpoint: str = LineBotApi.DEFAULT_API_ENDPOINT,
+        http_client: Optional[HttpClient] = None,
+    ) -> None:
+        self.endpoint = endpoint
+        self.http_client = http_client or PooledHttpClient()
+        self.headers = {
+            "Authorization": "Bearer " + channel_access_token,
+            "Content-Type": "application/json",
+            "User-Agent": "line-bot-sdk-python/" + __version__,
+        }
+
+    def post(self, path: str, body: bytes, retry_key: Optional[str] = None) -> None:
+        headers = self.headers
+        if retry_key is not None:
+            headers = {**headers, "X-Line-Retry-Key": retry_key}
+        response = self.http_client.post(
+            self.endpoint + path, headers=headers, data=body
+        )
+        self._check(response)
+
+    def get(self, path: str) -> Dict[str, Any]:
+        response = self.http_client.get(self.endpoint + path, headers=self.headers)
+        self._check(response)
+        body: Dict[str, Any] = response.json
+        return body
+
+    def _check(self, response: HttpResponse) -> None:
+        if not 200 <= response.status_code < 300:
+            # LineBotApiと同じ例外にして、呼び出し側の扱いを揃える
+            raise LineBotApiError(
+                status_code=response.status_code,
+                headers=dict(response.headers.items()),
+                request_id=response.headers.get("X-Line-Request-Id"),
+                accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+                error=self._error(response),
+            )
+
+    def _error(self, response: HttpResponse) -> Error:
+        # 502/503などはLINEの手前からHTMLや空のボディで返るため、本文をそのまま入れる
+        try:
+            body = response.json
+        except ValueError:
+            return Error(message=response.text or str(response.status_code))
+        if not isinstance(body, dict):
+            return Error(message=response.text)
+        return Error.new_from_json_dict(body)
@@ -0,0 +1,53 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List
+
+from .env import Env
+from .storage import get_blob_store
+
+# 配信済みツイートidを保持する件数
+LEDGER_MAX_SIZE = 500
+
+logger = logging.getLogger()
+
+
+@dataclass
+class IngestState:
+    # アカウントごとの処理済み最新ツイートid
+    since_ids: Dict[str, int] = field(default_factory=dict)
+    # 配信済みツイートid (古い順)
+    sent_ids: List[int] = field(default_factory=list)
+
+    def is_sent(self, status_id: int) -> bool:
+        return status_id in self.sent_ids
+
+    def mark_sent(self, status_ids: Iterable[int]) -> None:
+        for status_id in status_ids:
+            if status_id not in self.sent_ids:
+                self.sent_ids.append(status_id)
+        del self.sent_ids[:-LEDGER_MAX_SIZE]
+
+    def advance(self, screen_name: str, status_ids: Iterable[int]) -> None:
+        since_id = max(status_ids, default=0)
+        if since_id > self.since_ids.get(screen_name, 0):
+            self.since_ids[screen_name] = since_id
+
+
+def state_key(key: str) -> str:
+    # 購読者リストと同じ場所に保存する
+    return f"{key}.state.json"
+
+
+def load_state(env: Env) -> IngestState:
+    body = get_blob_store(env).get(state_key(env.S3_KEY_NAME))
+    if body is None:
+        logger.info("取り込み状態が無いため初期状態から開始")
+        return IngestState()
+    state = json.loads(body)
+    return IngestState(since_ids=state["since_ids"], sent_ids=state["sent_ids"])
+
+
+def save_state(env: Env, state: IngestState) -> None:
+    body = {"since_ids": state.since_ids, "sent_ids": state.sent_ids}
+    get_blob_store(env).put(state_key(env.S3_KEY_NAME), json.dumps(body).encode())
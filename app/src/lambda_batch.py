@@ -1,24 +1,88 @@
 import json
 import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta, timezone
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple, Union, cast
 
 import boto3
-from linebot import LineBotApi
 from linebot.exceptions import LineBotApiError
 from linebot.models import TextSendMessage
 from tweepy import API, OAuth2BearerHandler
+from tweepy.errors import TweepyException
 from tweepy.models import Status
 
-from .env import get_env
-from .lambda_types import EventBridgeEvent, LambdaContext, LambdaResponse
+from .dedup import prune_seen_events
+from .delivery import (
+    Delivery,
+    DeliveryExecutor,
+    DeliveryResult,
+    chunked,
+    plan_deliveries,
+)
+from .digest import (
+    billable_messages,
+    build_digest,
+    get_member_counts,
+    get_message_quota,
+    is_digest_mode,
+    within_quota,
+)
+from .env import Env
+from .http_client import LineMessagingClient
+from .ingest_state import IngestState, load_state, save_state
+from .lambda_types import (
+    BatchShardEvent,
+    EventBridgeEvent,
+    LambdaContext,
+    LambdaResponse,
+)
+from .matcher import KeywordMatcher, get_matcher
+from .metrics import get_metrics, instrument
+from .outbox import (
+    FAILED,
+    SENT,
+    MemoryOutboxStore,
+    Outbox,
+    OutboxStore,
+    get_outbox_store,
+)
+from .recipient_health import (
+    PrunedRecipient,
+    load_health,
+    recipient_outcomes,
+    save_health,
+)
+from .runtime import get_runtime
+from .sharding import (
+    ShardResult,
+    get_shard_dispatcher,
+    get_shard_result_store,
+    partition,
+    shard_size,
+)
+from .sources import Source, load_sources
+from .subscriber_store import get_subscriber_store
+from .timeline_cache import get_timeline_cache
+from .topics import TopicIndex, get_subscription_store, get_topic_config
+
+FETCH_MAX_WORKERS = 20
+CHECKPOINT_SIZE = 100  # 配信ジャーナルを保存する間隔
+DEADLINE_MARGIN_MS = 30 * 1000
 
 # loggerの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def lambda_handler(event: EventBridgeEvent, context: LambdaContext) -> LambdaResponse:
+BatchEvent = Union[EventBridgeEvent, BatchShardEvent]
+
+
+@instrument("Batch")
+def lambda_handler(event: BatchEvent, context: LambdaContext) -> LambdaResponse:
     ok_json = LambdaResponse(
         {
             "isBase64Encoded": False,
@@ -36,89 +100,470 @@ def lambda_handler(event: EventBridgeEvent, context: LambdaContext) -> LambdaRes
         }
     )
 
-    env = get_env()
+    metrics = get_metrics()
+    with metrics.timer("Secrets"):
+        env = get_runtime().env
+
+    # コーディネーターから起動されたワーカー
+    if "shard" in event:
+        result = run_shard(env, cast(BatchShardEvent, event), context)
+        return ok_json if result else error_json
+
+    # Webhookが記録した処理済みのイベントのうち、期限が過ぎたものを消す
+    with metrics.timer("SeenEventsPrune"):
+        metrics.count("SeenEventsPruned", prune_seen_events(env))
+
+    store = get_outbox_store(env)
+    with metrics.timer("OutboxRead"):
+        outbox = store.load()
+    if outbox is None:
+        outbox = create_outbox(env, store)
+    else:
+        logger.info("中断した配信を再開")
+
+    if not outbox.entries:
+        return ok_json
+
+    # 宛先が多い時はシャードに分けて並列に配信する
+    shards = partition(outbox, shard_size())
+    if len(shards) > 1:
+        result = dispatch_shards(env, outbox, store, shards, event, context)
+        return ok_json if result else error_json
+
+    line_client = get_line_client(env.LINE_CHANNEL_ACCESS_TOKEN)
+    result = send_outbox(
+        outbox, store, line_client, context.get_remaining_time_in_millis
+    )
+
+    if outbox.pending():
+        continue_batch(event, context)
+    else:
+        update_recipient_health(env, outbox)
 
-    sender_ids = get_sender_ids(env.S3_BUCKET_NAME, env.S3_KEY_NAME)
+    return ok_json if result else error_json
 
-    auth = OAuth2BearerHandler(env.TWITTER_BEARER_TOKEN)
-    twitter_api = API(auth)
 
-    push_list = get_send_message_by_dbd_official(twitter_api)
-    push_list += get_send_message_by_ruby_nea(twitter_api)
+def get_line_client(line_channel_access_token: str) -> LineMessagingClient:
+    return get_runtime().client(
+        ("line_messaging", line_channel_access_token),
+        lambda: LineMessagingClient(line_channel_access_token),
+    )
 
-    return (
-        ok_json
-        if send_message(push_list, sender_ids, env.LINE_CHANNEL_ACCESS_TOKEN)
-        else error_json
+
+def get_twitter_api(twitter_bearer_token: str) -> API:
+    return get_runtime().client(
+        ("twitter", twitter_bearer_token),
+        lambda: API(OAuth2BearerHandler(twitter_bearer_token)),
     )
 
 
-def send_message(
-    push_list: List[Status], sender_ids: List[str], line_channel_access_token: str
+def create_outbox(env: Env, store: OutboxStore) -> Outbox:
+    metrics = get_metrics()
+    with metrics.timer("SubscriberRead"):
+        subscriber_store = get_subscriber_store(env)
+        subscriber_store.compact()
+        members = subscriber_store.members()
+
+    # 失敗が続いている宛先には、様子を見る期間が過ぎるまで送らない
+    with metrics.timer("HealthRead"):
+        health = load_health(env)
+    now = time.time()
+    sender_ids = [s for s in members if health.should_deliver(s, now)]
+    if len(sender_ids) < len(members):
+        logger.info("配信を停止中の宛先: %d件" % (len(members) - len(sender_ids)))
+    metrics.count("Recipients", len(sender_ids))
+    metrics.count("RecipientsQuarantined", len(members) - len(sender_ids))
+    if health.retain(members):
+        save_health(env, health)
+
+    with metrics.timer("TopicRead"):
+        topics = get_topic_config(env).topics()
+        subscriptions = get_subscription_store(env).load()
+    index = TopicIndex(topics, sender_ids, subscriptions)
+
+    twitter_api = get_twitter_api(env.TWITTER_BEARER_TOKEN)
+
+    with metrics.timer("StateRead"):
+        state = load_state(env)
+
+    timelines: Dict[str, List[Status]] = {}
+    with metrics.timer("TwitterFetch"):
+        push_list = get_send_messages(twitter_api, load_sources(), state, timelines)
+    # Webhookの返信で使うタイムラインを更新する
+    with metrics.timer("TimelineCacheWrite"):
+        get_timeline_cache(env).update(timelines)
+
+    digest = is_digest_mode()
+    if digest:
+        # 重要なツイートを先頭の吹き出しにまとめる
+        push_list.sort(key=lambda s: not index.is_high_priority(s.full_text))
+    deliveries = plan_outbox(push_list, index, digest)
+    if digest and deliveries:
+        deliveries = fit_quota(env, push_list, index, deliveries)
+    metrics.count("BillableMessages", billable_messages(deliveries))
+    outbox = Outbox.from_deliveries(deliveries)
+    metrics.count("Deliveries", len(outbox.entries))
+    if outbox.entries:
+        with metrics.timer("OutboxWrite"):
+            store.save(outbox)
+
+    # 配信はジャーナルに引き継いだので、途中で失敗しても配信済みとして記録する
+    state.mark_sent([status.id for status in push_list])
+    with metrics.timer("StateWrite"):
+        save_state(env, state)
+
+    return outbox
+
+
+def plan_outbox(
+    statuses: List[Status], index: TopicIndex, digest: bool
+) -> List[Delivery]:
+    texts = [status.full_text for status in statuses]
+    # 購読するトピックに一致したツイートだけを送る
+    deliveries = []
+    for indexes, recipients in index.audiences(texts):
+        chosen = [texts[i] for i in indexes]
+        if digest:
+            chosen = build_digest(chosen)
+        messages = [TextSendMessage(text=text) for text in chosen]
+        deliveries += plan_deliveries(messages, recipients)
+    return deliveries
+
+
+def fit_quota(
+    env: Env, statuses: List[Status], index: TopicIndex, deliveries: List[Delivery]
+) -> List[Delivery]:
+    metrics = get_metrics()
+    try:
+        with metrics.timer("QuotaRead"):
+            quota = get_message_quota(get_line_client(env.LINE_CHANNEL_ACCESS_TOKEN))
+    except LineBotApiError as e:
+        # 残りが分からなくても配信は止めない
+        logger.error("Failed to get message quota: %s" % e)
+        return deliveries
+    if quota.remaining is None:
+        return deliveries
+    metrics.count("QuotaRemaining", quota.remaining)
+
+    with metrics.timer("MemberCountRead"):
+        member_counts = get_member_counts(
+            get_line_client(env.LINE_CHANNEL_ACCESS_TOKEN),
+            {to for delivery in deliveries for to in delivery.to},
+        )
+    required = billable_messages(deliveries, member_counts)
+    if quota.remaining - required >= quota.reserve:
+        return deliveries
+    # 残りが少ない時は重要なトピックのツイートだけを送る
+    important = [s for s in statuses if index.is_high_priority(s.full_text)]
+    logger.info(
+        "メッセージの残りが少ないため重要なツイートだけを配信: 残り%d通, %d件中%d件"
+        % (quota.remaining, len(statuses), len(important))
+    )
+    metrics.count("TweetsSkipped", len(statuses) - len(important))
+    deliveries = plan_outbox(important, index, True)
+    required = billable_messages(deliveries, member_counts)
+    if required > quota.remaining:
+        logger.error(
+            "Message quota exhausted: %d remaining, %d required"
+            % (quota.remaining, required)
+        )
+        deliveries = within_quota(deliveries, quota.remaining, member_counts)
+    return deliveries
+
+
+def dispatch_shards(
+    env: Env,
+    outbox: Outbox,
+    store: OutboxStore,
+    shards: List[Outbox],
+    event: BatchEvent,
+    context: LambdaContext,
 ) -> bool:
-    line_bot_api = LineBotApi(line_channel_access_token)
+    metrics = get_metrics()
+    # 前回のワーカーが残っていてもジャーナルが重ならないよう、実行ごとに名前を変える
+    run_id = uuid.uuid4().hex[:12]
+    named = {f"{run_id}-{i}": shard for i, shard in enumerate(shards)}
+    metrics.count("Shards", len(named))
+    dispatcher = get_shard_dispatcher(
+        env, context.invoked_function_arn, run_local_shard, DEADLINE_MARGIN_MS
+    )
+    with metrics.timer("ShardDispatch"):
+        dispatcher.start(named, context.get_remaining_time_in_millis())
+    logger.info("%d個のシャードに分けて配信" % len(named))
+    if dispatcher.durable:
+        # 各ワーカーのジャーナルに引き継いだので、元のジャーナルは消す
+        store.clear()
+    with metrics.timer("ShardWait"):
+        results = dispatcher.wait(named, context.get_remaining_time_in_millis)
+
+    sent = sum(result.sent for result in results.values())
+    failed = sum(result.failed for result in results.values())
+    pending = sum(result.pending for result in results.values())
+    logger.info("配信結果: 送信 %d件, 失敗 %d件, 未配信 %d件" % (sent, failed, pending))
+    missing = [name for name in named if name not in results]
+    if missing:
+        logger.error("Shards did not report: %s" % ", ".join(missing))
+
+    for name, result in results.items():
+        result.apply(named[name])
+
+    if dispatcher.durable:
+        # 残りはワーカー自身が後続の実行に引き継ぎ、終わった時に宛先の結果を記録する。
+        # 報告の無かったシャードは未配信のままなので、ここでは記録されない
+        update_recipient_health(env, outbox)
+        return failed == 0 and not missing
+
+    # ワーカーの結果を元のジャーナルに書き戻し、未配信分は次に回す
+    metrics.count("PushesSent", sent)
+    metrics.count("Failures", failed)
+    with metrics.timer("Checkpoint"):
+        if outbox.pending():
+            store.save(outbox)
+        else:
+            store.clear()
+    if outbox.pending():
+        continue_batch(event, context)
+    else:
+        update_recipient_health(env, outbox)
+    return failed == 0 and not missing
+
+
+def run_shard(env: Env, event: BatchShardEvent, context: LambdaContext) -> bool:
+    store = get_outbox_store(env, event["shard"])
+    outbox = store.load()
+    if outbox is None:
+        logger.info("配信済みのシャード: %s" % event["shard"])
+        return True
+
+    line_client = get_line_client(env.LINE_CHANNEL_ACCESS_TOKEN)
+    result = send_outbox(
+        outbox,
+        store,
+        line_client,
+        context.get_remaining_time_in_millis,
+        rate_share=1 / event["shards"],
+    )
+
+    if outbox.pending():
+        continue_batch(event, context)
+    else:
+        result_store = get_shard_result_store(env)
+        if not result_store.put(ShardResult.from_outbox(event["shard"], outbox)):
+            logger.info("待つのをやめたシャードの配信が完了: %s" % event["shard"])
+            update_recipient_health(env, outbox)
+    return result
+
+
+def run_local_shard(
+    shard: str, outbox: Outbox, remaining_ms: int, rate_share: float
+) -> ShardResult:
+    # プロセスプールで動くため、呼び出し元のジャーナルには結果を返して書き戻してもらう
+    env = get_runtime().env
+    line_client = get_line_client(env.LINE_CHANNEL_ACCESS_TOKEN)
+    deadline = time.monotonic() + remaining_ms / 1000
+    send_outbox(
+        outbox,
+        MemoryOutboxStore(),
+        line_client,
+        lambda: int((deadline - time.monotonic()) * 1000),
+        rate_share=rate_share,
+    )
+    return ShardResult.from_outbox(shard, outbox)
+
+
+def update_recipient_health(env: Env, outbox: Outbox) -> None:
+    # 配信が全て終わった時に、宛先ごとの結果を記録する
+    outcomes = recipient_outcomes(outbox.entries)
+    if not outcomes:
+        return
+    metrics = get_metrics()
+    now = time.time()
+    with metrics.timer("HealthWrite"):
+        health = load_health(env)
+        pruned: List[PrunedRecipient] = []
+        for sender_id, error in outcomes.items():
+            record = health.record(sender_id, error, now)
+            if record is not None:
+                pruned.append(record)
+        if pruned:
+            removed = [record.sender_id for record in pruned]
+            get_subscriber_store(env).apply([], removed)
+        save_health(env, health)
+    metrics.count("RecipientsPruned", len(pruned))
+    for record in pruned:
+        logger.info(
+            "配信できない宛先を削除: %s (status %s, %d回失敗)"
+            % (record.sender_id, record.last_error, record.failures)
+        )
+
+
+def send_outbox(
+    outbox: Outbox,
+    store: OutboxStore,
+    line_client: LineMessagingClient,
+    remaining_ms: Callable[[], int],
+    rate_share: float = 1.0,
+) -> bool:
+    metrics = get_metrics()
+    executor = DeliveryExecutor(line_client, rate_share=rate_share)
     raise_error = False
-    for status in push_list:
-        messages = []
-        messages.append(TextSendMessage(text=status.full_text))
-        for sender_id in sender_ids:
-            try:
-                line_bot_api.push_message(sender_id, messages=messages)
-            except LineBotApiError as e:
-                logger.error("Got exception from LINE Messaging API: %s\n" % e.message)
-                for m in e.error.details:
-                    logger.error("  %s: %s" % (m.property, m.message))
-                raise_error = True
+    for entries in chunked(outbox.pending(), CHECKPOINT_SIZE):
+        if remaining_ms() < DEADLINE_MARGIN_MS:
+            logger.info("タイムアウトが近いため配信を中断")
+            break
+        with metrics.timer("LinePush"):
+            results = executor.run([outbox.to_delivery(entry) for entry in entries])
+        for entry, result in zip(entries, results):
+            entry.state = SENT if result.ok else FAILED
+            entry.error = result.error.status_code if result.error else None
+        record_delivery_metrics(results)
+        if not log_delivery_errors(results):
+            raise_error = True
+
+        with metrics.timer("Checkpoint"):
+            if outbox.pending():
+                store.save(outbox)
+            else:
+                store.clear()
 
     return not raise_error
 
 
-def get_sender_ids(bucket: str, key: str) -> List[str]:
-    s3 = boto3.resource("s3")
-    obj = s3.Object(bucket, key)
-    return list(json.loads(obj.get()["Body"].read()))
-
-
-def get_send_message_by_dbd_official(twitter_api: API) -> List[Status]:
-    SCREEN_NAME = "DeadbyBHVR_JP"
-    OUTPUT_FILTER = [
-        "シュライン・オブ・シークレット",
-        "引き換えコード",
-        "BP",
-        "ブラッドポイント",
-        "インデスントシャード",
-        "シャード",
-        "アップデート",
-        "ログイン",
-        "ラインナップ",
-    ]
-    statuses = get_statuses(twitter_api, SCREEN_NAME)
-    return [status for status in statuses if judge_output_status(status, OUTPUT_FILTER)]
+def continue_batch(event: BatchEvent, context: LambdaContext) -> None:
+    if os.getenv("ENV_NAME", None) != "prod":
+        logger.info("未配信分は次回の実行で配信")
+        return
+    boto3.client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(event).encode("utf-8"),
+    )
+    logger.info("未配信分を後続の実行に引き継ぎ")
+
+
+def record_delivery_metrics(results: List[DeliveryResult]) -> None:
+    metrics = get_metrics()
+    metrics.count("PushesSent", sum(1 for result in results if result.ok))
+    metrics.count("Failures", sum(1 for result in results if not result.ok))
+    metrics.count("Retries", sum(result.attempts - 1 for result in results))
 
 
-def get_send_message_by_ruby_nea(twitter_api: API) -> List[Status]:
-    SCREEN_NAME = "Ruby_Nea_"
-    OUTPUT_FILTER = [
-        "引き換えコード",
-        "コード",
+def log_delivery_errors(results: List[DeliveryResult]) -> bool:
+    raise_error = False
+    for result in results:
+        if result.error is None:
+            continue
+        e = result.error
+        logger.error("Got exception from LINE Messaging API: %s\n" % e.message)
+        for m in e.error.details:
+            logger.error("  %s: %s" % (m.property, m.message))
+        logger.error("  to: %s" % ", ".join(result.delivery.to))
+        raise_error = True
+
+    return not raise_error
+
+
+def get_send_messages(
+    twitter_api: API,
+    sources: List[Source],
+    state: IngestState,
+    timelines: Optional[Dict[str, List[Status]]] = None,
+) -> List[Status]:
+    # 遅いアカウントに引きずられないよう全アカウントを並列に取得する
+    pool = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS)
+    futures = [
+        pool.submit(
+            get_statuses,
+            twitter_api,
+            source,
+            state.since_ids.get(source.screen_name),
+        )
+        for source in sources
     ]
-    statuses = get_statuses(twitter_api, SCREEN_NAME)
-    return [status for status in statuses if judge_output_status(status, OUTPUT_FILTER)]
-
-
-def get_statuses(twitter_api: API, screen_name: str) -> List[Status]:
-    return list(
-        twitter_api.user_timeline(
-            screen_name=screen_name,
-            count=20,
-            tweet_mode="extended",
-            exclude_replies=False,
-            include_rts=False,
+    started_at = time.monotonic()
+
+    metrics = get_metrics()
+    cutoff = output_cutoff()
+    push_list: List[Status] = []
+    for source, future in zip(sources, futures):
+        # since_idがあればその後のツイートを全て配信する。実行が遅れたり抜けたりしても
+        # 古いツイートとして捨てないよう、期限は初回の実行にだけ使う
+        first_run = state.since_ids.get(source.screen_name) is None
+        remaining = source.timeout - (time.monotonic() - started_at)
+        try:
+            statuses, complete = future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            logger.error("Timed out fetching tweets of %s" % source.screen_name)
+            metrics.count("FetchFailures")
+            continue
+        except TweepyException as e:
+            logger.error("Got exception from Twitter API: %s" % e)
+            metrics.count("FetchFailures")
+            continue
+        if complete:
+            state.advance(source.screen_name, [status.id for status in statuses])
+        else:
+            # 取りきれなかったツイートを次回に取得できるよう、since_idを進めない。
+            # 今回取得した分は配信済みidで重複を防ぐ
+            logger.error(
+                "Too many new tweets of %s; keeping since_id" % source.screen_name
+            )
+            metrics.count("FetchIncomplete")
+        if timelines is not None:
+            timelines[source.screen_name] = statuses
+        matcher = get_matcher(source.keywords)
+        matched = [
+            status
+            for status in statuses
+            if not state.is_sent(status.id)
+            and judge_output_status(status, matcher, cutoff if first_run else None)
+        ]
+        metrics.count("TweetsFetched", len(statuses))
+        metrics.count("TweetsMatched", len(matched))
+        push_list += matched
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    return push_list
+
+
+def get_statuses(
+    twitter_api: API, source: Source, since_id: Optional[int] = None
+) -> Tuple[List[Status], bool]:
+    # (since_id以降のツイート, 全て取得できたか) を返す
+    MAX_PAGES = 5
+    statuses: List[Status] = []
+    max_id = None
+    # since_id以降のツイートを新しい順にページングして取得する
+    for _ in range(MAX_PAGES):
+        page = list(
+            twitter_api.user_timeline(
+                screen_name=source.screen_name,
+                count=source.count,
+                since_id=since_id,
+                max_id=max_id,
+                tweet_mode="extended",
+                exclude_replies=source.exclude_replies,
+                include_rts=source.include_rts,
+            )
         )
-    )
+        statuses += page
+        # countはRTやリプライを除く前に適用されるため、少ないページでも続きがある。
+        # 空のページが返るかsince_idに届くまで続ける
+        if since_id is None or not page:
+            return statuses, True
+        max_id = min(status.id for status in page) - 1
+        if max_id <= since_id:
+            return statuses, True
+    return statuses, False
+
 
+def output_cutoff() -> datetime:
+    return datetime.now(timezone.utc) - timedelta(hours=12)
 
-def judge_output_status(status: Status, filter_list: List[str]) -> bool:
-    return status.created_at >= datetime.now(timezone.utc) - timedelta(
-        hours=12
-    ) and bool(list(filter(lambda x: x in status.full_text, filter_list)))
+
+def judge_output_status(
+    status: Status, matcher: KeywordMatcher, cutoff: Optional[datetime]
+) -> bool:
+    if cutoff is not None and status.created_at < cutoff:
+        return False
+    return matcher.search(status.full_text)
@@ -1,4 +1,4 @@
-from typing import Dict, List, TypedDict
+from typing import Dict, List, Protocol, TypedDict
 
 EventBridgeEvent = TypedDict(
     "EventBridgeEvent",
@@ -16,7 +16,12 @@ EventBridgeEvent = TypedDict(
 )
 
 
-class LambdaContext(TypedDict):
+class BatchShardEvent(TypedDict):
+    shard: str
+    shards: int
+
+
+class LambdaContext(Protocol):
     function_name: str
     function_version: str
     invoked_function_arn: str
@@ -27,6 +32,9 @@ class LambdaContext(TypedDict):
     identity: object
     client_context: object
 
+    def get_remaining_time_in_millis(self) -> int:
+        ...
+
 
 class LambdaResponse(TypedDict):
     isBase64Encoded: bool
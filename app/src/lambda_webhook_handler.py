@@ -1,28 +1,45 @@
+import base64
+import hashlib
+import hmac
 import json
 import logging
-from typing import TypedDict
-
-import boto3
-import openai
-from linebot import LineBotApi, WebhookHandler, WebhookPayload
-from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import (
-    Event,
-    JoinEvent,
-    LeaveEvent,
-    MessageEvent,
-    TextMessage,
-    TextSendMessage,
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypedDict,
+    Union,
 )
-from tweepy import API, OAuth2BearerHandler
 
-from .env import Env, get_env
+from .capture import get_capture_store, redact_request
+from .dedup import EventDeduplicator, get_deduplicator
+from .env import Env
+from .event_queue import get_event_queue, is_async_mode
 from .lambda_types import LambdaContext, LambdaResponse
+from .metrics import get_metrics, instrument
+from .runtime import get_runtime
+
+# openai, tweepy, boto3, linebotは読み込みが重いため、コールドスタートを軽くするよう
+# 必要になった処理の中で読み込む
 
 # loggerの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+SHRINE_COMMAND = "今週の聖堂"
+CHATGPT_COMMAND = "/chatgpt"
+TOPIC_COMMAND = "/topic"
+ALL_TOPICS = "all"
+CHATGPT_MODEL = "gpt-3.5-turbo"
+# 返信トークンの有効期限切れ・使用済みの時にLINEが返すメッセージ
+INVALID_REPLY_TOKEN = "Invalid reply token"
+
+EventHandler = Callable[[Dict[str, Any], Env], None]
+
 RequestHeadersFromLineBot = TypedDict(
     "RequestHeadersFromLineBot",
     {"x-line-signature": str, "X-Line-Signature": str},
@@ -32,11 +49,21 @@ RequestHeadersFromLineBot = TypedDict(
 
 class RequestFromLineBot(TypedDict):
     headers: RequestHeadersFromLineBot
-    body: WebhookPayload
+    body: str
+
+
+class WarmupRequest(TypedDict):
+    warmup: bool
 
 
+class WebhookEventsRequest(TypedDict):
+    webhookEvents: List[Dict[str, Any]]
+
+
+@instrument("Webhook")
 def lambda_handler(
-    request: RequestFromLineBot, context: LambdaContext
+    request: Union[RequestFromLineBot, WarmupRequest, WebhookEventsRequest],
+    context: LambdaContext,
 ) -> LambdaResponse:
     ok_json = LambdaResponse(
         {
@@ -55,116 +82,357 @@ def lambda_handler(
         }
     )
 
-    env = get_env()
-    handler = WebhookHandler(env.LINE_CHANNEL_SECRET)
+    metrics = get_metrics()
+    # 定期実行のウォームアップはシークレットも読まずに返し、計測にも含めない
+    if "warmup" in request:
+        metrics.discard()
+        return ok_json
 
-    @handler.add(MessageEvent, message=TextMessage)
-    def handler_message_text(event: Event) -> None:
-        text = event.message.text
-        reply_token = event.reply_token
-        message(text, reply_token, env)
+    with metrics.timer("Secrets"):
+        env = get_runtime().env
 
-    @handler.add(JoinEvent)
-    def handler_join(event: Event) -> None:
-        sender_id = event.source.sender_id
-        store_id(sender_id, env)
-
-    @handler.add(LeaveEvent)
-    def handler_leave(event: Event) -> None:
-        sender_id = event.source.sender_id
-        delete_id(sender_id, env)
+    # 受付時にキューへ積んだイベントを処理する
+    if "webhookEvents" in request:
+        # Webhookへの応答時間と分けて集計する
+        metrics.function = "WebhookWorker"
+        events = request["webhookEvents"]  # type: ignore[typeddict-item]
+        return ok_json if process_events(events, env) else error_json
 
     body = request["body"]
+    headers = request["headers"]
     signature = ""
-    if "x-line-signature" in request["headers"]:
-        signature = request["headers"]["x-line-signature"]
-    elif "X-Line-Signature" in request["headers"]:
-        signature = request["headers"]["X-Line-Signature"]
+    if "x-line-signature" in headers:
+        signature = headers["x-line-signature"]
+    elif "X-Line-Signature" in headers:
+        signature = headers["X-Line-Signature"]
+
+    with metrics.timer("Verify"):
+        verified = verify_signature(env.LINE_CHANNEL_SECRET, body, signature)
+    if not verified:
+        logger.error("Detected invalid signature")
+        metrics.count("InvalidSignatures")
+        return error_json
+
+    capture_request(headers, body, env)
+
+    # 雑談など何もしないイベントは、キューに積まず処理済みの記録 (S3への読み書き) も省く
+    events = [event for event in json.loads(body)["events"] if is_actionable(event)]
+    if not events:
+        return ok_json
+
+    if is_async_mode():
+        # 外部APIの応答を待たずに返し、LINEのタイムアウトと再送を防ぐ
+        # ローカルのキューのスレッドでも、Lambdaで非同期に呼んだ時と同じく計測する
+        queue = get_event_queue(
+            context.invoked_function_arn,
+            instrument("WebhookWorker")(
+                lambda events: process_events(events, get_runtime().env)
+            ),
+        )
+        with metrics.timer("Enqueue"):
+            queue.put(events)
+        metrics.count("EventsQueued", len(events))
+        return ok_json
+
+    return ok_json if process_events(events, env) else error_json
+
 
+def capture_request(headers: Mapping[str, object], body: str, env: Env) -> None:
+    capture_store = get_capture_store(env)
+    if capture_store is None:
+        return
+    # 再生用の記録に失敗してもWebhookの処理は続ける
     try:
-        handler.handle(body, signature)
-    except LineBotApiError as e:
+        capture_store.put(redact_request(headers, body, is_command))
+    except Exception:
+        logger.exception("Failed to capture webhook request")
+
+
+def process_events(events: List[Dict[str, Any]], env: Env) -> bool:
+    metrics = get_metrics()
+    deduplicator = get_deduplicator(env)
+    with metrics.timer("Dedup"):
+        events = claim_events(events, deduplicator)
+    metrics.count("Events", len(events))
+    try:
+        changes = collect_membership_changes(events)
+        if changes:
+            with metrics.timer("SubscriberWrite"):
+                apply_membership_changes(changes, env)
+        with metrics.timer("Dispatch"):
+            for event in events:
+                dispatch(event, env)
+    except Exception as e:
+        metrics.count("Failures")
+        # 再送された時にやり直せるよう、処理済みの記録を取り消す
+        deduplicator.release(
+            event["webhookEventId"] for event in events if "webhookEventId" in event
+        )
+        # LINE APIを呼んだ時にしか起きないので、その時だけ読み込む
+        from linebot.exceptions import LineBotApiError
+
+        if not isinstance(e, LineBotApiError):
+            raise
         logger.error("Got exception from LINE Messaging API: %s\n" % e.message)
         for m in e.error.details:
             logger.error("  %s: %s" % (m.property, m.message))
-        return error_json
-    except InvalidSignatureError:
-        logger.error("Detected invalid signature")
-        return error_json
+        return False
 
-    return ok_json
+    return True
 
 
-def message(text: str, reply_token: str, env: Env) -> None:
-    if text == "今週の聖堂":
-        auth = OAuth2BearerHandler(env.TWITTER_BEARER_TOKEN)
-        twitter_api = API(auth)
+def claim_events(
+    events: List[Dict[str, Any]], deduplicator: EventDeduplicator
+) -> List[Dict[str, Any]]:
+    claimed = []
+    for event in events:
+        event_id = event.get("webhookEventId")
+        # 再送されたイベントは処理せずに受け付ける
+        if event_id is not None and not deduplicator.claim(event_id):
+            logger.info("処理済みのイベントを無視: " + event_id)
+            get_metrics().count("DuplicateEvents")
+            continue
+        claimed.append(event)
+    return claimed
 
-        status_list = twitter_api.user_timeline(
-            screen_name="DeadbyBHVR_JP",
-            count=50,
-            tweet_mode="extended",
-            exclude_replies=True,
-            include_rts=False,
-        )
-        output_list = list(
-            filter(lambda x: "シュライン・オブ・シークレット" in x.full_text, status_list)
-        )
 
-        if not output_list:
+def verify_signature(channel_secret: str, body: str, signature: str) -> bool:
+    digest = hmac.new(
+        channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256
+    ).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode("utf-8"))
+
+
+def is_command(text: str) -> bool:
+    text_list = text.split()
+    return text == SHRINE_COMMAND or (
+        len(text_list) > 0 and text_list[0] in (CHATGPT_COMMAND, TOPIC_COMMAND)
+    )
+
+
+def handle_text_message(event: Dict[str, Any], env: Env) -> None:
+    # グループの雑談の大半はコマンドではないので、モデルに変換する前に捨てる
+    if not is_command(event["message"]["text"]):
+        return
+
+    from linebot.models import MessageEvent
+
+    message_event = MessageEvent.new_from_json_dict(event)
+    # 返信トークンが切れていたら送信元にpushする
+    push_to = message_event.source.sender_id if message_event.source else None
+    message(message_event.message.text, message_event.reply_token, env, push_to)
+
+
+def collect_membership_changes(events: List[Dict[str, Any]]) -> Dict[str, bool]:
+    membership_events = [e for e in events if e["type"] in MEMBERSHIP_EVENTS]
+    if not membership_events:
+        return {}
+
+    from linebot.models import JoinEvent, LeaveEvent
+
+    models = {"join": JoinEvent, "leave": LeaveEvent}
+    # 送信元ごとに最後の参加(True)/退室(False)だけを残す
+    changes: Dict[str, bool] = {}
+    for event in membership_events:
+        sender_id = models[event["type"]].new_from_json_dict(event).source.sender_id
+        changes[sender_id] = MEMBERSHIP_EVENTS[event["type"]]
+    return changes
+
+
+# (イベントの種類, メッセージの種類) -> 処理
+EVENT_HANDLERS: Dict[Tuple[str, Optional[str]], EventHandler] = {
+    ("message", "text"): handle_text_message,
+}
+# 参加/退室は1つのリクエスト内でまとめて反映する
+MEMBERSHIP_EVENTS = {"join": True, "leave": False}
+
+
+def is_actionable(event: Dict[str, Any]) -> bool:
+    if event["type"] in MEMBERSHIP_EVENTS:
+        return True
+    message_type = event["message"].get("type") if event["type"] == "message" else None
+    if (event["type"], message_type) not in EVENT_HANDLERS:
+        return False
+    return message_type != "text" or is_command(event["message"]["text"])
+
+
+def dispatch(event: Dict[str, Any], env: Env) -> None:
+    message_type = event["message"].get("type") if event["type"] == "message" else None
+    handler = EVENT_HANDLERS.get((event["type"], message_type))
+    # 対応していないイベントはモデルに変換せずに無視する
+    if handler is not None:
+        handler(event, env)
+
+
+def message(
+    text: str, reply_token: str, env: Env, push_to: Optional[str] = None
+) -> None:
+    if text == SHRINE_COMMAND:
+        from .timeline_cache import get_timeline_cache
+
+        # バッチが保存したシュラインがあればTwitterに問い合わせずに返す
+        timeline_cache = get_timeline_cache(env)
+        with get_metrics().timer("Shrine"):
+            shrine = timeline_cache.shrine()
+            if shrine is None:
+                shrine = fetch_shrine(env)
+        if shrine is None:
             return
 
-        reply_line(output_list[0].full_text, reply_token, env)
+        reply_line(shrine, reply_token, env, push_to)
 
-    if (text_list := text.split())[0] == "/chatgpt":
+    if (text_list := text.split())[0] == CHATGPT_COMMAND:
         if len(text_list) == 1:
             return
 
-        openai.api_key = env.OPENAI_API_KEY
+        from .chat_cache import get_chat_cache
+        from .conversation import format_messages, get_conversation_memory
+
+        prompt = " ".join(text_list[1:])
+        # 送信元ごとの直近のやり取りを付けて、続けての質問にも答えられるようにする
+        memory = get_conversation_memory(env)
+        history = memory.history(push_to) if push_to is not None else []
+        messages = history + [{"role": "user", "content": prompt}]
+
+        chat_cache = get_chat_cache(env)
+        # 同じ質問が続いた時はOpenAIを呼ばずに前回の応答を返す。
+        # 応答は履歴に依るので履歴ごとキーにし、履歴が無い時だけ質問だけのキーになる
+        with get_metrics().timer("ChatGPT"):
+            reply = chat_cache.get_or_create(
+                CHATGPT_MODEL,
+                format_messages(messages),
+                lambda: create_chat_completion(messages, env),
+            )
+        logger.info("ChatGPTの応答キャッシュ: %s" % chat_cache.stats_dict())
+        if push_to is not None:
+            memory.append(push_to, prompt, reply)
+        reply_line(reply, reply_token, env, push_to)
+
+    if text_list[0] == TOPIC_COMMAND:
+        # 購読するトピックは送信元ごとに持つ
+        if push_to is None:
+            return
+        with get_metrics().timer("Topic"):
+            reply = update_topics(push_to, text_list[1:], env)
+        reply_line(reply, reply_token, env, push_to)
+
+
+def update_topics(sender_id: str, names: List[str], env: Env) -> str:
+    from .topics import get_subscription_store, get_topic_config
+
+    available = [topic.name for topic in get_topic_config(env).topics()]
+    if not available:
+        return "選べるトピックがありません"
+    usage = (
+        f"選べるトピック: {', '.join(available)}\n"
+        f"「{TOPIC_COMMAND} {available[0]}」のように選び、"
+        f"「{TOPIC_COMMAND} {ALL_TOPICS}」で全てに戻せます"
+    )
+    store = get_subscription_store(env)
+    if not names:
+        current = store.get(sender_id)
+        chosen = "すべて" if current is None else ", ".join(current)
+        return f"配信するトピック: {chosen}\n{usage}"
+    if names == [ALL_TOPICS]:
+        store.set(sender_id, None)
+        logger.info("トピックの購読を解除: " + sender_id)
+        return "全てのツイートを配信します"
+
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        return f"知らないトピック: {', '.join(unknown)}\n{usage}"
+    chosen_names = list(dict.fromkeys(names))
+    store.set(sender_id, chosen_names)
+    logger.info("トピックを購読: %s %s" % (sender_id, chosen_names))
+    return f"配信するトピック: {', '.join(chosen_names)}"
+
+
+def create_chat_completion(messages: List[Dict[str, str]], env: Env) -> str:
+    import openai
+
+    openai.api_key = env.OPENAI_API_KEY
 
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "user", "content": " ".join(text_list[1:])},
-            ],
-        )  # type: ignore
+    response = openai.ChatCompletion.create(
+        model=CHATGPT_MODEL,
+        messages=messages,
+    )  # type: ignore
 
-        reply_line(response["choices"][0]["message"]["content"], reply_token, env)
+    content: str = response["choices"][0]["message"]["content"]
+    return content
 
 
-def reply_line(reply: str, reply_token: str, env: Env) -> None:
+def fetch_shrine(env: Env) -> Optional[str]:
+    from tweepy import API, OAuth2BearerHandler
+
+    from .timeline_cache import SHRINE_KEYWORD, SHRINE_SCREEN_NAME, get_timeline_cache
+
+    twitter_api = get_runtime().client(
+        ("twitter", env.TWITTER_BEARER_TOKEN),
+        lambda: API(OAuth2BearerHandler(env.TWITTER_BEARER_TOKEN)),
+    )
+
+    status_list = twitter_api.user_timeline(
+        screen_name=SHRINE_SCREEN_NAME,
+        count=50,
+        tweet_mode="extended",
+        exclude_replies=True,
+        include_rts=False,
+    )
+    output_list = list(filter(lambda x: SHRINE_KEYWORD in x.full_text, status_list))
+
+    if not output_list:
+        return None
+
+    get_timeline_cache(env).put_shrine(output_list[0])
+    full_text: str = output_list[0].full_text
+    return full_text
+
+
+def reply_line(
+    reply: str, reply_token: str, env: Env, push_to: Optional[str] = None
+) -> None:
+    from linebot import LineBotApi
+    from linebot.exceptions import LineBotApiError
+    from linebot.models import TextSendMessage
+
+    from .http_client import PooledHttpClient
+
     messages = []
     messages.append(TextSendMessage(text=reply))
 
-    line_bot_api = LineBotApi(env.LINE_CHANNEL_ACCESS_TOKEN)
-    line_bot_api.reply_message(reply_token, messages=messages)
+    line_bot_api = get_runtime().client(
+        ("line", env.LINE_CHANNEL_ACCESS_TOKEN),
+        lambda: LineBotApi(env.LINE_CHANNEL_ACCESS_TOKEN, http_client=PooledHttpClient),
+    )
+    metrics = get_metrics()
+    try:
+        with metrics.timer("Reply"):
+            line_bot_api.reply_message(reply_token, messages=messages)
+    except LineBotApiError as e:
+        expired = e.status_code == 400 and e.error.message == INVALID_REPLY_TOKEN
+        if push_to is None or not expired:
+            raise
+        logger.info("返信トークンが切れたためpushで送信")
+        with metrics.timer("Reply"):
+            line_bot_api.push_message(push_to, messages=messages)
+        metrics.count("ReplyFallbacks")
+
 
+def apply_membership_changes(changes: Dict[str, bool], env: Env) -> None:
+    from .subscriber_store import get_subscriber_store
 
-def store_id(sender_id: str, env: Env) -> None:
-    logger.info("参加先id: " + sender_id)
+    added = [sender_id for sender_id, joined in changes.items() if joined]
+    removed = [sender_id for sender_id, joined in changes.items() if not joined]
+    for sender_id in added:
+        logger.info("参加先id: " + sender_id)
+    for sender_id in removed:
+        logger.info("退室先id: " + sender_id)
+    get_subscriber_store(env).apply(added, removed)
 
-    s3 = boto3.resource("s3")
-    obj = s3.Object(env.S3_BUCKET_NAME, env.S3_KEY_NAME)
-    ids = json.loads(obj.get()["Body"].read())
 
-    if sender_id in ids:
-        logger.info("id重複のため書き込まない")
-    else:
-        ids.append(sender_id)
-        response = obj.put(Body=json.dumps(ids))
-        logger.info(response)
+def store_id(sender_id: str, env: Env) -> None:
+    apply_membership_changes({sender_id: True}, env)
 
 
 def delete_id(sender_id: str, env: Env) -> None:
-    logger.info("退室先id: " + sender_id)
-
-    s3 = boto3.resource("s3")
-    obj = s3.Object(env.S3_BUCKET_NAME, env.S3_KEY_NAME)
-    ids = json.loads(obj.get()["Body"].read())
-
-    if sender_id in ids:
-        new_ids = list(filter(lambda x: not x == sender_id, ids))
-        response = obj.put(Body=json.dumps(new_ids))
-        logger.info(response)
-    else:
-        logger.info("idが無いため削除しない")
+    apply_membership_changes({sender_id: False}, env)
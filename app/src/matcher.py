@@ -0,0 +1,35 @@
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Sequence, Set, Tuple
+
+
+class KeywordMatcher:
+    def __init__(self, keywords: Sequence[str]) -> None:
+        self.keywords = tuple(dict.fromkeys(k for k in keywords if k))
+        # 同じ位置から始まるキーワードは最長のものを優先させる
+        alternation = "|".join(
+            re.escape(k) for k in sorted(self.keywords, key=len, reverse=True)
+        )
+        self._pattern = re.compile(alternation) if self.keywords else None
+        self._lookahead = re.compile(f"(?=({alternation}))") if self.keywords else None
+        # 最長一致したキーワードの接頭辞になっているキーワードも同じ位置で一致している
+        self._prefixes: Dict[str, FrozenSet[str]] = {
+            k: frozenset(p for p in self.keywords if k.startswith(p))
+            for k in self.keywords
+        }
+
+    def search(self, text: str) -> bool:
+        return self._pattern is not None and self._pattern.search(text) is not None
+
+    def matches(self, text: str) -> Set[str]:
+        matched: Set[str] = set()
+        if self._lookahead is None:
+            return matched
+        for m in self._lookahead.finditer(text):
+            matched |= self._prefixes[m.group(1)]
+        return matched
+
+
+@lru_cache(maxsize=128)
+def get_matcher(keywords: Tuple[str, ...]) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
@@ -0,0 +1,118 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional, TypeVar, cast
+
+# CloudWatch Embedded Metric Format (EMF) の名前空間
+NAMESPACE = "DbdInfoBot"
+MILLISECONDS = "Milliseconds"
+COUNT = "Count"
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+# 1回の実行の段階ごとの所要時間と件数を集め、最後にEMFの1行として出力する
+class Metrics:
+    def __init__(
+        self,
+        function: str,
+        namespace: str = NAMESPACE,
+        clock: Callable[[], float] = time.perf_counter,
+        now: Callable[[], float] = time.time,
+        emit: Callable[[str], None] = print,
+    ) -> None:
+        self.function = function
+        self.namespace = namespace
+        self.clock = clock
+        self.now = now
+        self.emit = emit
+        self.values: Dict[str, float] = {}
+        self.units: Dict[str, str] = {}
+        self.discarded = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        # 同じ段階を何度も通る時は合計する
+        started_at = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = (self.clock() - started_at) * 1000
+            self.add(f"{stage}Duration", elapsed, MILLISECONDS)
+
+    def count(self, name: str, value: float = 1) -> None:
+        self.add(name, value, COUNT)
+
+    def add(self, name: str, value: float, unit: str) -> None:
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def discard(self) -> None:
+        # ウォームアップなど、集計に含めたくない実行
+        self.discarded = True
+
+    def to_emf(self) -> Dict[str, Any]:
+        with self._lock:
+            names = sorted(self.values)
+            return {
+                "_aws": {
+                    "Timestamp": int(self.now() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": self.namespace,
+                            "Dimensions": [["Function"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": self.units[name]}
+                                for name in names
+                            ],
+                        }
+                    ],
+                },
+                "Function": self.function,
+                **{name: self.values[name] for name in names},
+            }
+
+    def flush(self) -> None:
+        if self.values and not self.discarded:
+            # loggerの接頭辞が付くとEMFとして解釈されないため、そのまま標準出力に書く
+            self.emit(json.dumps(self.to_emf(), separators=(",", ":")))
+        with self._lock:
+            self.values.clear()
+            self.units.clear()
+
+
+# 実行ごとの計測。Webhookのスレッドプールやキューのスレッドで同時に動く実行が
+# 互いの計測を上書きしないよう、コンテキストごとに持つ
+_metrics: ContextVar[Optional[Metrics]] = ContextVar("metrics", default=None)
+
+
+def get_metrics() -> Metrics:
+    metrics = _metrics.get()
+    if metrics is None:
+        metrics = Metrics("Unknown")
+        _metrics.set(metrics)
+    return metrics
+
+
+def instrument(function: str) -> Callable[[F], F]:
+    # ハンドラーの実行ごとに計測を始め、終わったら出力する
+    def decorator(handler: F) -> F:
+        @functools.wraps(handler)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            metrics = Metrics(function)
+            token = _metrics.set(metrics)
+            try:
+                with metrics.timer("Invocation"):
+                    return handler(*args, **kwargs)
+            finally:
+                metrics.flush()
+                _metrics.reset(token)
+
+        return cast(F, wrapper)
+
+    return decorator
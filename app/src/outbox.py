@@ -0,0 +1,126 @@
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .delivery import Delivery, MessagePayload
+from .env import Env
+from .storage import BlobStore, get_blob_store
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+
+@dataclass
+class OutboxEntry:
+    to: List[str]
+    payload: int  # Outbox.payloadsの添字
+    multicast: bool
+    retry_key: str
+    state: str = PENDING
+    error: Optional[int] = None  # 失敗した時のステータスコード
+
+
+@dataclass
+class Outbox:
+    entries: List[OutboxEntry] = field(default_factory=list)
+    # 宛先ごとに同じメッセージを持たないよう、メッセージは1回だけ保存する
+    payloads: List[MessagePayload] = field(default_factory=list)
+
+    @classmethod
+    def from_deliveries(cls, deliveries: List[Delivery]) -> "Outbox":
+        outbox = cls()
+        indexes: Dict[int, int] = {}
+        for delivery in deliveries:
+            key = id(delivery.payload)
+            if key not in indexes:
+                indexes[key] = len(outbox.payloads)
+                outbox.payloads.append(delivery.payload)
+            outbox.entries.append(
+                OutboxEntry(
+                    to=delivery.to,
+                    payload=indexes[key],
+                    multicast=delivery.multicast,
+                    retry_key=delivery.retry_key,
+                )
+            )
+        return outbox
+
+    def pending(self) -> List[OutboxEntry]:
+        return [entry for entry in self.entries if entry.state == PENDING]
+
+    def to_delivery(self, entry: OutboxEntry) -> Delivery:
+        return Delivery(
+            to=entry.to,
+            payload=self.payloads[entry.payload],
+            multicast=entry.multicast,
+            retry_key=entry.retry_key,
+        )
+
+    def dumps(self) -> str:
+        # 配信の途中で何度も保存するため、asdictによる深いコピーを避ける
+        body = {
+            "payloads": [payload.messages for payload in self.payloads],
+            "entries": [vars(entry) for entry in self.entries],
+        }
+        return json.dumps(body, ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, body: str) -> "Outbox":
+        data = json.loads(body)
+        return cls(
+            [OutboxEntry(**entry) for entry in data["entries"]],
+            [MessagePayload(messages) for messages in data["payloads"]],
+        )
+
+
+class OutboxStore:
+    def load(self) -> Optional[Outbox]:
+        raise NotImplementedError
+
+    def save(self, outbox: Outbox) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class BlobOutboxStore(OutboxStore):
+    def __init__(self, blobs: BlobStore, key: str) -> None:
+        self.blobs = blobs
+        self.key = key
+
+    def load(self) -> Optional[Outbox]:
+        body = self.blobs.get(self.key)
+        if body is None:
+            return None
+        return Outbox.loads(body.decode("utf-8"))
+
+    def save(self, outbox: Outbox) -> None:
+        self.blobs.put(self.key, outbox.dumps().encode("utf-8"))
+
+    def clear(self) -> None:
+        self.blobs.delete(self.key)
+
+
+class MemoryOutboxStore(OutboxStore):
+    # 途中経過を呼び出し元が引き取る場合に使う
+    def __init__(self) -> None:
+        self.outbox: Optional[Outbox] = None
+
+    def load(self) -> Optional[Outbox]:
+        return self.outbox
+
+    def save(self, outbox: Outbox) -> None:
+        self.outbox = outbox
+
+    def clear(self) -> None:
+        self.outbox = None
+
+
+def get_outbox_store(env: Env, shard: Optional[str] = None) -> OutboxStore:
+    # 分割した配信はワーカーごとに別のジャーナルを持つ
+    suffix = "" if shard is None else f".{shard}"
+    # 購読者リストと同じ場所に保存する
+    key = f"{env.S3_KEY_NAME}.outbox{suffix}.json"
+    return BlobOutboxStore(get_blob_store(env), key)
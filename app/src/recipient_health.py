@@ -0,0 +1,151 @@
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Counter, Dict, Iterable, List, Optional, Set, Tuple
+
+from .env import Env
+from .outbox import FAILED, SENT, OutboxEntry
+from .storage import get_blob_store
+
+# 宛先が無効で、何度送っても成功しないエラー
+PERMANENT_ERRORS = (400, 403, 404)
+# 連続してこの回数の実行で失敗したら配信を止める
+QUARANTINE_THRESHOLD = 3
+# 配信を止めてから最後にもう一度送るまでの期間
+QUARANTINE_PERIOD = 3 * 24 * 60 * 60  # sec
+# 削除した宛先の記録を保持する件数
+PRUNED_MAX_SIZE = 500
+# 同じメッセージを個別に送った宛先のうち、この割合を超えて同じエラーで失敗したら
+# 宛先ではなくメッセージの問題とみなす
+PAYLOAD_FAULT_RATIO = 0.5
+
+
+@dataclass
+class RecipientHealth:
+    failures: int = 0  # 恒久的なエラーで失敗が続いた実行の回数
+    last_error: Optional[int] = None  # 最後に失敗した時のステータスコード
+    last_failed_at: Optional[float] = None
+    quarantined_at: Optional[float] = None
+
+
+@dataclass
+class PrunedRecipient:
+    sender_id: str
+    failures: int
+    last_error: Optional[int]
+    quarantined_at: Optional[float]
+    pruned_at: float
+
+
+@dataclass
+class HealthState:
+    # 失敗したことのある宛先だけを持つ
+    recipients: Dict[str, RecipientHealth] = field(default_factory=dict)
+    # 購読者リストから削除した宛先 (古い順)
+    pruned: List[PrunedRecipient] = field(default_factory=list)
+
+    def retain(self, sender_ids: Iterable[str]) -> bool:
+        # 退室などで購読者でなくなった宛先は忘れる
+        members = set(sender_ids)
+        departed = [s for s in self.recipients if s not in members]
+        for sender_id in departed:
+            del self.recipients[sender_id]
+        return bool(departed)
+
+    def should_deliver(self, sender_id: str, now: float) -> bool:
+        health = self.recipients.get(sender_id)
+        if health is None or health.quarantined_at is None:
+            return True
+        return now - health.quarantined_at >= QUARANTINE_PERIOD
+
+    def record(
+        self, sender_id: str, error: Optional[int], now: float
+    ) -> Optional[PrunedRecipient]:
+        # 削除すべき宛先なら記録を返す
+        if error is None:
+            self.recipients.pop(sender_id, None)
+            return None
+        if error not in PERMANENT_ERRORS:
+            # 一時的なエラーは数えない
+            if sender_id in self.recipients:
+                self.recipients[sender_id].last_error = error
+            return None
+
+        health = self.recipients.setdefault(sender_id, RecipientHealth())
+        health.failures += 1
+        health.last_error = error
+        health.last_failed_at = now
+        if health.quarantined_at is None:
+            if health.failures >= QUARANTINE_THRESHOLD:
+                health.quarantined_at = now
+            return None
+        if now - health.quarantined_at < QUARANTINE_PERIOD:
+            return None
+
+        # 配信を止めた後に送り直しても失敗した
+        del self.recipients[sender_id]
+        pruned = PrunedRecipient(
+            sender_id, health.failures, error, health.quarantined_at, now
+        )
+        self.pruned.append(pruned)
+        del self.pruned[:-PRUNED_MAX_SIZE]
+        return pruned
+
+
+def payload_faults(entries: Iterable[OutboxEntry]) -> Set[Tuple[int, int]]:
+    # (メッセージ, ステータスコード) のうち、メッセージが原因とみられる組を返す
+    pushes: Counter[int] = Counter()
+    errors: Counter[Tuple[int, int]] = Counter()
+    for entry in entries:
+        if entry.multicast or entry.state not in (SENT, FAILED):
+            continue
+        pushes[entry.payload] += 1
+        if entry.state == FAILED and entry.error is not None:
+            errors[(entry.payload, entry.error)] += 1
+    # 宛先が1つだけなら、どちらが原因か分からないので宛先の失敗として数える
+    return {
+        key
+        for key, count in errors.items()
+        if pushes[key[0]] > 1 and count > pushes[key[0]] * PAYLOAD_FAULT_RATIO
+    }
+
+
+def recipient_outcomes(entries: List[OutboxEntry]) -> Dict[str, Optional[int]]:
+    # 宛先ごとに1回の実行で1件の結果にまとめる (1件でも成功すれば成功)。
+    # multicastの失敗はどの宛先が原因か分からないので、個別に送った宛先だけを見る
+    faults = payload_faults(entries)
+    outcomes: Dict[str, Optional[int]] = {}
+    for entry in entries:
+        if entry.multicast or entry.state not in (SENT, FAILED):
+            continue
+        sender_id = entry.to[0]
+        if entry.state == SENT:
+            outcomes[sender_id] = None
+        elif entry.error is not None and (entry.payload, entry.error) not in faults:
+            # 既に成功していれば上書きしない
+            if sender_id not in outcomes or outcomes[sender_id] is not None:
+                outcomes[sender_id] = entry.error
+    return outcomes
+
+
+def health_key(key: str) -> str:
+    # 購読者リストと同じ場所に保存する
+    return f"{key}.health.json"
+
+
+def load_health(env: Env) -> HealthState:
+    body = get_blob_store(env).get(health_key(env.S3_KEY_NAME))
+    if body is None:
+        return HealthState()
+    state = json.loads(body)
+    return HealthState(
+        recipients={
+            sender_id: RecipientHealth(**health)
+            for sender_id, health in state["recipients"].items()
+        },
+        pruned=[PrunedRecipient(**pruned) for pruned in state["pruned"]],
+    )
+
+
+def save_health(env: Env, state: HealthState) -> None:
+    body = json.dumps(asdict(state)).encode()
+    get_blob_store(env).put(health_key(env.S3_KEY_NAME), body)
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, TypeVar
+
+from .env import Env, get_env
+
+T = TypeVar("T")
+
+
+class Runtime:
+    # コンテナが再利用される間、シークレットとSDKのクライアントを保持する
+    def __init__(
+        self,
+        secrets_ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.secrets_ttl = secrets_ttl
+        self.clock = clock
+        self._env: Optional[Env] = None
+        self._loaded_at = 0.0
+        self._clients: Dict[Hashable, Any] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def env(self) -> Env:
+        with self._lock:
+            if self._env is None or self._is_expired():
+                self._env = get_env()
+                self._loaded_at = self.clock()
+            return self._env
+
+    def _is_expired(self) -> bool:
+        if self.secrets_ttl is None:
+            return False
+        return self.clock() - self._loaded_at >= self.secrets_ttl
+
+    def client(self, key: Hashable, factory: Callable[[], T]) -> T:
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            client: T = self._clients[key]
+            return client
+
+    def get(self, key: Hashable) -> Any:
+        # 作られていなければ作らずにNoneを返す
+        with self._lock:
+            return self._clients.get(key)
+
+    @property
+    def s3(self) -> Any:
+        # コールドスタートを軽くするため使う時に読み込む
+        import boto3
+
+        return self.client("s3", lambda: boto3.resource("s3"))
+
+
+_runtime: Optional[Runtime] = None
+
+
+def get_runtime() -> Runtime:
+    global _runtime
+    if _runtime is None:
+        ttl = os.getenv("SECRETS_TTL", None)
+        _runtime = Runtime(secrets_ttl=float(ttl) if ttl else None)
+    return _runtime
+
+
+def reset_runtime() -> None:
+    global _runtime
+    _runtime = None
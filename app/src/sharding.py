@@ -0,0 +1,242 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import boto3
+
+from .env import Env
+from .outbox import FAILED, PENDING, SENT, Outbox, get_outbox_store
+from .runtime import reset_runtime
+from .storage import BlobStore, get_blob_store
+
+SHARD_SIZE = 1000  # 1つのワーカーが受け持つ配信の数
+MAX_SHARDS = 50
+POLL_INTERVAL = 2.0  # sec
+ABANDONED = b"abandoned"  # コーディネーターが待つのをやめたシャードの印
+
+logger = logging.getLogger()
+
+
+@dataclass
+class ShardResult:
+    shard: str
+    states: List[str]  # 受け持った配信ごとの状態
+    errors: List[Optional[int]] = field(default_factory=list)  # ステータスコード
+
+    @property
+    def sent(self) -> int:
+        return self.states.count(SENT)
+
+    @property
+    def failed(self) -> int:
+        return self.states.count(FAILED)
+
+    @property
+    def pending(self) -> int:
+        return self.states.count(PENDING)
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"shard": self.shard, "states": self.states, "errors": self.errors}
+        )
+
+    @classmethod
+    def from_outbox(cls, shard: str, outbox: Outbox) -> "ShardResult":
+        return cls(
+            shard,
+            [entry.state for entry in outbox.entries],
+            [entry.error for entry in outbox.entries],
+        )
+
+    @classmethod
+    def loads(cls, body: str) -> "ShardResult":
+        return cls(**json.loads(body))
+
+    def apply(self, outbox: Outbox) -> None:
+        # コーディネーターが持つ同じ配信に結果を書き戻す
+        for i, entry in enumerate(outbox.entries):
+            entry.state = self.states[i]
+            entry.error = self.errors[i] if self.errors else None
+
+
+# (シャード名, ジャーナル, 残り時間[ms], レート制限の取り分) を受け取って配信する
+ShardWorker = Callable[[str, Outbox, int, float], ShardResult]
+
+
+def shard_size() -> int:
+    return int(os.getenv("BATCH_SHARD_SIZE", SHARD_SIZE))
+
+
+def partition(outbox: Outbox, size: int) -> List[Outbox]:
+    # 未配信分を連続した範囲に分ける。メッセージは全シャードで共有する
+    entries = outbox.pending()
+    count = min(-(-len(entries) // size), MAX_SHARDS)
+    if count <= 1:
+        return [Outbox(entries, outbox.payloads)]
+    bounds = [len(entries) * i // count for i in range(count + 1)]
+    return [
+        Outbox(entries[start:end], outbox.payloads)
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+class ShardDispatcher:
+    # ワーカーが自分のジャーナルを保存するなら、起動した時点で配信を引き渡せる
+    durable = False
+
+    def start(self, shards: Dict[str, Outbox], remaining_ms: int) -> None:
+        raise NotImplementedError
+
+    def wait(
+        self, shards: Dict[str, Outbox], remaining_ms: Callable[[], int]
+    ) -> Dict[str, ShardResult]:
+        raise NotImplementedError
+
+
+class LocalShardDispatcher(ShardDispatcher):
+    # ローカルではプロセスプールで並列に配信する
+    def __init__(
+        self,
+        worker: ShardWorker,
+        executor_factory: Optional[Callable[[int], Executor]] = None,
+    ) -> None:
+        self.worker = worker
+        self.executor_factory = executor_factory or default_executor
+        self.futures: Dict[str, "Future[ShardResult]"] = {}
+
+    def start(self, shards: Dict[str, Outbox], remaining_ms: int) -> None:
+        max_workers = min(len(shards), os.cpu_count() or 1)
+        self.pool = self.executor_factory(max_workers)
+        # 同時に動くワーカーでレート制限を分け合う
+        rate_share = 1 / max_workers
+        self.futures = {
+            name: self.pool.submit(self.worker, name, outbox, remaining_ms, rate_share)
+            for name, outbox in shards.items()
+        }
+
+    def wait(
+        self, shards: Dict[str, Outbox], remaining_ms: Callable[[], int]
+    ) -> Dict[str, ShardResult]:
+        results: Dict[str, ShardResult] = {}
+        for name, future in self.futures.items():
+            try:
+                results[name] = future.result(timeout=max(remaining_ms() / 1000, 0))
+            except FutureTimeoutError:
+                break
+            except Exception:
+                logger.exception("Shard %s failed" % name)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        return results
+
+
+def default_executor(max_workers: int) -> Executor:
+    # 親プロセスのHTTPセッションを子プロセスで使い回さないようにする
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=reset_runtime)
+
+
+class ShardResultStore:
+    # 各ワーカーの結果を1シャード1オブジェクトで保存する
+    def __init__(self, blobs: BlobStore, prefix: str) -> None:
+        self.blobs = blobs
+        self.prefix = prefix
+
+    def put(self, result: ShardResult) -> bool:
+        # コーディネーターが既に待つのをやめていれば、印を消してFalseを返す
+        key = self._key(result.shard)
+        if self.blobs.create(key, result.dumps().encode("utf-8")):
+            return True
+        self.blobs.delete(key)
+        return False
+
+    def abandon(self, shard: str) -> bool:
+        # 結果がまだ無ければ印を残してTrueを返す。後から終わったワーカーは印を見て、
+        # 宛先の結果を自分で記録する
+        return self.blobs.create(self._key(shard), ABANDONED)
+
+    def load(self, shard: str) -> Optional[ShardResult]:
+        body = self.blobs.get(self._key(shard))
+        if body is None:
+            return None
+        return ShardResult.loads(body.decode("utf-8"))
+
+    def delete(self, shard: str) -> None:
+        self.blobs.delete(self._key(shard))
+
+    def _key(self, shard: str) -> str:
+        return f"{self.prefix}{shard}.json"
+
+
+def get_shard_result_store(env: Env) -> ShardResultStore:
+    return ShardResultStore(get_blob_store(env), f"{env.S3_KEY_NAME}.shards/")
+
+
+class LambdaShardDispatcher(ShardDispatcher):
+    # 本番では同じ関数を非同期に呼び出し、結果をS3から集める
+    durable = True
+
+    def __init__(
+        self,
+        env: Env,
+        function_arn: str,
+        margin_ms: int,
+        poll_interval: float = POLL_INTERVAL,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.env = env
+        self.function_arn = function_arn
+        self.margin_ms = margin_ms
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        self.results = get_shard_result_store(env)
+
+    def start(self, shards: Dict[str, Outbox], remaining_ms: int) -> None:
+        for name, outbox in shards.items():
+            get_outbox_store(self.env, name).save(outbox)
+        client = boto3.client("lambda")
+        for name in shards:
+            client.invoke(
+                FunctionName=self.function_arn,
+                InvocationType="Event",
+                Payload=json.dumps({"shard": name, "shards": len(shards)}).encode(
+                    "utf-8"
+                ),
+            )
+
+    def wait(
+        self, shards: Dict[str, Outbox], remaining_ms: Callable[[], int]
+    ) -> Dict[str, ShardResult]:
+        results: Dict[str, ShardResult] = {}
+        while True:
+            for name in shards:
+                if name in results:
+                    continue
+                result = self.results.load(name)
+                if result is not None:
+                    results[name] = result
+                    self.results.delete(name)
+            if len(results) == len(shards) or remaining_ms() < self.margin_ms:
+                break
+            self.sleep(self.poll_interval)
+
+        for name in shards:
+            if name in results or self.results.abandon(name):
+                continue
+            # 待つのをやめる直前に届いた
+            result = self.results.load(name)
+            if result is not None:
+                results[name] = result
+                self.results.delete(name)
+        return results
+
+
+def get_shard_dispatcher(
+    env: Env, function_arn: str, worker: ShardWorker, margin_ms: int
+) -> ShardDispatcher:
+    if os.getenv("ENV_NAME", None) == "prod":
+        return LambdaShardDispatcher(env, function_arn, margin_ms)
+    return LocalShardDispatcher(worker)
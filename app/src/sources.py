@@ -0,0 +1,27 @@
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+DEFAULT_SOURCES_PATH = Path(__file__).parent / "sources.json"
+
+
+@dataclass(frozen=True)
+class Source:
+    screen_name: str
+    keywords: Tuple[str, ...]
+    count: int = 20
+    include_rts: bool = False
+    exclude_replies: bool = False
+    timeout: float = 10.0  # sec
+
+
+def load_sources(path: Optional[str] = None) -> List[Source]:
+    if path is None:
+        path = os.getenv("SOURCES_PATH", str(DEFAULT_SOURCES_PATH))
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return [
+        Source(**{**source, "keywords": tuple(source["keywords"])}) for source in config
+    ]
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+from .env import STORAGE_LOCAL, STORAGE_SQLITE, Env
+from .runtime import get_runtime
+
+
+class BlobStore:
+    # 1つのJSONを丸ごと読み書きする状態の保存先。無ければNoneを返す。
+    # S3を使わない時は、全ての保存先がこれを通してEnvで選んだ場所に読み書きする
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, key: str, body: bytes) -> None:
+        raise NotImplementedError
+
+    def create(self, key: str, body: bytes) -> bool:
+        # 無い時だけ書き込み、書き込めたらTrueを返す
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket: str) -> None:
+        self.s3 = get_runtime().s3
+        self.bucket = bucket
+
+    def get(self, key: str) -> Optional[bytes]:
+        from botocore.exceptions import ClientError
+
+        try:
+            body: bytes = self.s3.Object(self.bucket, key).get()["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return None
+        return body
+
+    def put(self, key: str, body: bytes) -> None:
+        self.s3.Object(self.bucket, key).put(Body=body)
+
+    def create(self, key: str, body: bytes) -> bool:
+        # S3の条件付き書き込みが使えないため、存在確認してから書き込む
+        if self.get(key) is not None:
+            return False
+        self.put(key, body)
+        return True
+
+    def delete(self, key: str) -> None:
+        self.s3.Object(self.bucket, key).delete()
+
+
+class FileBlobStore(BlobStore):
+    # S3のキーをそのままディレクトリの下のパスにする
+    def __init__(self, root: str) -> None:
+        self.root = Path(root)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return (self.root / key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, body: bytes) -> None:
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 読み込み中に書きかけのファイルが見えないよう置き換える
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(body)
+        tmp.replace(path)
+
+    def create(self, key: str, body: bytes) -> bool:
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # 同時に作っても1つだけが成功する
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        return True
+
+    def delete(self, key: str) -> None:
+        (self.root / key).unlink(missing_ok=True)
+
+
+class SqliteBlobStore(BlobStore):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, body BLOB)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT body FROM blobs WHERE key = ?", (key,))
+            row = rows.fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put(self, key: str, body: bytes) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (key, body) VALUES (?, ?)", (key, body)
+            )
+
+    def create(self, key: str, body: bytes) -> bool:
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO blobs (key, body) VALUES (?, ?)", (key, body)
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key: str) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM blobs WHERE key = ?", (key,))
+
+
+def sqlite_path(env: Env) -> str:
+    # SQLiteを使う保存先は全て1つのデータベースにまとめる
+    os.makedirs(env.STORAGE_DIR, exist_ok=True)
+    return os.path.join(env.STORAGE_DIR, "storage.db")
+
+
+def get_blob_store(env: Env) -> BlobStore:
+    def create() -> BlobStore:
+        if env.STORAGE == STORAGE_LOCAL:
+            return FileBlobStore(env.STORAGE_DIR)
+        if env.STORAGE == STORAGE_SQLITE:
+            return SqliteBlobStore(sqlite_path(env))
+        return S3BlobStore(env.S3_BUCKET_NAME)
+
+    return get_runtime().client(
+        ("blob_store", env.STORAGE, env.STORAGE_DIR, env.S3_BUCKET_NAME), create
+    )
@@ -0,0 +1,200 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from .env import STORAGE_LOCAL, STORAGE_SQLITE, Env
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store, sqlite_path
+
+# 畳み込み済みの追記ログを削除せずに残しておく期間
+LOG_RETENTION = timedelta(hours=1)
+# 追記ログの書き込みが完了しているとみなすまでの時間
+LOG_SETTLE_NS = 60 * 10**9
+COMPACT_MAX_RETRIES = 3
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+class SubscriberStore:
+    def members(self) -> List[str]:
+        raise NotImplementedError
+
+    def apply(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        raise NotImplementedError
+
+    def add(self, sender_id: str) -> None:
+        self.apply([sender_id], [])
+
+    def remove(self, sender_id: str) -> None:
+        self.apply([], [sender_id])
+
+    def compact(self) -> None:
+        pass
+
+
+def fold(ids: Dict[str, None], added: Iterable[str], removed: Iterable[str]) -> None:
+    for sender_id in added:
+        ids.setdefault(sender_id, None)
+    for sender_id in removed:
+        ids.pop(sender_id, None)
+
+
+# スナップショット (従来のidリストのJSON) と追記ログで購読者を管理する。
+# 参加/退室はログを1件書くだけなのでリストの大きさに依らず一定のコストで済み、
+# 同時に書き込まれても更新が失われない。
+class S3SubscriberStore(SubscriberStore):
+    WATERMARK = "log-watermark"
+
+    def __init__(self, bucket: str, key: str) -> None:
+        self.s3 = get_runtime().s3
+        self.bucket = bucket
+        self.key = key
+        self.log_prefix = f"{key}.log/"
+
+    def members(self) -> List[str]:
+        ids, _, watermark = self._read_snapshot()
+        for _, body in self._read_logs(watermark):
+            fold(ids, body["add"], body["remove"])
+        return list(ids)
+
+    def apply(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        body = {"add": list(added), "remove": list(removed)}
+        log_key = f"{self.log_prefix}{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+        self.s3.Object(self.bucket, log_key).put(Body=json.dumps(body))
+
+    def compact(self) -> None:
+        # 書き込み途中のログを飛ばさないよう、十分に古いログだけをスナップショットに畳み込む
+        settled = f"{self.log_prefix}{time.time_ns() - LOG_SETTLE_NS:020d}"
+        for _ in range(COMPACT_MAX_RETRIES):
+            ids, etag, watermark = self._read_snapshot()
+            logs = [log for log in self._read_logs(watermark) if log[0] < settled]
+            if not logs:
+                return
+            for _, body in logs:
+                fold(ids, body["add"], body["remove"])
+            try:
+                self._write_snapshot(ids, etag, logs[-1][0])
+            except ConcurrentUpdateError:
+                continue
+            self._expire_logs(logs[-1][0])
+            return
+        raise ConcurrentUpdateError(f"Failed to compact s3://{self.bucket}/{self.key}")
+
+    def _read_snapshot(self) -> Tuple[Dict[str, None], Optional[str], str]:
+        obj = self.s3.Object(self.bucket, self.key)
+        try:
+            response = obj.get()
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return {}, None, ""
+        ids = dict.fromkeys(json.loads(response["Body"].read()))
+        watermark = response.get("Metadata", {}).get(self.WATERMARK, "")
+        return ids, response["ETag"], watermark
+
+    def _read_logs(self, watermark: str) -> List[Tuple[str, Dict[str, List[str]]]]:
+        return [
+            (log["Key"], self._get_json(log["Key"]))
+            for log in self._list_logs(start_after=watermark)
+        ]
+
+    def _get_json(self, key: str) -> Any:
+        return json.loads(self.s3.Object(self.bucket, key).get()["Body"].read())
+
+    def _list_logs(self, start_after: str = "") -> List[Dict[str, Any]]:
+        paginator = self.s3.meta.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=self.log_prefix,
+            StartAfter=start_after or self.log_prefix,
+        )
+        return [log for page in pages for log in page.get("Contents", [])]
+
+    def _write_snapshot(
+        self, ids: Dict[str, None], etag: Optional[str], watermark: str
+    ) -> None:
+        obj = self.s3.Object(self.bucket, self.key)
+        # 読み込んでから他の実行がスナップショットを書き換えていないか確認する
+        try:
+            current: Optional[str] = obj.e_tag
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            current = None
+        if current != etag:
+            raise ConcurrentUpdateError(f"s3://{self.bucket}/{self.key} was updated")
+        obj.put(Body=json.dumps(list(ids)), Metadata={self.WATERMARK: watermark})
+
+    def _expire_logs(self, watermark: str) -> None:
+        expires_at = datetime.now(timezone.utc) - LOG_RETENTION
+        for log in self._list_logs():
+            if log["Key"] <= watermark and log["LastModified"] < expires_at:
+                self.s3.Object(self.bucket, log["Key"]).delete()
+
+
+class SqliteSubscriberStore(SubscriberStore):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS subscribers (sender_id TEXT PRIMARY KEY)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def members(self) -> List[str]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT sender_id FROM subscribers ORDER BY rowid")
+            return [row[0] for row in rows]
+
+    def apply(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO subscribers (sender_id) VALUES (?)",
+                [(sender_id,) for sender_id in added],
+            )
+            conn.executemany(
+                "DELETE FROM subscribers WHERE sender_id = ?",
+                [(sender_id,) for sender_id in removed],
+            )
+
+
+class BlobSubscriberStore(SubscriberStore):
+    # S3のスナップショットと同じidリストのJSONを、読み込んでから書き換える
+    _lock = threading.Lock()
+
+    def __init__(self, blobs: BlobStore, key: str) -> None:
+        self.blobs = blobs
+        self.key = key
+
+    def members(self) -> List[str]:
+        return list(self._read())
+
+    def apply(self, added: Iterable[str], removed: Iterable[str]) -> None:
+        # 同じプロセスのワーカーが同時に書き換えても更新が失われないようにする
+        with self._lock:
+            ids = self._read()
+            fold(ids, added, removed)
+            self.blobs.put(self.key, json.dumps(list(ids)).encode("utf-8"))
+
+    def _read(self) -> Dict[str, None]:
+        body = self.blobs.get(self.key)
+        return {} if body is None else dict.fromkeys(json.loads(body))
+
+
+def get_subscriber_store(env: Env) -> SubscriberStore:
+    if env.STORAGE == STORAGE_SQLITE:
+        return SqliteSubscriberStore(sqlite_path(env))
+    if env.STORAGE == STORAGE_LOCAL:
+        return BlobSubscriberStore(get_blob_store(env), env.S3_KEY_NAME)
+    return S3SubscriberStore(env.S3_BUCKET_NAME, env.S3_KEY_NAME)
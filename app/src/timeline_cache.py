@@ -0,0 +1,178 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from .cache import TTLCache
+from .env import Env
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store
+
+if TYPE_CHECKING:
+    # 返信時のキャッシュヒットではtweepyを読み込まずに済ませる
+    from tweepy.models import Status
+
+SHRINE_SCREEN_NAME = "DeadbyBHVR_JP"
+SHRINE_KEYWORD = "シュライン・オブ・シークレット"
+# シュライン・オブ・シークレットは毎週火曜 0:00 (UTC) に入れ替わる
+SHRINE_RESET_WEEKDAY = 1
+TIMELINE_MAX_SIZE = 50
+LOCAL_MAXSIZE = 32
+LOCAL_TTL = 300.0  # sec
+
+Snapshot = Dict[str, Any]
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def next_shrine_reset(after: datetime) -> datetime:
+    midnight = after.astimezone(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    days = (SHRINE_RESET_WEEKDAY - midnight.weekday()) % 7 or 7
+    return midnight + timedelta(days=days)
+
+
+def status_to_dict(status: "Status") -> Dict[str, Any]:
+    return {
+        "id": status.id,
+        "full_text": status.full_text,
+        "created_at": status.created_at.isoformat(),
+    }
+
+
+def make_shrine(status: Dict[str, Any]) -> Dict[str, Any]:
+    created_at = datetime.fromisoformat(status["created_at"])
+    return {
+        "id": status["id"],
+        "full_text": status["full_text"],
+        "expires_at": next_shrine_reset(created_at).isoformat(),
+    }
+
+
+def find_shrine(timeline: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # タイムラインは新しい順に並んでいる
+    for status in timeline:
+        if SHRINE_KEYWORD in status["full_text"]:
+            return make_shrine(status)
+    return None
+
+
+class SnapshotStore:
+    def load(self) -> Optional[Snapshot]:
+        raise NotImplementedError
+
+    def save(self, snapshot: Snapshot) -> None:
+        raise NotImplementedError
+
+
+class BlobSnapshotStore(SnapshotStore):
+    def __init__(self, blobs: BlobStore, key: str) -> None:
+        self.blobs = blobs
+        self.key = key
+
+    def load(self) -> Optional[Snapshot]:
+        body = self.blobs.get(self.key)
+        if body is None:
+            return None
+        snapshot: Snapshot = json.loads(body)
+        return snapshot
+
+    def save(self, snapshot: Snapshot) -> None:
+        body = json.dumps(snapshot, ensure_ascii=False).encode("utf-8")
+        self.blobs.put(self.key, body)
+
+
+# バッチが取得したタイムラインを保存し、Webhookはそれを読んで返信する。
+# プロセス内のLRUを先に引き、外れた時だけ保存先を読みに行く。
+class TimelineCache:
+    def __init__(
+        self,
+        store: SnapshotStore,
+        clock: Callable[[], float] = time.monotonic,
+        now: Callable[[], datetime] = utcnow,
+    ) -> None:
+        self.store = store
+        self.now = now
+        self.local: TTLCache[Any] = TTLCache(LOCAL_MAXSIZE, LOCAL_TTL, clock)
+
+    def shrine(self) -> Optional[str]:
+        shrine = self.local.get("shrine")
+        if shrine is None:
+            shrine = self._load().get("shrine")
+            if shrine is None or not self._cache_shrine(shrine):
+                return None
+        full_text: str = shrine["full_text"]
+        return full_text
+
+    def timeline(self, screen_name: str) -> List[Dict[str, Any]]:
+        timeline = self.local.get(("timeline", screen_name))
+        if timeline is None:
+            timeline = self._load()["timelines"].get(screen_name, [])
+            self.local.set(("timeline", screen_name), timeline)
+        result: List[Dict[str, Any]] = timeline
+        return result
+
+    def update(self, timelines: Dict[str, List["Status"]]) -> None:
+        snapshot = self._load()
+        for screen_name, statuses in timelines.items():
+            if not statuses:
+                continue
+            merged = {s["id"]: s for s in snapshot["timelines"].get(screen_name, [])}
+            merged.update({status.id: status_to_dict(status) for status in statuses})
+            snapshot["timelines"][screen_name] = sorted(
+                merged.values(), key=lambda s: s["id"], reverse=True
+            )[:TIMELINE_MAX_SIZE]
+            self.local.delete(("timeline", screen_name))
+
+        shrine = find_shrine(snapshot["timelines"].get(SHRINE_SCREEN_NAME, []))
+        if shrine is not None:
+            self._set_shrine(snapshot, shrine)
+        self.store.save(snapshot)
+
+    def put_shrine(self, status: "Status") -> None:
+        snapshot = self._load()
+        self._set_shrine(snapshot, make_shrine(status_to_dict(status)))
+        self.store.save(snapshot)
+
+    def _load(self) -> Snapshot:
+        return self.store.load() or {"timelines": {}, "shrine": None}
+
+    def _set_shrine(self, snapshot: Snapshot, shrine: Dict[str, Any]) -> None:
+        current = snapshot.get("shrine")
+        # 古いツイートで新しいシュラインを上書きしない
+        if current is not None and current["id"] > shrine["id"]:
+            return
+        snapshot["shrine"] = shrine
+        self._cache_shrine(shrine)
+
+    def _cache_shrine(self, shrine: Dict[str, Any]) -> bool:
+        # 次の入れ替わりまでしか保持しない
+        ttl = (
+            datetime.fromisoformat(shrine["expires_at"]) - self.now()
+        ).total_seconds()
+        if ttl <= 0:
+            self.local.delete("shrine")
+            return False
+        self.local.set("shrine", shrine, ttl)
+        return True
+
+
+def get_timeline_cache(env: Env) -> TimelineCache:
+    def create() -> TimelineCache:
+        key = f"{env.S3_KEY_NAME}.timeline.json"
+        return TimelineCache(BlobSnapshotStore(get_blob_store(env), key))
+
+    # 温まったコンテナの間はプロセス内のキャッシュを使い回す
+    return get_runtime().client(
+        (
+            "timeline_cache",
+            env.STORAGE,
+            env.STORAGE_DIR,
+            env.S3_BUCKET_NAME,
+            env.S3_KEY_NAME,
+        ),
+        create,
+    )
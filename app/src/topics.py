@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from .env import STORAGE_S3, Env
+from .matcher import KeywordMatcher
+from .runtime import get_runtime
+from .storage import BlobStore, get_blob_store
+from .subscriber_store import ConcurrentUpdateError
+
+DEFAULT_TOPICS_PATH = Path(__file__).parent / "topics.json"
+UPDATE_MAX_RETRIES = 3
+
+logger = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class Topic:
+    name: str
+    keywords: Tuple[str, ...]
+    # 配信できるメッセージの残りが少ない時もこのトピックのツイートは送る
+    high_priority: bool = False
+
+
+def parse_topics(config: Any) -> List[Topic]:
+    topics = [
+        Topic(
+            topic["name"],
+            tuple(topic["keywords"]),
+            bool(topic.get("high_priority", False)),
+        )
+        for topic in config
+    ]
+    names = [topic.name for topic in topics]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate topic names: {names}")
+    if any(not topic.name or not topic.keywords for topic in topics):
+        raise ValueError("Topics need a name and at least one keyword")
+    return topics
+
+
+def load_topics(path: Path) -> List[Topic]:
+    with open(path, encoding="utf-8") as f:
+        return parse_topics(json.load(f))
+
+
+class TopicConfig:
+    def topics(self) -> List[Topic]:
+        raise NotImplementedError
+
+
+class S3TopicConfig(TopicConfig):
+    # 温まったコンテナの間は保持し、ETagで変更を確かめて変わった時だけ読み直す
+    def __init__(self, bucket: str, key: str) -> None:
+        self.obj = get_runtime().s3.Object(bucket, key)
+        self.etag: Optional[str] = None
+        self._topics: Optional[List[Topic]] = None
+
+    def topics(self) -> List[Topic]:
+        try:
+            if self.etag is None:
+                response = self.obj.get()
+            else:
+                response = self.obj.get(IfNoneMatch=self.etag)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("304", "NotModified") and self._topics is not None:
+                return self._topics
+            if code != "NoSuchKey":
+                raise
+            # 設定を置いていなければ同梱の設定を使う
+            self.etag = None
+            self._topics = load_topics(DEFAULT_TOPICS_PATH)
+            return self._topics
+        try:
+            topics = parse_topics(json.loads(response["Body"].read()))
+        except (ValueError, KeyError, TypeError):
+            # 壊れた設定を置かれても、直前の設定で配信を続ける
+            logger.exception("Invalid topic config: %s" % self.obj.key)
+            if self._topics is None:
+                self._topics = load_topics(DEFAULT_TOPICS_PATH)
+            return self._topics
+        self.etag = response["ETag"]
+        self._topics = topics
+        logger.info("トピックの設定を読み込み: %s" % [t.name for t in topics])
+        return topics
+
+
+class FileTopicConfig(TopicConfig):
+    # ファイルの更新時刻と大きさをETagの代わりにする
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.etag: Optional[Tuple[int, int]] = None
+        self._topics: List[Topic] = []
+
+    def topics(self) -> List[Topic]:
+        stat = self.path.stat()
+        etag = (stat.st_mtime_ns, stat.st_size)
+        if etag != self.etag:
+            self._topics = load_topics(self.path)
+            self.etag = etag
+        return self._topics
+
+
+def get_topic_config(env: Env) -> TopicConfig:
+    path = os.getenv("TOPICS_PATH", None)
+
+    def create() -> TopicConfig:
+        if path is not None:
+            return FileTopicConfig(path)
+        # 本番では再デプロイせずにS3の設定を差し替えられる
+        if os.getenv("ENV_NAME", None) == "prod":
+            key = f"{env.S3_KEY_NAME}.topics.json"
+            return S3TopicConfig(env.S3_BUCKET_NAME, key)
+        return FileTopicConfig(str(DEFAULT_TOPICS_PATH))
+
+    return get_runtime().client(
+        ("topic_config", env.S3_BUCKET_NAME, env.S3_KEY_NAME, path), create
+    )
+
+
+# 送信元 -> 購読するトピック。選んでいない送信元は含めず、全てのツイートを配信する
+Subscriptions = Dict[str, List[str]]
+
+
+class SubscriptionStore:
+    def load(self) -> Subscriptions:
+        raise NotImplementedError
+
+    def set(self, sender_id: str, topics: Optional[List[str]]) -> None:
+        raise NotImplementedError
+
+    def get(self, sender_id: str) -> Optional[List[str]]:
+        return self.load().get(sender_id)
+
+
+class S3SubscriptionStore(SubscriptionStore):
+    # コマンドで時々書き換えるだけなので、1つのJSONにまとめてバッチの読み込みを1回にする
+    def __init__(self, bucket: str, key: str) -> None:
+        self.obj = get_runtime().s3.Object(bucket, key)
+
+    def load(self) -> Subscriptions:
+        return self._read()[0]
+
+    def set(self, sender_id: str, topics: Optional[List[str]]) -> None:
+        for _ in range(UPDATE_MAX_RETRIES):
+            subscriptions, etag = self._read()
+            if topics is None:
+                subscriptions.pop(sender_id, None)
+            else:
+                subscriptions[sender_id] = topics
+            try:
+                self._write(subscriptions, etag)
+            except ConcurrentUpdateError:
+                continue
+            return
+        raise ConcurrentUpdateError(f"Failed to update {self.obj.key}")
+
+    def _read(self) -> Tuple[Subscriptions, Optional[str]]:
+        try:
+            response = self.obj.get()
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return {}, None
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def _write(self, subscriptions: Subscriptions, etag: Optional[str]) -> None:
+        # 読み込んでから他の実行が書き換えていないか確認する
+        try:
+            self.obj.reload()
+            current: Optional[str] = self.obj.e_tag
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            current = None
+        if current != etag:
+            raise ConcurrentUpdateError(f"{self.obj.key} was updated")
+        body = json.dumps(subscriptions, ensure_ascii=False).encode("utf-8")
+        self.obj.put(Body=body)
+
+
+class BlobSubscriptionStore(SubscriptionStore):
+    def __init__(self, blobs: BlobStore, key: str) -> None:
+        self.blobs = blobs
+        self.key = key
+
+    def load(self) -> Subscriptions:
+        body = self.blobs.get(self.key)
+        if body is None:
+            return {}
+        subscriptions: Subscriptions = json.loads(body)
+        return subscriptions
+
+    def set(self, sender_id: str, topics: Optional[List[str]]) -> None:
+        subscriptions = self.load()
+        if topics is None:
+            subscriptions.pop(sender_id, None)
+        else:
+            subscriptions[sender_id] = topics
+        body = json.dumps(subscriptions, ensure_ascii=False).encode("utf-8")
+        self.blobs.put(self.key, body)
+
+
+def get_subscription_store(env: Env) -> SubscriptionStore:
+    key = f"{env.S3_KEY_NAME}.subscriptions.json"
+    if env.STORAGE != STORAGE_S3:
+        return BlobSubscriptionStore(get_blob_store(env), key)
+    return S3SubscriptionStore(env.S3_BUCKET_NAME, key)
+
+
+class TopicIndex:
+    # トピック -> 購読する送信元の転置インデックス。
+    # ツイートごとに一致したトピックの送信元にだけ配信する
+    def __init__(
+        self, topics: List[Topic], sender_ids: List[str], subscriptions: Subscriptions
+    ) -> None:
+        self.matcher = KeywordMatcher([k for topic in topics for k in topic.keywords])
+        self.keyword_topics: Dict[str, List[str]] = {}
+        for topic in topics:
+            for keyword in topic.keywords:
+                self.keyword_topics.setdefault(keyword, []).append(topic.name)
+        self.recipients: Dict[str, List[str]] = {topic.name: [] for topic in topics}
+        self.high_priority = {topic.name for topic in topics if topic.high_priority}
+        # トピックを選んでいない (または選んだトピックが無くなった) 送信元
+        self.everyone: List[str] = []
+        for sender_id in sender_ids:
+            chosen = [
+                name
+                for name in subscriptions.get(sender_id, [])
+                if name in self.recipients
+            ]
+            if not chosen:
+                self.everyone.append(sender_id)
+            for name in chosen:
+                self.recipients[name].append(sender_id)
+
+    def topics_of(self, text: str) -> List[str]:
+        names: Dict[str, None] = {}
+        for keyword in self.matcher.matches(text):
+            names.update(dict.fromkeys(self.keyword_topics[keyword]))
+        return sorted(names)
+
+    def is_high_priority(self, text: str) -> bool:
+        return any(name in self.high_priority for name in self.topics_of(text))
+
+    def audiences(self, texts: List[str]) -> List[Tuple[List[int], List[str]]]:
+        # 受け取るツイートの組み合わせが同じ送信元をまとめ、
+        # (ツイートの添字, 送信元) の組ごとに1回の配信にする
+        wanted: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            audience: Dict[str, None] = {}
+            for name in self.topics_of(text):
+                audience.update(dict.fromkeys(self.recipients[name]))
+            for sender_id in audience:
+                wanted.setdefault(sender_id, []).append(i)
+
+        groups: Dict[Tuple[int, ...], List[str]] = {}
+        if texts and self.everyone:
+            groups[tuple(range(len(texts)))] = list(self.everyone)
+        for sender_id, indexes in wanted.items():
+            groups.setdefault(tuple(indexes), []).append(sender_id)
+        return [(list(indexes), sender_ids) for indexes, sender_ids in groups.items()]
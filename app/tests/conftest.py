@@ -0,0 +1,12 @@
+from typing import Iterator
+
+import pytest
+from app.src.runtime import reset_runtime
+
+
+@pytest.fixture(autouse=True)
+def clear_runtime() -> Iterator[None]:
+    # 温まったコンテナの状態をテスト間で持ち越さない
+    reset_runtime()
+    yield
+    reset_runtime()
@@ -1,20 +1,27 @@
-from app.src.lambda_types import EventBridgeEvent, LambdaContext
+from dataclasses import dataclass, field
 
+from app.src.lambda_types import EventBridgeEvent
 
-def make_context() -> LambdaContext:
-    return LambdaContext(
-        {
-            "function_name": "",
-            "function_version": "",
-            "invoked_function_arn": "",
-            "memory_limit_in_mb": "",
-            "aws_request_id": "",
-            "log_group_name": "",
-            "log_stream_name": "",
-            "identity": {},
-            "client_context": {},
-        }
-    )
+
+@dataclass
+class DummyLambdaContext:
+    function_name: str = ""
+    function_version: str = ""
+    invoked_function_arn: str = ""
+    memory_limit_in_mb: str = ""
+    aws_request_id: str = ""
+    log_group_name: str = ""
+    log_stream_name: str = ""
+    identity: object = field(default_factory=dict)
+    client_context: object = field(default_factory=dict)
+    remaining_time_in_millis: int = 300000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_time_in_millis
+
+
+def make_context(remaining_time_in_millis: int = 300000) -> DummyLambdaContext:
+    return DummyLambdaContext(remaining_time_in_millis=remaining_time_in_millis)
 
 
 def make_event_bridge_event() -> EventBridgeEvent:
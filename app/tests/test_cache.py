@@ -0,0 +1,36 @@
+from app.src.cache import TTLCache
+
+
+def test_get_and_set() -> None:
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+
+    assert cache.get("a") is None
+    cache.set("a", "1")
+    assert cache.get("a") == "1"
+
+
+def test_expired_after_ttl() -> None:
+    now = [0.0]
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60, clock=lambda: now[0])
+    cache.set("a", "1")
+    # 個別のTTLは全体のTTLより長くならない
+    cache.set("b", "2", ttl=600)
+    cache.set("c", "3", ttl=10)
+
+    now[0] = 10
+    assert cache.get("c") is None
+    now[0] = 60
+    assert cache.get("b") is None
+
+
+def test_evicts_least_recently_used() -> None:
+    cache: TTLCache[str] = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+
+    cache.set("c", "3")
+
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert len(cache) == 2
@@ -0,0 +1,139 @@
+import json
+import os
+from pathlib import Path
+
+import boto3
+import pytest
+from app.src.capture import (
+    FileCaptureStore,
+    S3CaptureStore,
+    get_capture_store,
+    pseudonymize,
+    redact_request,
+)
+from app.src.env import get_env
+from app.src.lambda_webhook_handler import is_command
+from moto import mock_s3
+
+BODY = json.dumps(
+    {
+        "destination": "U" + "0" * 32,
+        "events": [
+            {
+                "type": "message",
+                "replyToken": "secret-token",
+                "source": {"type": "group", "groupId": "C1", "userId": "U1"},
+                "message": {"type": "text", "text": "こんにちは"},
+            },
+            {
+                "type": "message",
+                "replyToken": "secret-token",
+                "source": {"type": "user", "userId": "U1"},
+                "message": {"type": "text", "text": "/chatgpt おすすめは？"},
+            },
+        ],
+    }
+)
+
+
+def test_redact_request() -> None:
+    headers = {"X-Line-Signature": "sig", "Content-Type": "application/json"}
+    capture = redact_request(headers, BODY, is_command, received_at=1.0)
+
+    assert capture["received_at"] == 1.0
+    # 署名は再生時に付け直す
+    assert capture["headers"] == {"content-type": "application/json"}
+    body = json.loads(capture["body"])
+    assert body["destination"] == pseudonymize("U" + "0" * 32)
+    first, second = body["events"]
+    assert first["replyToken"] == "redacted"
+    assert first["source"] == {
+        "type": "group",
+        "groupId": pseudonymize("C1"),
+        "userId": pseudonymize("U1"),
+    }
+    # コマンド以外の発言は長さだけを残す
+    assert first["message"]["text"] == "*****"
+    assert second["message"]["text"] == "/chatgpt おすすめは？"
+    # 同じ送信元は同じidになる
+    assert second["source"]["userId"] == first["source"]["userId"]
+
+
+def test_redact_request_nested_ids() -> None:
+    body = json.dumps(
+        {
+            "events": [
+                {
+                    "type": "memberJoined",
+                    "source": {"type": "group", "groupId": "C1"},
+                    "joined": {"members": [{"type": "user", "userId": "U2"}]},
+                },
+                {
+                    "type": "message",
+                    "source": {"type": "group", "groupId": "C1", "userId": "U1"},
+                    "message": {
+                        "type": "text",
+                        "text": "@太郎 こんにちは",
+                        "mention": {
+                            "mentionees": [
+                                {"index": 0, "length": 3, "userId": "U2"},
+                                {"index": 0, "length": 3, "type": "all"},
+                            ]
+                        },
+                    },
+                },
+            ]
+        }
+    )
+
+    capture = redact_request({}, body, is_command, received_at=1.0)
+
+    assert "U2" not in capture["body"]
+    joined, mentioned = json.loads(capture["body"])["events"]
+    assert joined["joined"]["members"][0]["userId"] == pseudonymize("U2")
+    mentionees = mentioned["message"]["mention"]["mentionees"]
+    assert mentionees[0]["userId"] == pseudonymize("U2")
+    assert mentionees[1] == {"index": 0, "length": 3, "type": "all"}
+
+
+def test_pseudonymize() -> None:
+    pseudonym = pseudonymize("U" + "a" * 32)
+    assert pseudonym.startswith("U")
+    assert len(pseudonym) == 33
+    assert pseudonym != "U" + "a" * 32
+
+
+def test_file_capture_store(tmp_path: Path) -> None:
+    path = tmp_path / "corpus.jsonl"
+    store = FileCaptureStore(str(path))
+    store.put({"received_at": 1.0, "headers": {}, "body": "{}"})
+    store.put({"received_at": 2.0, "headers": {}, "body": "{}"})
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["received_at"] for line in lines] == [1.0, 2.0]
+
+
+@mock_s3
+def test_s3_capture_store() -> None:
+    s3 = boto3.resource("s3")
+    s3.Bucket("test").create()
+    store = S3CaptureStore("test", "test.captures/")
+    store.put({"received_at": 2.0, "headers": {}, "body": "{}"})
+    store.put({"received_at": 1.0, "headers": {}, "body": "{}"})
+
+    # キーが受信時刻順に並ぶ
+    keys = [o.key for o in s3.Bucket("test").objects.filter(Prefix="test.captures/")]
+    bodies = [json.loads(s3.Object("test", key).get()["Body"].read()) for key in keys]
+    assert [body["received_at"] for body in bodies] == [1.0, 2.0]
+
+
+def test_get_capture_store(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    env = get_env()
+    # 指定しなければ記録しない
+    monkeypatch.delenv("WEBHOOK_CAPTURE_PATH", raising=False)
+    monkeypatch.setenv("WEBHOOK_CAPTURE", "true")
+    assert os.getenv("ENV_NAME") != "prod"
+    assert get_capture_store(env) is None
+
+    monkeypatch.setenv("WEBHOOK_CAPTURE_PATH", str(tmp_path / "corpus.jsonl"))
+    assert isinstance(get_capture_store(env), FileCaptureStore)
@@ -0,0 +1,144 @@
+import threading
+from pathlib import Path
+from typing import List
+
+import boto3
+import pytest
+from app.src.chat_cache import (
+    BlobResponseStore,
+    ChatCache,
+    cache_key,
+    get_chat_cache,
+    normalize_prompt,
+)
+from app.src.env import Env
+from app.src.storage import FileBlobStore, S3BlobStore
+from moto import mock_s3
+
+
+def test_normalize_prompt() -> None:
+    assert normalize_prompt(" 今日の  シュライン　おすすめは？ ") == (
+        "今日の シュライン おすすめは?"
+    )
+    assert normalize_prompt("ＢＰ Farm") == normalize_prompt("bp farm")
+
+
+def test_cache_key_depends_on_model() -> None:
+    assert cache_key("gpt-3.5-turbo", "a") == cache_key("gpt-3.5-turbo", " A ")
+    assert cache_key("gpt-3.5-turbo", "a") != cache_key("gpt-4", "a")
+
+
+def test_get_or_create_hits() -> None:
+    cache = ChatCache()
+    calls: List[str] = []
+
+    def create() -> str:
+        calls.append("called")
+        return "answer"
+
+    assert cache.get_or_create("model", "question", create) == "answer"
+    assert cache.get_or_create("model", "Question ", create) == "answer"
+
+    assert len(calls) == 1
+    assert cache.stats_dict() == {
+        "hits": 1,
+        "persisted_hits": 0,
+        "misses": 1,
+        "coalesced": 0,
+    }
+
+
+def test_get_or_create_expires() -> None:
+    now = [0.0]
+    cache = ChatCache(ttl=60, clock=lambda: now[0])
+    cache.get_or_create("model", "question", lambda: "old")
+
+    now[0] = 60
+
+    assert cache.get_or_create("model", "question", lambda: "new") == "new"
+
+
+def test_get_or_create_coalesces() -> None:
+    cache = ChatCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls: List[str] = []
+
+    def create() -> str:
+        calls.append("called")
+        started.set()
+        release.wait(5)
+        return "answer"
+
+    results: List[str] = []
+    leader = threading.Thread(
+        target=lambda: results.append(cache.get_or_create("model", "q", create))
+    )
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.append(cache.get_or_create("model", "q", create))
+    )
+    follower.start()
+    while cache.stats.coalesced == 0:
+        pass
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == ["answer", "answer"]
+    assert len(calls) == 1
+
+
+def test_get_or_create_does_not_cache_errors() -> None:
+    cache = ChatCache()
+
+    def fail() -> str:
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_create("model", "question", fail)
+
+    assert cache.get_or_create("model", "question", lambda: "answer") == "answer"
+
+
+def test_persisted_tier(tmp_path: Path) -> None:
+    store = BlobResponseStore(FileBlobStore(str(tmp_path)), "test.chatgpt/")
+    ChatCache(store).get_or_create("model", "question", lambda: "answer")
+
+    # 別のコンテナから読む
+    cache = ChatCache(store)
+
+    assert cache.get_or_create("model", "question", lambda: "new") == "answer"
+    assert cache.stats.persisted_hits == 1
+
+
+def test_persisted_tier_expires(tmp_path: Path) -> None:
+    now = [0.0]
+    blobs = FileBlobStore(str(tmp_path))
+    store = BlobResponseStore(blobs, "test.chatgpt/", now=lambda: now[0])
+    ChatCache(store, ttl=60, now=lambda: now[0]).get_or_create(
+        "model", "question", lambda: "old"
+    )
+
+    now[0] = 60
+
+    assert store.get(cache_key("model", "question")) is None
+
+
+@mock_s3
+def test_s3_response_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = BlobResponseStore(S3BlobStore("test"), "test.chatgpt/", now=lambda: 0)
+
+    assert store.get("key") is None
+    store.put("key", "answer", expires_at=60)
+    assert store.get("key") == "answer"
+
+
+def test_get_chat_cache(tmp_path: Path) -> None:
+    assert get_chat_cache(Env()).store is None
+    assert get_chat_cache(Env()) is get_chat_cache(Env())
+
+    env = Env(STORAGE="sqlite", STORAGE_DIR=str(tmp_path))
+    assert isinstance(get_chat_cache(env).store, BlobResponseStore)
@@ -0,0 +1,103 @@
+from pathlib import Path
+
+import boto3
+from app.src.conversation import (
+    CONVERSATION_TTL,
+    BlobConversationStore,
+    Conversation,
+    ConversationMemory,
+    S3ConversationStore,
+    estimate_tokens,
+    format_messages,
+    get_conversation_memory,
+)
+from app.src.env import Env
+from app.src.storage import FileBlobStore
+from moto import mock_s3
+
+
+def test_estimate_tokens() -> None:
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("シュライン") == 5
+
+
+def test_conversation_messages() -> None:
+    conversation = Conversation()
+    conversation.append("おすすめは?", "バーベキュー&チリです")
+
+    assert conversation.messages() == [
+        {"role": "user", "content": "おすすめは?"},
+        {"role": "assistant", "content": "バーベキュー&チリです"},
+    ]
+
+
+def test_conversation_drops_old_turns_over_budget() -> None:
+    conversation = Conversation()
+    for i in range(10):
+        conversation.append(f"質問{i}", "あ" * 5, budget=24)
+
+    # 1往復で3+5トークン
+    assert [q for q, _ in conversation.turns] == ["質問7", "質問8", "質問9"]
+    assert conversation.tokens() <= 24
+
+
+def test_conversation_round_trip() -> None:
+    conversation = Conversation()
+    conversation.append("a", "b")
+    conversation.append("c", "d")
+
+    assert Conversation.loads(conversation.dumps()).turns == conversation.turns
+    assert conversation.dumps() == '[["u","a"],["a","b"],["u","c"],["a","d"]]'
+
+
+def test_memory_is_per_sender(tmp_path: Path) -> None:
+    store = BlobConversationStore(FileBlobStore(str(tmp_path)), "test.conversations/")
+    memory = ConversationMemory(store)
+    memory.append("Cabcde", "a", "b")
+
+    assert memory.history("Cfghij") == []
+    # 別のコンテナから読む
+    assert ConversationMemory(store).history("Cabcde") == [
+        {"role": "user", "content": "a"},
+        {"role": "assistant", "content": "b"},
+    ]
+
+
+def test_blob_store_forgets_idle_conversation(tmp_path: Path) -> None:
+    now = [0.0]
+    blobs = FileBlobStore(str(tmp_path))
+    store = BlobConversationStore(blobs, "test.conversations/", now=lambda: now[0])
+    conversation = Conversation()
+    conversation.append("a", "b")
+    store.save("Cabcde", conversation)
+    loaded = store.load("Cabcde")
+    assert loaded is not None and loaded.turns == conversation.turns
+
+    now[0] = CONVERSATION_TTL
+    assert store.load("Cabcde") is None
+
+
+@mock_s3
+def test_s3_conversation_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = S3ConversationStore("test", "test.conversations/")
+    conversation = Conversation()
+    conversation.append("a", "b")
+
+    assert store.load("Cabcde") is None
+    store.save("Cabcde", conversation)
+    loaded = store.load("Cabcde")
+    assert loaded is not None and loaded.turns == conversation.turns
+
+
+def test_format_messages() -> None:
+    assert format_messages([{"role": "user", "content": "a"}]) == "user: a"
+
+
+def test_get_conversation_memory(tmp_path: Path) -> None:
+    assert get_conversation_memory(Env()).store is None
+
+    env = Env(STORAGE="local", STORAGE_DIR=str(tmp_path))
+    assert isinstance(get_conversation_memory(env).store, BlobConversationStore)
@@ -0,0 +1,104 @@
+import time
+from pathlib import Path
+
+import boto3
+from app.src.dedup import (
+    DEDUP_TTL,
+    BlobSeenStore,
+    EventDeduplicator,
+    S3SeenStore,
+    get_deduplicator,
+    prune_seen_events,
+)
+from app.src.env import Env
+from app.src.storage import FileBlobStore, SqliteBlobStore
+from moto import mock_s3
+
+
+def test_claim_in_memory() -> None:
+    deduplicator = EventDeduplicator()
+
+    assert deduplicator.claim("01H")
+    assert not deduplicator.claim("01H")
+    assert deduplicator.claim("01J")
+
+
+def test_claim_expires() -> None:
+    now = [0.0]
+    deduplicator = EventDeduplicator(ttl=60, clock=lambda: now[0])
+    deduplicator.claim("01H")
+
+    now[0] = 60
+
+    assert deduplicator.claim("01H")
+
+
+def test_release() -> None:
+    deduplicator = EventDeduplicator()
+    deduplicator.claim("01H")
+
+    deduplicator.release(["01H"])
+
+    assert deduplicator.claim("01H")
+
+
+def test_persisted_tier(tmp_path: Path) -> None:
+    store = BlobSeenStore(FileBlobStore(str(tmp_path)), "test.events/")
+    EventDeduplicator(store).claim("01H")
+
+    # 別のコンテナに再送された
+    deduplicator = EventDeduplicator(store)
+
+    assert not deduplicator.claim("01H")
+    deduplicator.release(["01H"])
+    assert EventDeduplicator(store).claim("01H")
+
+
+def test_blob_seen_store_expires(tmp_path: Path) -> None:
+    now = [0.0]
+    blobs = SqliteBlobStore(str(tmp_path / "storage.db"))
+    store = BlobSeenStore(blobs, "test.events/", now=lambda: now[0])
+    assert store.claim("01H")
+    assert not store.claim("01H")
+
+    now[0] = DEDUP_TTL
+    assert store.claim("01H")
+
+
+@mock_s3
+def test_s3_seen_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = S3SeenStore("test", "test.events/")
+
+    assert store.claim("01H")
+    assert not store.claim("01H")
+    store.release("01H")
+    assert store.claim("01H")
+
+
+@mock_s3
+def test_s3_seen_store_prune() -> None:
+    bucket = boto3.resource("s3").Bucket("test")
+    bucket.create()
+    bucket.put_object(Key="test.subscribers.json", Body=b"[]")
+    now = [time.time()]
+    store = S3SeenStore("test", "test.events/", now=lambda: now[0])
+    store.claim("01H")
+    store.claim("01J")
+
+    assert store.prune() == 0
+    # 再送されないまま期限が過ぎた記録を消す
+    now[0] += DEDUP_TTL
+    assert store.prune() == 2
+    assert [obj.key for obj in bucket.objects.all()] == ["test.subscribers.json"]
+    assert store.claim("01H")
+
+
+def test_get_deduplicator(tmp_path: Path) -> None:
+    assert get_deduplicator(Env()).store is None
+    assert get_deduplicator(Env()) is get_deduplicator(Env())
+
+    env = Env(STORAGE="local", STORAGE_DIR=str(tmp_path))
+    assert isinstance(get_deduplicator(env).store, BlobSeenStore)
+    # 一覧できない保存先では消さない
+    assert prune_seen_events(env) == 0
@@ -0,0 +1,202 @@
+import json
+from typing import List
+
+import requests
+from app.src.delivery import (
+    MAX_MESSAGES_PER_REQUEST,
+    MULTICAST_MAX_RECIPIENTS,
+    MULTICAST_PATH,
+    NO_RESPONSE,
+    PUSH_PATH,
+    Delivery,
+    DeliveryExecutor,
+    MessagePayload,
+    TokenBucket,
+    chunked,
+    is_user_id,
+    plan_deliveries,
+)
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+from linebot.models.error import Error
+from pytest_mock import MockerFixture
+
+
+def test_is_user_id() -> None:
+    assert is_user_id("U1234")
+    assert not is_user_id("C1234")
+    assert not is_user_id("R1234")
+
+
+def test_chunked() -> None:
+    assert list(chunked([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunked([], 2)) == []
+
+
+def test_plan_deliveries_multicast_chunks() -> None:
+    messages = [TextSendMessage(text="dummy")]
+    user_ids = [f"U{i}" for i in range(MULTICAST_MAX_RECIPIENTS + 1)]
+
+    deliveries = plan_deliveries(messages, user_ids)
+
+    assert [len(d.to) for d in deliveries] == [MULTICAST_MAX_RECIPIENTS, 1]
+    assert all(d.multicast for d in deliveries)
+    # 宛先が変わってもメッセージは同じものを使い回す
+    assert deliveries[0].payload is deliveries[1].payload
+
+
+def test_plan_deliveries_push_for_groups() -> None:
+    messages = [
+        TextSendMessage(text=str(i)) for i in range(MAX_MESSAGES_PER_REQUEST + 1)
+    ]
+
+    deliveries = plan_deliveries(messages, ["Cabcde", "Rfghij"])
+
+    assert [(d.to, len(d.payload.messages), d.multicast) for d in deliveries] == [
+        (["Cabcde"], MAX_MESSAGES_PER_REQUEST, False),
+        (["Rfghij"], MAX_MESSAGES_PER_REQUEST, False),
+        (["Cabcde"], 1, False),
+        (["Rfghij"], 1, False),
+    ]
+
+
+def test_plan_deliveries_no_messages() -> None:
+    assert plan_deliveries([], ["U1", "Cabcde"]) == []
+
+
+def make_line_bot_api_error(status_code: int) -> LineBotApiError:
+    return LineBotApiError(status_code, {}, error=Error(message="error", details=[]))
+
+
+def make_payload() -> MessagePayload:
+    return MessagePayload.from_messages([TextSendMessage(text="dummy")])
+
+
+def test_message_payload_request_body() -> None:
+    messages = [TextSendMessage(text="引き換えコード"), TextSendMessage(text="dummy")]
+    payload = MessagePayload.from_messages(messages)
+
+    # SDKが組み立てるものと同じ内容になる
+    expected = [message.as_json_dict() for message in messages]
+    assert json.loads(payload.request_body("Cabcde")) == {
+        "to": "Cabcde",
+        "messages": expected,
+    }
+    assert json.loads(payload.request_body(["U1", "U2"])) == {
+        "to": ["U1", "U2"],
+        "messages": expected,
+    }
+
+
+def test_token_bucket_waits_when_empty() -> None:
+    now = [0.0]
+    waits: List[float] = []
+
+    def sleep(sec: float) -> None:
+        waits.append(sec)
+        now[0] += sec
+
+    bucket = TokenBucket(2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(3):
+        bucket.acquire()
+
+    assert waits == [0.5]
+
+
+def test_executor_retries_with_same_retry_key(mocker: MockerFixture) -> None:
+    client = mocker.Mock(**{"post.side_effect": [make_line_bot_api_error(500), None]})
+    sleep = mocker.Mock()
+    delivery = Delivery(["Cabcde"], make_payload(), multicast=False)
+
+    result = DeliveryExecutor(client, sleep=sleep).send(delivery)
+
+    assert result.ok
+    assert result.attempts == 2
+    assert sleep.call_count == 1
+    assert {c.args[0] for c in client.post.mock_calls} == {PUSH_PATH}
+    retry_keys = {c.kwargs["retry_key"] for c in client.post.mock_calls}
+    assert retry_keys == {delivery.retry_key}
+
+
+def test_executor_conflict_after_retry_is_success(mocker: MockerFixture) -> None:
+    client = mocker.Mock(
+        **{
+            "post.side_effect": [
+                make_line_bot_api_error(429),
+                make_line_bot_api_error(409),
+            ]
+        }
+    )
+    delivery = Delivery(["U1"], make_payload(), multicast=True)
+
+    result = DeliveryExecutor(client, sleep=mocker.Mock()).send(delivery)
+
+    assert result.ok
+    assert {c.args[0] for c in client.post.mock_calls} == {MULTICAST_PATH}
+
+
+def test_executor_retries_connection_error(mocker: MockerFixture) -> None:
+    client = mocker.Mock(
+        **{
+            "post.side_effect": [
+                requests.ConnectionError("reset"),
+                requests.ReadTimeout("slow"),
+                None,
+            ]
+        }
+    )
+    delivery = Delivery(["Cabcde"], make_payload(), multicast=False)
+
+    result = DeliveryExecutor(client, sleep=mocker.Mock()).send(delivery)
+
+    assert result.ok
+    assert result.attempts == 3
+    retry_keys = {c.kwargs["retry_key"] for c in client.post.mock_calls}
+    assert retry_keys == {delivery.retry_key}
+
+    # 送り直しても繋がらなければ、バッチを止めずに失敗として返す
+    client = mocker.Mock(**{"post.side_effect": requests.ConnectionError("reset")})
+    result = DeliveryExecutor(client, max_retries=1, sleep=mocker.Mock()).run(
+        [delivery]
+    )[0]
+    assert result.error is not None
+    assert result.error.status_code == NO_RESPONSE
+    assert result.attempts == 2
+
+
+def test_executor_conflict_on_first_attempt_is_success(
+    mocker: MockerFixture,
+) -> None:
+    # 送信後にジャーナルを保存する前に中断し、同じリトライキーで再開した
+    client = mocker.Mock(**{"post.side_effect": make_line_bot_api_error(409)})
+    delivery = Delivery(["Cabcde"], make_payload(), multicast=False)
+
+    result = DeliveryExecutor(client, sleep=mocker.Mock()).send(delivery)
+
+    assert result.ok
+    assert result.attempts == 1
+
+
+def test_executor_gives_up(mocker: MockerFixture) -> None:
+    error = make_line_bot_api_error(503)
+    client = mocker.Mock(**{"post.side_effect": error})
+    delivery = Delivery(["Cabcde"], make_payload(), multicast=False)
+
+    result = DeliveryExecutor(client, max_retries=2, sleep=mocker.Mock()).send(delivery)
+
+    assert result.error is error
+    assert result.attempts == 3
+
+
+def test_executor_no_retry_on_client_error(mocker: MockerFixture) -> None:
+    client = mocker.Mock(**{"post.side_effect": make_line_bot_api_error(400)})
+    deliveries = [
+        Delivery([sender_id], make_payload(), multicast=False)
+        for sender_id in ["Cabcde", "Cfghij"]
+    ]
+
+    results = DeliveryExecutor(client, sleep=mocker.Mock()).run(deliveries)
+
+    assert [r.delivery for r in results] == deliveries
+    assert [r.attempts for r in results] == [1, 1]
+    assert client.post.call_count == 2
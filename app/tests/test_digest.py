@@ -0,0 +1,77 @@
+from app.src.delivery import Delivery, MessagePayload
+from app.src.digest import (
+    DEFAULT_GROUP_SIZE,
+    QUOTA_CONSUMPTION_PATH,
+    QUOTA_PATH,
+    MessageQuota,
+    billable_messages,
+    build_digest,
+    get_member_counts,
+    get_message_quota,
+    within_quota,
+)
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+from pytest_mock import MockerFixture
+
+
+def test_build_digest() -> None:
+    assert build_digest([]) == []
+    assert build_digest(["a", "b", "c"]) == ["a\n\nb\n\nc"]
+
+    # 上限を超えたら次の吹き出しにする
+    assert build_digest(["aaa", "bbb", "c"], max_length=8) == ["aaa\n\nbbb", "c"]
+    # 1件で上限を超えるツイートは切り詰める
+    assert build_digest(["a" * 10], max_length=8) == ["a" * 7 + "…"]
+
+
+def test_get_message_quota(mocker: MockerFixture) -> None:
+    client = mocker.Mock()
+    client.get.side_effect = lambda path: {
+        QUOTA_PATH: {"type": "limited", "value": 1000},
+        QUOTA_CONSUMPTION_PATH: {"totalUsage": 950},
+    }[path]
+
+    quota = get_message_quota(client)
+    assert quota == MessageQuota(1000, 950)
+    assert quota.remaining == 50
+    assert quota.reserve == 100
+
+    client.get.side_effect = lambda path: {
+        QUOTA_PATH: {"type": "none"},
+        QUOTA_CONSUMPTION_PATH: {"totalUsage": 950},
+    }[path]
+    assert get_message_quota(client).remaining is None
+
+
+def test_within_quota() -> None:
+    payload = MessagePayload([])
+    deliveries = [
+        Delivery(["U1", "U2", "U3"], payload, multicast=True),
+        Delivery(["C1"], payload, multicast=False),
+        Delivery(["R1"], payload, multicast=False),
+    ]
+    member_counts = {"C1": 4, "R1": 2}
+    # グループ・トークルームはメンバーの人数分と数える
+    assert billable_messages(deliveries, member_counts) == 9
+    # 人数が分からなければ見積もりで数える
+    assert billable_messages(deliveries) == 3 + 2 * DEFAULT_GROUP_SIZE
+    # 収まらない配信は飛ばし、後ろの小さい配信で残りを使う
+    assert within_quota(deliveries, 6, member_counts) == [deliveries[0], deliveries[2]]
+    assert within_quota(deliveries, 9, member_counts) == deliveries
+
+
+def test_get_member_counts(mocker: MockerFixture) -> None:
+    client = mocker.Mock()
+    client.get.side_effect = lambda path: {
+        "/v2/bot/group/C1/members/count": {"count": 4},
+        "/v2/bot/room/R1/members/count": {"count": 2},
+    }[path]
+
+    assert get_member_counts(client, ["U1", "C1", "R1"]) == {"C1": 4, "R1": 2}
+    # 温まったコンテナでは取得し直さない
+    assert get_member_counts(client, ["C1"]) == {"C1": 4}
+    assert client.get.call_count == 2
+
+    client.get.side_effect = LineBotApiError(404, {}, error=Error(message="x"))
+    assert get_member_counts(client, ["C2"]) == {}
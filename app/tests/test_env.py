@@ -64,3 +64,21 @@ def test_then_no_key_env(caplog: LogCaptureFixture) -> None:
         ERROR,
         "Specify TEST as environment variable.",
     ) in caplog.record_tuples
+
+
+def test_get_env_local_storage(
+    set_env: None, monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    monkeypatch.setenv("STORAGE", "sqlite")
+    monkeypatch.setenv("STORAGE_DIR", "/tmp/storage")
+    env = get_env()
+    assert (env.STORAGE, env.STORAGE_DIR) == ("sqlite", "/tmp/storage")
+
+    monkeypatch.setenv("STORAGE", "dynamodb")
+    with pytest.raises(SystemExit):
+        get_env()
+    assert (
+        "root",
+        ERROR,
+        "STORAGE must be one of s3, local, sqlite.",
+    ) in caplog.record_tuples
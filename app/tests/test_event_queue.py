@@ -0,0 +1,85 @@
+import json
+from typing import List
+
+import pytest
+from app.src.event_queue import (
+    LambdaEventQueue,
+    LocalEventQueue,
+    WebhookEvents,
+    get_event_queue,
+    is_async_mode,
+)
+from pytest_mock import MockerFixture
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("1", True), ("true", True), ("", False), ("0", False)]
+)
+def test_is_async_mode(
+    monkeypatch: pytest.MonkeyPatch, value: str, expected: bool
+) -> None:
+    monkeypatch.setenv("WEBHOOK_ASYNC", value)
+
+    assert is_async_mode() is expected
+
+
+def test_local_event_queue() -> None:
+    processed: List[WebhookEvents] = []
+    queue = LocalEventQueue(processed.append)
+
+    queue.put([{"type": "join"}])
+    queue.put([{"type": "leave"}])
+    queue.join()
+
+    assert [event for events in processed for event in events] == [
+        {"type": "join"},
+        {"type": "leave"},
+    ]
+
+
+def test_local_event_queue_window() -> None:
+    processed: List[WebhookEvents] = []
+    queue = LocalEventQueue(processed.append, window=0.5)
+
+    queue.put([{"type": "join"}])
+    queue.put([{"type": "leave"}])
+    queue.join()
+
+    assert processed == [[{"type": "join"}, {"type": "leave"}]]
+
+
+def test_local_event_queue_keeps_running_after_error() -> None:
+    processed: List[WebhookEvents] = []
+
+    def worker(events: WebhookEvents) -> None:
+        if not events:
+            raise ValueError
+        processed.append(events)
+
+    queue = LocalEventQueue(worker)
+    queue.put([])
+    queue.put([{"type": "join"}])
+    queue.join()
+
+    assert processed == [[{"type": "join"}]]
+
+
+def test_lambda_event_queue(mocker: MockerFixture) -> None:
+    mock_client = mocker.patch("boto3.client").return_value
+
+    LambdaEventQueue("arn:aws:lambda:function:webhook").put([{"type": "join"}])
+
+    mock_client.invoke.assert_called_once_with(
+        FunctionName="arn:aws:lambda:function:webhook",
+        InvocationType="Event",
+        Payload=json.dumps({"webhookEvents": [{"type": "join"}]}).encode("utf-8"),
+    )
+
+
+def test_get_event_queue(monkeypatch: pytest.MonkeyPatch) -> None:
+    queue = get_event_queue("arn", print)
+    assert isinstance(queue, LocalEventQueue)
+    assert get_event_queue("arn", print) is queue
+
+    monkeypatch.setenv("ENV_NAME", "prod")
+    assert isinstance(get_event_queue("arn", print), LambdaEventQueue)
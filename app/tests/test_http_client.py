@@ -0,0 +1,67 @@
+import pytest
+import requests
+from app.src.http_client import LineMessagingClient
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpResponse
+from pytest_mock import MockerFixture
+
+
+def test_line_messaging_client_post(mocker: MockerFixture) -> None:
+    http_client = mocker.Mock()
+    http_client.post.return_value.status_code = 200
+    client = LineMessagingClient("token", "https://example.com", http_client)
+
+    client.post("/v2/bot/message/push", b"{}", retry_key="key")
+    client.post("/v2/bot/message/push", b"{}")
+
+    first, second = http_client.post.mock_calls
+    assert first.args == ("https://example.com/v2/bot/message/push",)
+    assert first.kwargs["data"] == b"{}"
+    assert first.kwargs["headers"]["Authorization"] == "Bearer token"
+    assert first.kwargs["headers"]["X-Line-Retry-Key"] == "key"
+    # リトライキーは共有のヘッダーに残らない
+    assert "X-Line-Retry-Key" not in second.kwargs["headers"]
+
+
+def test_line_messaging_client_error(mocker: MockerFixture) -> None:
+    http_client = mocker.Mock()
+    response = http_client.post.return_value
+    response.status_code = 429
+    response.headers = {"X-Line-Request-Id": "request"}
+    response.json = {"message": "Too Many Requests", "details": []}
+    client = LineMessagingClient("token", http_client=http_client)
+
+    with pytest.raises(LineBotApiError) as e:
+        client.post("/v2/bot/message/push", b"{}")
+
+    assert e.value.status_code == 429
+    assert e.value.request_id == "request"
+    assert e.value.error.message == "Too Many Requests"
+
+
+@pytest.mark.parametrize("text", ["<html>Bad Gateway</html>", ""])
+def test_line_messaging_client_error_not_json(mocker: MockerFixture, text: str) -> None:
+    http_client = mocker.Mock()
+    response = RequestsHttpResponse(requests.Response())
+    response.response.status_code = 502
+    response.response._content = text.encode("utf-8")
+    http_client.post.return_value = response
+    client = LineMessagingClient("token", http_client=http_client)
+
+    with pytest.raises(LineBotApiError) as e:
+        client.post("/v2/bot/message/push", b"{}")
+
+    assert e.value.status_code == 502
+    assert e.value.error.message == (text or "502")
+
+
+def test_line_messaging_client_get(mocker: MockerFixture) -> None:
+    http_client = mocker.Mock()
+    http_client.get.return_value.status_code = 200
+    http_client.get.return_value.json = {"type": "limited", "value": 1000}
+    client = LineMessagingClient("token", "https://example.com", http_client)
+
+    assert client.get("/v2/bot/message/quota") == {"type": "limited", "value": 1000}
+    (call,) = http_client.get.mock_calls
+    assert call.args == ("https://example.com/v2/bot/message/quota",)
+    assert call.kwargs["headers"]["Authorization"] == "Bearer token"
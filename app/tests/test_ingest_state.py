@@ -0,0 +1,65 @@
+from logging import INFO
+
+import boto3
+from _pytest.logging import LogCaptureFixture
+from app.src.env import Env
+from app.src.ingest_state import (
+    LEDGER_MAX_SIZE,
+    IngestState,
+    load_state,
+    save_state,
+    state_key,
+)
+from moto import mock_s3
+
+ENV = Env(S3_BUCKET_NAME="test", S3_KEY_NAME="test")
+
+
+def test_mark_sent_is_bounded() -> None:
+    state = IngestState()
+
+    state.mark_sent(range(LEDGER_MAX_SIZE + 10))
+    state.mark_sent([LEDGER_MAX_SIZE + 9])
+
+    assert len(state.sent_ids) == LEDGER_MAX_SIZE
+    assert not state.is_sent(9)
+    assert state.is_sent(10)
+
+
+def test_advance_only_moves_forward() -> None:
+    state = IngestState(since_ids={"dummy": 10})
+
+    state.advance("dummy", [5, 8])
+    assert state.since_ids == {"dummy": 10}
+
+    state.advance("dummy", [12, 11])
+    assert state.since_ids == {"dummy": 12}
+
+    state.advance("other", [])
+    assert state.since_ids == {"dummy": 12}
+
+
+@mock_s3
+def test_load_state_no_key(caplog: LogCaptureFixture) -> None:
+    caplog.set_level(INFO)
+    boto3.resource("s3").Bucket("test").create()
+
+    state = load_state(ENV)
+
+    assert state == IngestState()
+    assert (
+        "root",
+        INFO,
+        "取り込み状態が無いため初期状態から開始",
+    ) in caplog.record_tuples
+
+
+@mock_s3
+def test_save_and_load_state() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    state = IngestState(since_ids={"dummy": 1}, sent_ids=[1])
+
+    save_state(ENV, state)
+
+    assert state_key("test") == "test.state.json"
+    assert load_state(ENV) == state
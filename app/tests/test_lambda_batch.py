@@ -1,23 +1,55 @@
+import json
 import os
-from datetime import datetime, timezone
-from logging import ERROR
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from logging import ERROR, INFO
+from typing import Any, Dict, List, Tuple
 
 import boto3
 import pytest
 from _pytest.logging import LogCaptureFixture
+from app.src.delivery import (
+    MULTICAST_PATH,
+    PUSH_PATH,
+    Delivery,
+    MessagePayload,
+    plan_deliveries,
+)
+from app.src.digest import QUOTA_CONSUMPTION_PATH, QUOTA_PATH
+from app.src.env import get_env
+from app.src.ingest_state import IngestState, load_state, save_state
 from app.src.lambda_batch import (
-    get_send_message_by_dbd_official,
-    get_send_message_by_ruby_nea,
+    continue_batch,
+    get_send_messages,
+    get_statuses,
     judge_output_status,
     lambda_handler,
-    send_message,
+    output_cutoff,
+    send_outbox,
+)
+from app.src.matcher import KeywordMatcher
+from app.src.outbox import FAILED, SENT, MemoryOutboxStore, Outbox, get_outbox_store
+from app.src.recipient_health import (
+    QUARANTINE_PERIOD,
+    HealthState,
+    RecipientHealth,
+    load_health,
+    save_health,
 )
+from app.src.sharding import ShardResult, get_shard_result_store
+from app.src.sources import Source, load_sources
+from app.src.storage import get_blob_store
+from app.src.subscriber_store import get_subscriber_store
+from app.src.timeline_cache import get_timeline_cache
+from app.src.topics import get_subscription_store
+from botocore.exceptions import ClientError
 from linebot.exceptions import LineBotApiError
 from linebot.models import TextSendMessage
 from linebot.models.error import Error, ErrorDetail
 from moto import mock_s3
 from pytest_mock import MockerFixture
+from tweepy.errors import TweepyException
 from tweepy.models import Status
 
 from .lambda_helper import make_context, make_event_bridge_event
@@ -36,11 +68,17 @@ def setup_mock_s3(content: str) -> None:
     os.environ["S3_KEY_NAME"] = key
 
 
+def sent_requests(mock_client: Any) -> List[Tuple[str, Dict[str, Any]]]:
+    # 送信したリクエストを (パス, ボディ) の組にする
+    requests = [(c.args[0], json.loads(c.args[1])) for c in mock_client.post.mock_calls]
+    return sorted(requests, key=lambda request: request[0])
+
+
 def setup_mock_twitter_api(
     mocker: MockerFixture, send_message: str, created_at: str
 ) -> None:
     test_status = Status.parse(
-        None, {"full_text": send_message, "created_at": created_at}
+        None, {"id": 1, "full_text": send_message, "created_at": created_at}
     )
     status_list = [test_status]
     mocker.patch(
@@ -51,38 +89,558 @@ def setup_mock_twitter_api(
 
 @mock_s3
 @pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
-def test_lambda_handler(mocker: MockerFixture) -> None:
+def test_lambda_handler(
+    mocker: MockerFixture, capsys: pytest.CaptureFixture[str]
+) -> None:
     setup_mock_s3('["abcde"]')
 
     send_message = "引き換えコード: dummy"
     created_at = "Tue Feb 22 13:00:00 +0000 2022"
 
+    # Twitterへのリクエストをmock
+    status_lists = [
+        [
+            Status.parse(
+                None, {"id": i, "full_text": send_message, "created_at": created_at}
+            )
+        ]
+        for i in [1, 2]
+    ]
+    mocker.patch(
+        "app.src.lambda_batch.API",
+        return_value=mocker.Mock(**{"user_timeline.side_effect": status_lists}),
+    )
+
+    # LINEへのリクエストをmock
+    mock_line_bot_api = mocker.Mock()
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    result = lambda_handler(make_event_bridge_event(), make_context())
+
+    assert result["statusCode"] == 200
+    # 2アカウント分のツイートを1リクエストにまとめて送る
+    assert sent_requests(mock_line_bot_api) == [
+        (
+            PUSH_PATH,
+            {
+                "to": "abcde",
+                "messages": [
+                    TextSendMessage(text=send_message).as_json_dict(),
+                    TextSendMessage(text=send_message).as_json_dict(),
+                ],
+            },
+        )
+    ]
+
+    state = load_state(get_env())
+    assert state.since_ids == {"DeadbyBHVR_JP": 1, "Ruby_Nea_": 2}
+    assert state.sent_ids == [1, 2]
+
+    # Webhook向けにタイムラインを保存する
+    timeline_cache = get_timeline_cache(get_env())
+    assert [s["id"] for s in timeline_cache.timeline("Ruby_Nea_")] == [2]
+
+    # 段階ごとの計測をEMFで出力する
+    emf = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert emf["Function"] == "Batch"
+    assert emf["TweetsFetched"] == 2
+    assert emf["TweetsMatched"] == 2
+    assert emf["Recipients"] == 1
+    assert emf["PushesSent"] == 1
+    assert emf["Failures"] == 0
+    assert "TwitterFetchDuration" in emf
+
+
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
+def test_lambda_handler_skip_sent(mocker: MockerFixture) -> None:
+    setup_mock_s3('["abcde"]')
+    save_state(get_env(), IngestState(since_ids={"Ruby_Nea_": 1}, sent_ids=[2]))
+
     # Twitterへのリクエストをmock
     test_status = Status.parse(
-        None, {"full_text": send_message, "created_at": created_at}
+        None,
+        {
+            "id": 2,
+            "full_text": "引き換えコード: dummy",
+            "created_at": "Tue Feb 22 13:00:00 +0000 2022",
+        },
     )
-    status_list = [test_status]
+    mock_twitter_api = mocker.Mock(**{"user_timeline.return_value": [test_status]})
+    mocker.patch("app.src.lambda_batch.API", return_value=mock_twitter_api)
+
+    # LINEへのリクエストをmock
+    mock_line_bot_api = mocker.Mock()
     mocker.patch(
-        "app.src.lambda_batch.API",
-        return_value=mocker.Mock(**{"user_timeline.return_value": status_list}),
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
     )
 
+    result = lambda_handler(make_event_bridge_event(), make_context())
+
+    assert result["statusCode"] == 200
+    mock_line_bot_api.post.assert_not_called()
+    since_ids = [
+        c.kwargs["since_id"] for c in mock_twitter_api.user_timeline.mock_calls
+    ]
+    assert since_ids == [None, 1]
+
+
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
+def test_lambda_handler_resume_after_deadline(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    setup_mock_s3('["abcde"]')
+
+    # Twitterへのリクエストをmock
+    test_status = Status.parse(
+        None,
+        {
+            "id": 1,
+            "full_text": "引き換えコード: dummy",
+            "created_at": "Tue Feb 22 13:00:00 +0000 2022",
+        },
+    )
+    mock_twitter_api = mocker.Mock(**{"user_timeline.return_value": [test_status]})
+    mocker.patch("app.src.lambda_batch.API", return_value=mock_twitter_api)
+
     # LINEへのリクエストをmock
     mock_line_bot_api = mocker.Mock()
-    mocker.patch("app.src.lambda_batch.LineBotApi", return_value=mock_line_bot_api)
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    # タイムアウト直前なので配信せずにジャーナルだけ残す
+    result = lambda_handler(make_event_bridge_event(), make_context(0))
+
+    assert result["statusCode"] == 200
+    mock_line_bot_api.post.assert_not_called()
+    assert ("root", INFO, "タイムアウトが近いため配信を中断") in caplog.record_tuples
+    assert load_state(get_env()).sent_ids == [1]
+
+    result = lambda_handler(make_event_bridge_event(), make_context())
+
+    assert result["statusCode"] == 200
+    assert ("root", INFO, "中断した配信を再開") in caplog.record_tuples
+    assert mock_twitter_api.user_timeline.call_count == 2
+    assert mock_line_bot_api.post.call_count == 1
+    obj = boto3.resource("s3").Object("test", "test.outbox.json")
+    with pytest.raises(ClientError):
+        obj.get()
+
+
+@mock_s3
+def test_lambda_handler_resume_already_accepted(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    setup_mock_s3('["Cabcde"]')
+    setup_mock_twitter_api(mocker, "dummy", "Tue Feb 22 13:00:00 +0000 2022")
+    # 送信した後、ジャーナルを保存する前に中断した
+    payload = MessagePayload.from_messages([TextSendMessage(text="dummy")])
+    delivery = Delivery(["Cabcde"], payload, multicast=False)
+    get_outbox_store(get_env()).save(Outbox.from_deliveries([delivery]))
+
+    conflict = LineBotApiError(409, {}, error=Error(message="Conflict"))
+    mock_line_bot_api = mocker.Mock(**{"post.side_effect": conflict})
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    result = lambda_handler(make_event_bridge_event(), make_context())
+
+    # 受理済みなので成功として扱う
+    assert result["statusCode"] == 200
+    assert mock_line_bot_api.post.call_args.kwargs["retry_key"] == delivery.retry_key
+    assert not [r for r in caplog.records if r.levelno >= ERROR]
+    assert get_outbox_store(get_env()).load() is None
+
+
+@mock_s3
+def test_lambda_handler_sharded(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    setup_mock_s3('["C1", "C2", "C3"]')
+    # freezegunはワーカーのスレッドで時刻がずれるため、現在時刻のツイートにする
+    created_at = datetime.now(timezone.utc).strftime("%a %b %d %H:%M:%S +0000 %Y")
+    setup_mock_twitter_api(mocker, "引き換えコード: dummy", created_at)
+    mock_line_bot_api = mocker.Mock()
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+    # プロセスプールの代わりにスレッドで動かし、mockへの呼び出しを確認する
+    mocker.patch("app.src.sharding.default_executor", ThreadPoolExecutor)
+    monkeypatch.setenv("BATCH_SHARD_SIZE", "1")
 
     result = lambda_handler(make_event_bridge_event(), make_context())
 
     assert result["statusCode"] == 200
-    assert mock_line_bot_api.push_message.call_count == 2
-    mock_line_bot_api.push_message.assert_called_with(
-        "abcde", messages=[TextSendMessage(text=send_message)]
+    assert ("root", INFO, "3個のシャードに分けて配信") in caplog.record_tuples
+    assert ("root", INFO, "配信結果: 送信 3件, 失敗 0件, 未配信 0件") in (
+        caplog.record_tuples
+    )
+    assert sorted(body["to"] for _, body in sent_requests(mock_line_bot_api)) == [
+        "C1",
+        "C2",
+        "C3",
+    ]
+    obj = boto3.resource("s3").Object("test", "test.outbox.json")
+    with pytest.raises(ClientError):
+        obj.get()
+
+
+@mock_s3
+def test_lambda_handler_sharded_worker_crash(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    setup_mock_s3('["C1", "C2"]')
+    created_at = datetime.now(timezone.utc).strftime("%a %b %d %H:%M:%S +0000 %Y")
+    setup_mock_twitter_api(mocker, "引き換えコード: dummy", created_at)
+
+    def post(path: str, body: bytes, retry_key: str) -> None:
+        if json.loads(body)["to"] == "C2":
+            raise RuntimeError("crash")
+
+    mock_line_bot_api = mocker.Mock(**{"post.side_effect": post})
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+    mocker.patch("app.src.sharding.default_executor", ThreadPoolExecutor)
+    monkeypatch.setenv("BATCH_SHARD_SIZE", "1")
+
+    result = lambda_handler(make_event_bridge_event(), make_context())
+
+    # 報告の無かったシャードは失敗として扱い、次回に配信する
+    assert result["statusCode"] == 500
+    assert [r.message for r in caplog.records if r.levelno >= ERROR][-1].startswith(
+        "Shards did not report: "
+    )
+    outbox = get_outbox_store(get_env()).load()
+    assert outbox is not None
+    assert [entry.to for entry in outbox.pending()] == [["C2"]]
+
+
+@mock_s3
+def test_lambda_handler_shard_worker(mocker: MockerFixture) -> None:
+    setup_mock_s3("[]")
+    env = get_env()
+    payload = MessagePayload.from_messages([TextSendMessage(text="dummy")])
+    outbox = Outbox.from_deliveries(
+        [Delivery([sender_id], payload, False) for sender_id in ["C1", "C2"]]
+    )
+    get_outbox_store(env, "run-0").save(outbox)
+    mock_line_bot_api = mocker.Mock()
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    event = {"shard": "run-0", "shards": 2}
+    result = lambda_handler(event, make_context())  # type: ignore
+
+    # 自分のジャーナルだけを配信し、結果をコーディネーターに渡す
+    assert result["statusCode"] == 200
+    assert mock_line_bot_api.post.call_count == 2
+    assert get_outbox_store(env, "run-0").load() is None
+    assert get_shard_result_store(env).load("run-0") == ShardResult(
+        "run-0", [SENT, SENT], [None, None]
+    )
+
+
+@mock_s3
+def test_lambda_handler_shard_worker_after_coordinator(mocker: MockerFixture) -> None:
+    setup_mock_s3('["C1", "C2"]')
+    env = get_env()
+    payload = MessagePayload.from_messages([TextSendMessage(text="dummy")])
+    outbox = Outbox.from_deliveries(
+        [Delivery([sender_id], payload, False) for sender_id in ["C1", "C2"]]
+    )
+    get_outbox_store(env, "run-0").save(outbox)
+    # コーディネーターは待つのをやめて終わっている
+    assert get_shard_result_store(env).abandon("run-0")
+
+    def post(path: str, body: bytes, retry_key: str) -> None:
+        if json.loads(body)["to"] == "C1":
+            raise LineBotApiError(404, {}, error=Error(message="Not found"))
+
+    mock_line_bot_api = mocker.Mock(**{"post.side_effect": post})
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    event = {"shard": "run-0", "shards": 2}
+    lambda_handler(event, make_context())  # type: ignore
+
+    # 結果を引き取る相手がいないので、宛先の結果を自分で記録して印を消す
+    assert list(load_health(env).recipients) == ["C1"]
+    assert get_blob_store(env).get("test.shards/run-0.json") is None
+
+
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
+def test_lambda_handler_prunes_dead_recipients(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    setup_mock_s3('["C1", "C2", "C3"]')
+    now = datetime(2022, 2, 22, 13, tzinfo=timezone.utc).timestamp()
+    health = HealthState(
+        recipients={
+            # 配信を止めてから期間が過ぎた
+            "C1": RecipientHealth(
+                3, 404, now - QUARANTINE_PERIOD, now - QUARANTINE_PERIOD
+            ),
+            # 配信を止めたばかり
+            "C2": RecipientHealth(3, 404, now - 1, now - 1),
+        }
+    )
+    save_health(get_env(), health)
+    setup_mock_twitter_api(
+        mocker, "引き換えコード: dummy", "Tue Feb 22 13:00:00 +0000 2022"
+    )
+
+    def post(path: str, body: bytes, retry_key: str) -> None:
+        if json.loads(body)["to"] == "C1":
+            raise LineBotApiError(404, {}, error=Error(message="Not found"))
+
+    mock_line_bot_api = mocker.Mock(**{"post.side_effect": post})
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    lambda_handler(make_event_bridge_event(), make_context())
+
+    assert sorted(body["to"] for _, body in sent_requests(mock_line_bot_api)) == [
+        "C1",
+        "C3",
+    ]
+    # 送り直しても失敗した宛先を購読者から外し、削除したことを記録する
+    assert get_subscriber_store(get_env()).members() == ["C2", "C3"]
+    health = load_health(get_env())
+    assert list(health.recipients) == ["C2"]
+    assert [(p.sender_id, p.last_error) for p in health.pruned] == [("C1", 404)]
+    assert (
+        "root",
+        INFO,
+        "配信できない宛先を削除: C1 (status 404, 4回失敗)",
+    ) in caplog.record_tuples
+
+
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
+def test_lambda_handler_topic_subscriptions(mocker: MockerFixture) -> None:
+    setup_mock_s3('["C1", "C2"]')
+    # C2はシュラインだけを購読する
+    get_subscription_store(get_env()).set("C2", ["聖堂"])
+    status_lists = [
+        [
+            Status.parse(
+                None,
+                {
+                    "id": i,
+                    "full_text": text,
+                    "created_at": "Tue Feb 22 13:00:00 +0000 2022",
+                },
+            )
+        ]
+        for i, text in [
+            (1, "今週のシュライン・オブ・シークレット"),
+            (2, "引き換えコード: dummy"),
+        ]
+    ]
+    mocker.patch(
+        "app.src.lambda_batch.API",
+        return_value=mocker.Mock(**{"user_timeline.side_effect": status_lists}),
+    )
+    mock_line_bot_api = mocker.Mock()
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    lambda_handler(make_event_bridge_event(), make_context())
+
+    sent = {
+        body["to"]: [m["text"] for m in body["messages"]]
+        for _, body in sent_requests(mock_line_bot_api)
+    }
+    assert sent == {
+        "C1": ["今週のシュライン・オブ・シークレット", "引き換えコード: dummy"],
+        "C2": ["今週のシュライン・オブ・シークレット"],
+    }
+
+
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
+def test_lambda_handler_digest_low_quota(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, caplog: LogCaptureFixture
+) -> None:
+    monkeypatch.setenv("BATCH_DIGEST", "true")
+    setup_mock_s3('["C1", "C2", "C3"]')
+    status_lists = [
+        [
+            Status.parse(
+                None,
+                {
+                    "id": i,
+                    "full_text": text,
+                    "created_at": "Tue Feb 22 13:00:00 +0000 2022",
+                },
+            )
+            for i, text in statuses
+        ]
+        for statuses in [
+            [(3, "BP2倍イベント開催中"), (1, "今週のシュライン・オブ・シークレット")],
+            [(2, "引き換えコード: dummy")],
+        ]
+    ]
+    mocker.patch(
+        "app.src.lambda_batch.API",
+        return_value=mocker.Mock(**{"user_timeline.side_effect": status_lists}),
+    )
+    mock_line_bot_api = mocker.Mock()
+    # 残り10通しか送れず、グループへの配信はメンバーの人数分の通数になる
+    mock_line_bot_api.get.side_effect = lambda path: {
+        QUOTA_PATH: {"type": "limited", "value": 1000},
+        QUOTA_CONSUMPTION_PATH: {"totalUsage": 990},
+        "/v2/bot/group/C1/members/count": {"count": 3},
+        "/v2/bot/group/C2/members/count": {"count": 4},
+        "/v2/bot/group/C3/members/count": {"count": 5},
+    }[path]
+    mocker.patch(
+        "app.src.lambda_batch.LineMessagingClient", return_value=mock_line_bot_api
+    )
+
+    lambda_handler(make_event_bridge_event(), make_context())
+
+    # 重要なツイートだけを1つの吹き出しにまとめ、残りの通数に収まる宛先にだけ送る
+    sent = {
+        body["to"]: [m["text"] for m in body["messages"]]
+        for _, body in sent_requests(mock_line_bot_api)
+    }
+    assert sent == {
+        "C1": ["今週のシュライン・オブ・シークレット\n\n引き換えコード: dummy"],
+        "C2": ["今週のシュライン・オブ・シークレット\n\n引き換えコード: dummy"],
+    }
+    assert (
+        "root",
+        INFO,
+        "メッセージの残りが少ないため重要なツイートだけを配信: 残り10通, 3件中2件",
+    ) in caplog.record_tuples
+    assert (
+        "root",
+        ERROR,
+        "Message quota exhausted: 10 remaining, 12 required",
+    ) in caplog.record_tuples
+
+
+def test_continue_batch_prod(mocker: MockerFixture) -> None:
+    os.environ["ENV_NAME"] = "prod"
+    mock_client = mocker.Mock()
+    mocker.patch("app.src.lambda_batch.boto3.client", return_value=mock_client)
+    context = make_context()
+    context.invoked_function_arn = "arn"
+
+    continue_batch(make_event_bridge_event(), context)
+    del os.environ["ENV_NAME"]
+
+    mock_client.invoke.assert_called_once_with(
+        FunctionName="arn", InvocationType="Event", Payload=mocker.ANY
+    )
+
+
+def test_get_statuses_paging(mocker: MockerFixture) -> None:
+    pages = [
+        [Status.parse(None, {"id": i}) for i in range(40, 20, -1)],
+        [Status.parse(None, {"id": 20})],
+        [],
+    ]
+    mock = mocker.Mock(**{"user_timeline.side_effect": pages})
+
+    result, complete = get_statuses(mock, Source("dummy", ("dummy",)), since_id=10)
+
+    assert [status.id for status in result] == list(range(40, 19, -1))
+    assert complete
+    max_ids = [c.kwargs["max_id"] for c in mock.user_timeline.mock_calls]
+    assert max_ids == [None, 20, 19]
+
+
+def test_get_statuses_short_page_is_not_the_end(mocker: MockerFixture) -> None:
+    # RTを除いた後の件数なので、countより少なくても続きがある
+    pages = [
+        [Status.parse(None, {"id": i}) for i in range(40, 35, -1)],
+        [Status.parse(None, {"id": i}) for i in range(30, 25, -1)],
+        [],
+    ]
+    mock = mocker.Mock(**{"user_timeline.side_effect": pages})
+
+    result, complete = get_statuses(mock, Source("dummy", ("dummy",)), since_id=10)
+
+    assert [status.id for status in result] == [40, 39, 38, 37, 36, 30, 29, 28, 27, 26]
+    assert complete
+
+
+def test_get_send_messages_keeps_since_id_when_incomplete(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    # 最大ページ数まで取得しても続きがある
+    created_at = "Tue Feb 22 13:00:00 +0000 2022"
+    pages = [
+        [Status.parse(None, {"id": i, "full_text": "dummy", "created_at": created_at})]
+        for i in range(40, 30, -1)
+    ]
+    mock = mocker.Mock(**{"user_timeline.side_effect": pages})
+    state = IngestState(since_ids={"dummy": 10})
+
+    get_send_messages(mock, [Source("dummy", ("dummy",))], state)
+
+    assert mock.user_timeline.call_count == 5
+    assert state.since_ids == {"dummy": 10}
+    assert (
+        "root",
+        ERROR,
+        "Too many new tweets of dummy; keeping since_id",
+    ) in caplog.record_tuples
+
+
+def test_get_send_messages_cutoff_only_on_first_run(mocker: MockerFixture) -> None:
+    # 実行が遅れて、12時間より前のツイートが未配信のまま残っている
+    created_at = (datetime.now(timezone.utc) - timedelta(hours=13)).strftime(
+        "%a %b %d %H:%M:%S +0000 %Y"
+    )
+    status = Status.parse(
+        None, {"id": 200, "full_text": "dummy", "created_at": created_at}
     )
+    mock = mocker.Mock(**{"user_timeline.side_effect": [[status], []] * 2})
+    sources = [Source("dummy", ("dummy",))]
+
+    state = IngestState(since_ids={"dummy": 100})
+    assert [s.id for s in get_send_messages(mock, sources, state)] == [200]
+    assert state.since_ids == {"dummy": 200}
+
+    # 初回の実行では古いツイートを配信しない
+    assert get_send_messages(mock, sources, IngestState()) == []
+
+
+def test_send_outbox_multicast(mocker: MockerFixture) -> None:
+    messages = [TextSendMessage(text="dummy")]
+    outbox = Outbox.from_deliveries(plan_deliveries(messages, ["U1", "Cabcde", "U2"]))
+
+    mock_line_bot_api = mocker.Mock()
+    store = MemoryOutboxStore()
+    result = send_outbox(outbox, store, mock_line_bot_api, lambda: 300000)
+
+    assert result is True
+    assert [entry.state for entry in outbox.entries] == [SENT, SENT]
+    assert store.load() is None
+    messages = [TextSendMessage(text="dummy").as_json_dict()]
+    assert sent_requests(mock_line_bot_api) == [
+        (MULTICAST_PATH, {"to": ["U1", "U2"], "messages": messages}),
+        (PUSH_PATH, {"to": "Cabcde", "messages": messages}),
+    ]
 
 
 def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) -> None:
-    push_list = [Status.parse(None, {"full_text": ""})]
-    sender_ids = ["abcde"]
+    messages = [TextSendMessage(text="")]
+    outbox = Outbox.from_deliveries(plan_deliveries(messages, ["abcde"]))
 
     line_bot_exception = LineBotApiError(
         400,
@@ -92,12 +650,9 @@ def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) ->
             details=[ErrorDetail(property="error", message="abcde")],
         ),
     )
-    mocker.patch(
-        "app.src.lambda_batch.LineBotApi",
-        return_value=mocker.Mock(**{"push_message.side_effect": line_bot_exception}),
-    )
+    mock_line_bot_api = mocker.Mock(**{"post.side_effect": line_bot_exception})
 
-    result = send_message(push_list, sender_ids, "")
+    result = send_outbox(outbox, MemoryOutboxStore(), mock_line_bot_api, lambda: 300000)
 
     assert (
         "root",
@@ -105,41 +660,76 @@ def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) ->
         "Got exception from LINE Messaging API: invalid id\n",
     ) in caplog.record_tuples
     assert ("root", ERROR, "  error: abcde") in caplog.record_tuples
+    assert ("root", ERROR, "  to: abcde") in caplog.record_tuples
     assert result is False
+    assert [(entry.state, entry.error) for entry in outbox.entries] == [(FAILED, 400)]
 
 
+@pytest.mark.parametrize("source", load_sources())
 @pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
-def test_no_get_dbd_official(mocker: MockerFixture) -> None:
+def test_no_get_send_messages(mocker: MockerFixture, source: Source) -> None:
     send_message = "dummy"
     created_at = "Tue Feb 22 13:00:00 +0000 2022"
 
     # Twitterへのリクエストをmock
     test_status = Status.parse(
-        None, {"full_text": send_message, "created_at": created_at}
+        None, {"id": 1, "full_text": send_message, "created_at": created_at}
     )
     status_list = [test_status]
     mock = mocker.Mock(**{"user_timeline.return_value": status_list})
 
-    result = get_send_message_by_dbd_official(mock)
+    result = get_send_messages(mock, [source], IngestState())
 
     assert result == []
 
 
 @pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
-def test_no_get_ruby_nea(mocker: MockerFixture) -> None:
-    send_message = "dummy"
-    created_at = "Tue Feb 22 13:00:00 +0000 2022"
-
-    # Twitterへのリクエストをmock
+def test_get_send_messages_timeout(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
     test_status = Status.parse(
-        None, {"full_text": send_message, "created_at": created_at}
+        None,
+        {"id": 1, "full_text": "dummy", "created_at": "Tue Feb 22 13:00:00 +0000 2022"},
     )
-    status_list = [test_status]
-    mock = mocker.Mock(**{"user_timeline.return_value": status_list})
+    released = threading.Event()
 
-    result = get_send_message_by_ruby_nea(mock)
+    def user_timeline(screen_name: str, **kwargs: Any) -> List[Status]:
+        if screen_name == "slow":
+            released.wait()
+        return [test_status]
+
+    mock = mocker.Mock(**{"user_timeline.side_effect": user_timeline})
+    sources = [
+        Source(screen_name="slow", keywords=("dummy",), timeout=0.1),
+        Source(screen_name="fast", keywords=("dummy",)),
+    ]
+    state = IngestState()
+
+    result = get_send_messages(mock, sources, state)
+    released.set()
+
+    assert result == [test_status]
+    assert state.since_ids == {"fast": 1}
+    assert ("root", ERROR, "Timed out fetching tweets of slow") in caplog.record_tuples
+
+
+def test_get_send_messages_twitter_error(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    mock = mocker.Mock(**{"user_timeline.side_effect": TweepyException("dummy")})
+    state = IngestState()
+
+    result = get_send_messages(
+        mock, [Source(screen_name="dummy", keywords=("dummy",))], state
+    )
 
     assert result == []
+    assert state.since_ids == {}
+    assert (
+        "root",
+        ERROR,
+        "Got exception from Twitter API: dummy",
+    ) in caplog.record_tuples
 
 
 @pytest.mark.parametrize(
@@ -154,13 +744,14 @@ def test_date_filter_judge_output_status(input: str, expected: bool) -> None:
     filters = ["test"]
     test_status = Status.parse(None, {"full_text": "test!", "created_at": input})
 
-    result = judge_output_status(test_status, filters)
+    result = judge_output_status(test_status, KeywordMatcher(filters), output_cutoff())
 
     assert expected == result
 
 
 @pytest.mark.parametrize(
-    "filters,text,expected", [(["引き換えコード"], "コード", False), (["コード"], "引き換えコード", True)]
+    "filters,text,expected",
+    [(["引き換えコード"], "コード", False), (["コード"], "引き換えコード", True)],
 )
 @pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 00, 00, 000000, tzinfo=timezone.utc))
 def test_str_filter_judge_output_status(
@@ -169,5 +760,5 @@ def test_str_filter_judge_output_status(
     test_status = Status.parse(
         None, {"full_text": text, "created_at": "Tue Feb 22 13:00:00 +0000 2022"}
     )
-    result = judge_output_status(test_status, filters)
+    result = judge_output_status(test_status, KeywordMatcher(filters), output_cutoff())
     assert expected == result
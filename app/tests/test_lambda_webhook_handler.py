@@ -1,21 +1,39 @@
+import base64
+import hashlib
+import hmac
 import json
 import os
+import subprocess
+import sys
+import threading
+from datetime import datetime, timezone
 from logging import ERROR, INFO
+from pathlib import Path
 from typing import List
 from unittest.mock import Mock
 
 import boto3
+import pytest
 from _pytest.logging import LogCaptureFixture
 from app.src.env import get_env
+from app.src.event_queue import get_event_queue
 from app.src.lambda_webhook_handler import (
     RequestFromLineBot,
     RequestHeadersFromLineBot,
+    WarmupRequest,
+    WebhookEventsRequest,
     delete_id,
+    is_command,
     lambda_handler,
     message,
+    reply_line,
     store_id,
 )
-from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from app.src.runtime import reset_runtime
+from app.src.subscriber_store import S3SubscriberStore, get_subscriber_store
+from app.src.timeline_cache import get_timeline_cache
+from app.src.topics import get_subscription_store
+from linebot.exceptions import LineBotApiError
 from linebot.models import TextSendMessage
 from linebot.models.error import Error, ErrorDetail
 from moto import mock_s3
@@ -25,36 +43,53 @@ from tweepy.models import Status
 from .lambda_helper import make_context
 
 
+def sign(body: str) -> str:
+    secret = get_env().LINE_CHANNEL_SECRET.encode("utf-8")
+    digest = hmac.new(secret, body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def make_request(body: str, header: str = "x-line-signature") -> RequestFromLineBot:
+    return RequestFromLineBot(
+        {
+            "headers": RequestHeadersFromLineBot({header: sign(body)}),  # type: ignore
+            "body": body,
+        }
+    )
+
+
 def mock_line_bot_api(mocker: MockerFixture) -> Mock:
     return_mock: Mock = mocker.Mock()
-    mocker.patch("app.src.lambda_webhook_handler.LineBotApi", return_value=return_mock)
+    mocker.patch("linebot.LineBotApi", return_value=return_mock)
     return return_mock
 
 
+@mock_s3
 def test_lambda_handler_message(mocker: MockerFixture) -> None:
-    event = RequestFromLineBot(
-        {
-            "headers": RequestHeadersFromLineBot({"x-line-signature": "dummy"}),
-            "body": '{"events":[\
+    event = make_request('{"events":[\
             {\
                 "type":"message",\
                 "message":{"type":"text","text":"今週の聖堂"},\
                 "replyToken":"dummy"\
             }\
-        ]}',
-        }
-    )
+        ]}')
     reply_token = "dummy"
     send_message = "今週のシュライン・オブ・シークレットはdummy!"
 
-    # 署名検証を無効にする
-    mocker.patch("linebot.SignatureValidator.validate", return_value=True)
+    setup_mock_s3("[]")
 
     # Twitterへのリクエストをmock
-    test_status = Status.parse(None, {"full_text": send_message})
+    test_status = Status.parse(
+        None,
+        {
+            "id": 1,
+            "full_text": send_message,
+            "created_at": "Tue Feb 22 00:00:00 +0000 2022",
+        },
+    )
     status_list = [test_status]
     mocker.patch(
-        "app.src.lambda_webhook_handler.API",
+        "tweepy.API",
         return_value=mocker.Mock(**{"user_timeline.return_value": status_list}),
     )
 
@@ -69,23 +104,148 @@ def test_lambda_handler_message(mocker: MockerFixture) -> None:
     )
 
 
-def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) -> None:
-    event = RequestFromLineBot(
+def test_lambda_handler_warmup(mocker: MockerFixture) -> None:
+    mock_get_env = mocker.patch("app.src.runtime.get_env")
+
+    result = lambda_handler(WarmupRequest({"warmup": True}), make_context())
+
+    assert result["statusCode"] == 200
+    mock_get_env.assert_not_called()
+
+
+def test_import_does_not_load_heavy_modules() -> None:
+    code = (
+        "import sys\n"
+        "import app.src.lambda_webhook_handler\n"
+        "print(' '.join(m for m in ('openai', 'tweepy', 'boto3', 'botocore', 'linebot')"
+        " if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parents[2],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.stdout.strip() == ""
+
+
+def test_lambda_handler_async(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("WEBHOOK_ASYNC", "true")
+    event = make_request('{"events":[{"type":"message",\
+            "message":{"type":"text","text":"/chatgpt test"},"replyToken":"dummy"}]}')
+    processed = threading.Event()
+    mocker.patch("openai.ChatCompletion")
+    mock_reply_message = mock_line_bot_api(mocker)
+    mock_reply_message.reply_message.side_effect = lambda *args, **kwargs: (
+        processed.wait(5)
+    )
+
+    result = lambda_handler(event, make_context())
+
+    # 処理の完了を待たずに返す
+    assert result["statusCode"] == 200
+    processed.set()
+    get_event_queue("", print).join()  # type: ignore[attr-defined]
+    mock_reply_message.reply_message.assert_called_once()
+
+
+def test_lambda_handler_async_ignores_chat(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("WEBHOOK_ASYNC", "true")
+    event = make_request('{"events":[{"type":"message",\
+            "message":{"type":"text","text":"こんにちは"},"replyToken":"dummy"}]}')
+    mock_queue = mocker.patch("app.src.lambda_webhook_handler.get_event_queue")
+
+    result = lambda_handler(event, make_context())
+
+    # 何もしないイベントだけなら自分を呼び出さずに返す
+    assert result["statusCode"] == 200
+    mock_queue.assert_not_called()
+
+
+def test_lambda_handler_worker(mocker: MockerFixture) -> None:
+    event = WebhookEventsRequest(
         {
-            "headers": RequestHeadersFromLineBot({"x-line-signature": "dummy"}),
-            "body": "",
+            "webhookEvents": [
+                {
+                    "type": "message",
+                    "message": {"type": "text", "text": "/chatgpt test"},
+                    "replyToken": "dummy",
+                }
+            ]
         }
     )
+    mocker.patch("openai.ChatCompletion")
+    mock_reply_message = mock_line_bot_api(mocker)
 
-    mocker.patch(
-        "linebot.WebhookHandler.handle",
-        side_effect=LineBotApiError(
-            400,
-            {},
-            error=Error(
-                message="invalid id",
-                details=[ErrorDetail(property="error", message="abcde")],
-            ),
+    result = lambda_handler(event, make_context())
+
+    assert result["statusCode"] == 200
+    mock_reply_message.reply_message.assert_called_once()
+
+
+def test_lambda_handler_ignores_redelivery(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    body = '{"events":[{"type":"message","webhookEventId":"01H",\
+        "deliveryContext":{"isRedelivery":false},\
+        "message":{"type":"text","text":"/chatgpt test"},"replyToken":"dummy"}]}'
+    mock_create = mocker.patch("openai.ChatCompletion.create")
+    mock_line_bot_api(mocker)
+
+    lambda_handler(make_request(body), make_context())
+    redelivered = body.replace('"isRedelivery":false', '"isRedelivery":true')
+    result = lambda_handler(make_request(redelivered), make_context())
+
+    assert result["statusCode"] == 200
+    mock_create.assert_called_once()
+    assert ("root", INFO, "処理済みのイベントを無視: 01H") in caplog.record_tuples
+
+
+def test_lambda_handler_retries_failed_event(mocker: MockerFixture) -> None:
+    event = make_request('{"events":[{"type":"message","webhookEventId":"01H",\
+            "message":{"type":"text","text":"/chatgpt test"},"replyToken":"dummy"}]}')
+    mocker.patch("openai.ChatCompletion")
+    mock_api = mock_line_bot_api(mocker)
+    mock_api.reply_message.side_effect = [
+        LineBotApiError(500, {}, error=Error(message="error", details=[])),
+        None,
+    ]
+
+    assert lambda_handler(event, make_context())["statusCode"] == 500
+    assert lambda_handler(event, make_context())["statusCode"] == 200
+    assert mock_api.reply_message.call_count == 2
+
+
+def test_reply_falls_back_to_push(mocker: MockerFixture) -> None:
+    mock_api = mock_line_bot_api(mocker)
+    mock_api.reply_message.side_effect = LineBotApiError(
+        400, {}, error=Error(message="Invalid reply token")
+    )
+
+    reply_line("dummy", "expired", get_env(), push_to="Cabcde")
+
+    mock_api.push_message.assert_called_once_with(
+        "Cabcde", messages=[TextSendMessage(text="dummy")]
+    )
+
+
+def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) -> None:
+    event = make_request('{"events":[{"type":"message",\
+            "message":{"type":"text","text":"/chatgpt test"},"replyToken":"dummy"}]}')
+
+    mocker.patch("openai.ChatCompletion")
+    mock_line_bot_api(mocker).reply_message.side_effect = LineBotApiError(
+        400,
+        {},
+        error=Error(
+            message="invalid id",
+            details=[ErrorDetail(property="error", message="abcde")],
         ),
     )
 
@@ -100,6 +260,45 @@ def test_line_bot_api_error(mocker: MockerFixture, caplog: LogCaptureFixture) ->
     assert result["statusCode"] == 500
 
 
+def test_lambda_handler_ignored_events(mocker: MockerFixture) -> None:
+    event = make_request('{"events":[\
+            {"type":"message","webhookEventId":"01H",\
+                "message":{"type":"text","text":"こんにちは"}},\
+            {"type":"message","message":{"type":"sticker","packageId":"1"}},\
+            {"type":"follow","source":{"type":"user","userId":"U1"}}\
+        ]}')
+    mock_message = mocker.patch("app.src.lambda_webhook_handler.message")
+    mock_from_json = mocker.patch("linebot.models.Base.new_from_json_dict")
+    mock_dedup = mocker.patch("app.src.lambda_webhook_handler.get_deduplicator")
+
+    result = lambda_handler(event, make_context())
+
+    assert result["statusCode"] == 200
+    mock_message.assert_not_called()
+    mock_from_json.assert_not_called()
+    mock_dedup.assert_not_called()
+
+
+def test_lambda_handler_captures_request(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    path = tmp_path / "corpus.jsonl"
+    monkeypatch.setenv("WEBHOOK_CAPTURE_PATH", str(path))
+    event = make_request(
+        '{"events":[{"type":"message","replyToken":"dummy",'
+        '"message":{"type":"text","text":"こんにちは"}}]}'
+    )
+
+    result = lambda_handler(event, make_context())
+
+    assert result["statusCode"] == 200
+    # 署名と返信トークンを除いて記録する
+    (line,) = path.read_text(encoding="utf-8").splitlines()
+    capture = json.loads(line)
+    assert capture["headers"] == {}
+    assert json.loads(capture["body"])["events"][0]["replyToken"] == "redacted"
+
+
 def test_invalid_signature_error(
     mocker: MockerFixture, caplog: LogCaptureFixture
 ) -> None:
@@ -110,19 +309,20 @@ def test_invalid_signature_error(
         }
     )
 
-    mocker.patch("linebot.WebhookHandler.handle", side_effect=InvalidSignatureError)
-
     result = lambda_handler(event, make_context())
 
     assert ("root", ERROR, "Detected invalid signature") in caplog.record_tuples
     assert result["statusCode"] == 500
 
 
+@mock_s3
 def test_message_no_shrine(mocker: MockerFixture) -> None:
+    setup_mock_s3("[]")
+
     # Twitterへのリクエストをmock
     status_list: List[Status] = []
     mocker.patch(
-        "app.src.lambda_webhook_handler.API",
+        "tweepy.API",
         return_value=mocker.Mock(**{"user_timeline.return_value": status_list}),
     )
 
@@ -134,9 +334,37 @@ def test_message_no_shrine(mocker: MockerFixture) -> None:
     mock_reply_message.reply_message.assert_not_called()
 
 
+@mock_s3
+@pytest.mark.freeze_time(datetime(2022, 2, 22, 13, 0, 0, tzinfo=timezone.utc))
+def test_message_shrine_from_cache(mocker: MockerFixture) -> None:
+    setup_mock_s3("[]")
+    send_message = "今週のシュライン・オブ・シークレットはdummy!"
+    status = Status.parse(
+        None,
+        {
+            "id": 1,
+            "full_text": send_message,
+            "created_at": "Tue Feb 22 00:00:00 +0000 2022",
+        },
+    )
+    # バッチが保存したタイムライン
+    get_timeline_cache(get_env()).update({"DeadbyBHVR_JP": [status]})
+    reset_runtime()
+
+    mock_twitter_api = mocker.patch("tweepy.API")
+    mock_reply_message = mock_line_bot_api(mocker)
+
+    message("今週の聖堂", "dummy", get_env())
+
+    mock_twitter_api.assert_not_called()
+    mock_reply_message.reply_message.assert_called_once_with(
+        "dummy", messages=[TextSendMessage(text=send_message)]
+    )
+
+
 def test_message_openai_call(mocker: MockerFixture) -> None:
     # OPENAIへのリクエストをmock
-    mocker.patch("app.src.lambda_webhook_handler.openai", return_value=mocker.Mock())
+    mocker.patch("openai.ChatCompletion")
 
     # LINEへのリクエストをmock
     mock_reply_message = mock_line_bot_api(mocker)
@@ -146,6 +374,62 @@ def test_message_openai_call(mocker: MockerFixture) -> None:
     mock_reply_message.reply_message.assert_called()
 
 
+def test_message_openai_cached(mocker: MockerFixture) -> None:
+    mock_create = mocker.patch(
+        "openai.ChatCompletion.create",
+        return_value={"choices": [{"message": {"content": "dummy"}}]},
+    )
+    mock_reply_message = mock_line_bot_api(mocker)
+
+    message("/chatgpt おすすめのパークは？", "", get_env())
+    message("/chatgpt  おすすめのパークは?", "", get_env())
+
+    mock_create.assert_called_once()
+    assert mock_reply_message.reply_message.call_count == 2
+
+
+def test_message_openai_with_history(mocker: MockerFixture) -> None:
+    mock_create = mocker.patch(
+        "openai.ChatCompletion.create",
+        side_effect=[
+            {"choices": [{"message": {"content": "バベチリです"}}]},
+            {"choices": [{"message": {"content": "BPが倍になります"}}]},
+        ],
+    )
+    mock_line_bot_api(mocker)
+
+    message("/chatgpt おすすめのパークは？", "", get_env(), "Cabcde")
+    message("/chatgpt その効果は？", "", get_env(), "Cabcde")
+
+    assert mock_create.call_args.kwargs["messages"] == [
+        {"role": "user", "content": "おすすめのパークは？"},
+        {"role": "assistant", "content": "バベチリです"},
+        {"role": "user", "content": "その効果は？"},
+    ]
+
+
+def test_message_openai_cache_is_per_history(mocker: MockerFixture) -> None:
+    mock_create = mocker.patch(
+        "openai.ChatCompletion.create",
+        side_effect=[
+            {"choices": [{"message": {"content": "バベチリです"}}]},
+            {"choices": [{"message": {"content": "BPが倍になるからです"}}]},
+            {"choices": [{"message": {"content": "何の理由ですか？"}}]},
+        ],
+    )
+    mock_line_bot_api(mocker)
+
+    message("/chatgpt おすすめのパークは？", "", get_env(), "Caaa")
+    message("/chatgpt その理由は？", "", get_env(), "Caaa")
+    # 別の送信元には、他の会話を前提にした応答を返さない
+    message("/chatgpt その理由は？", "", get_env(), "Cbbb")
+
+    assert mock_create.call_count == 3
+    assert mock_create.call_args.kwargs["messages"] == [
+        {"role": "user", "content": "その理由は？"}
+    ]
+
+
 def test_message_openai_no_call(mocker: MockerFixture) -> None:
     # LINEへのリクエストをmock
     mock_reply_message = mock_line_bot_api(mocker)
@@ -164,6 +448,36 @@ def test_message_other_text(mocker: MockerFixture) -> None:
     mock_reply_message.reply_message.assert_not_called()
 
 
+def test_message_topic(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setenv("STORAGE", "local")
+    monkeypatch.setenv("STORAGE_DIR", str(tmp_path))
+    mock_reply_message = mock_line_bot_api(mocker)
+
+    def replied() -> str:
+        messages = mock_reply_message.reply_message.call_args.kwargs["messages"]
+        text: str = messages[0].text
+        return text
+
+    assert is_command("/topic コード")
+    message("/topic コード 聖堂 コード", "", get_env(), "Cabcde")
+    assert replied() == "配信するトピック: コード, 聖堂"
+    assert get_subscription_store(get_env()).get("Cabcde") == ["コード", "聖堂"]
+
+    message("/topic", "", get_env(), "Cabcde")
+    assert replied().startswith("配信するトピック: コード, 聖堂\n選べるトピック: ")
+
+    # 知らないトピックでは購読を変えない
+    message("/topic ガチャ", "", get_env(), "Cabcde")
+    assert replied().startswith("知らないトピック: ガチャ\n")
+    assert get_subscription_store(get_env()).get("Cabcde") == ["コード", "聖堂"]
+
+    message("/topic all", "", get_env(), "Cabcde")
+    assert replied() == "全てのツイートを配信します"
+    assert get_subscription_store(get_env()).get("Cabcde") is None
+
+
 def setup_mock_s3(content: str) -> None:
     bucket_name = "test"
     key = "test"
@@ -179,23 +493,37 @@ def setup_mock_s3(content: str) -> None:
 
 @mock_s3
 def test_lambda_handler_join(mocker: MockerFixture) -> None:
-    event = RequestFromLineBot(
-        {
-            "headers": RequestHeadersFromLineBot({"x-line-signature": "dummy"}),
-            "body": '{"events":[{"type":"join","source":{"type":"group","group_id":"abcde"}}]}',
-        }
+    event = make_request(
+        '{"events":[{"type":"join","source":{"type":"group","group_id":"abcde"}}]}'
     )
 
     setup_mock_s3("[]")
 
-    # 署名検証を無効にする
-    mocker.patch("linebot.SignatureValidator.validate", return_value=True)
-
     lambda_handler(event, make_context())
 
-    obj = boto3.resource("s3").Object("test", "test")
+    assert get_subscriber_store(get_env()).members() == ["abcde"]
 
-    assert json.loads(obj.get()["Body"].read()) == ["abcde"]
+
+@mock_s3
+def test_lambda_handler_coalesces_membership_events(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    event = make_request('{"events":[\
+            {"type":"join","source":{"type":"group","groupId":"Cabcde"}},\
+            {"type":"join","source":{"type":"group","groupId":"Cfghij"}},\
+            {"type":"leave","source":{"type":"group","groupId":"Cabcde"}},\
+            {"type":"leave","source":{"type":"room","roomId":"Rklmno"}}\
+        ]}')
+    setup_mock_s3('["Rklmno"]')
+    mock_apply = mocker.spy(S3SubscriberStore, "apply")
+
+    lambda_handler(event, make_context())
+
+    # 1回の書き込みで差分だけを反映する
+    mock_apply.assert_called_once_with(mocker.ANY, ["Cfghij"], ["Cabcde", "Rklmno"])
+    assert ("root", INFO, "参加先id: Cfghij") in caplog.record_tuples
+    assert ("root", INFO, "退室先id: Cabcde") in caplog.record_tuples
+    assert get_subscriber_store(get_env()).members() == ["Cfghij"]
 
 
 @mock_s3
@@ -204,28 +532,22 @@ def test_join_exist_id(caplog: LogCaptureFixture) -> None:
 
     store_id("abcde", get_env())
 
-    assert ("root", INFO, "id重複のため書き込まない") in caplog.record_tuples
+    assert ("root", INFO, "参加先id: abcde") in caplog.record_tuples
+    assert get_subscriber_store(get_env()).members() == ["abcde"]
 
 
 @mock_s3
 def test_lambda_handler_leave(mocker: MockerFixture) -> None:
-    event = RequestFromLineBot(
-        {
-            "headers": RequestHeadersFromLineBot({"X-Line-Signature": "dummy"}),
-            "body": '{"events":[{"type":"leave","source":{"type":"group","group_id":"abcde"}}]}',
-        }
+    event = make_request(
+        '{"events":[{"type":"leave","source":{"type":"group","group_id":"abcde"}}]}',
+        header="X-Line-Signature",
     )
 
     setup_mock_s3('["abcde"]')
 
-    # 署名検証を無効にする
-    mocker.patch("linebot.SignatureValidator.validate", return_value=True)
-
     lambda_handler(event, make_context())
 
-    obj = boto3.resource("s3").Object("test", "test")
-
-    assert json.loads(obj.get()["Body"].read()) == []
+    assert get_subscriber_store(get_env()).members() == []
 
 
 @mock_s3
@@ -234,4 +556,5 @@ def test_leave_no_ids(caplog: LogCaptureFixture) -> None:
 
     delete_id("abcde", get_env())
 
-    assert ("root", INFO, "idが無いため削除しない") in caplog.record_tuples
+    assert ("root", INFO, "退室先id: abcde") in caplog.record_tuples
+    assert get_subscriber_store(get_env()).members() == ["fghij"]
@@ -0,0 +1,41 @@
+import pytest
+from app.src.matcher import KeywordMatcher, get_matcher
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("引き換えコード: dummy", True),
+        ("新しいシャードが登場", True),
+        ("dummy", False),
+        ("", False),
+    ],
+)
+def test_search(text: str, expected: bool) -> None:
+    matcher = KeywordMatcher(["引き換えコード", "シャード"])
+    assert matcher.search(text) is expected
+
+
+def test_matches_overlapping_keywords() -> None:
+    matcher = KeywordMatcher(["コード", "引き換えコード", "引き換え", "BP"])
+
+    result = matcher.matches("引き換えコード: dummy BP")
+
+    assert result == {"コード", "引き換えコード", "引き換え", "BP"}
+
+
+def test_matches_escapes_regex() -> None:
+    matcher = KeywordMatcher(["a.b", "(c)"])
+
+    assert matcher.matches("axb (c)") == {"(c)"}
+
+
+def test_no_keywords() -> None:
+    matcher = KeywordMatcher([])
+
+    assert not matcher.search("dummy")
+    assert matcher.matches("dummy") == set()
+
+
+def test_get_matcher_is_cached() -> None:
+    assert get_matcher(("dummy",)) is get_matcher(("dummy",))
@@ -0,0 +1,114 @@
+import json
+import threading
+from typing import List
+
+import pytest
+from app.src.metrics import Metrics, get_metrics, instrument
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_metrics_timer_and_count() -> None:
+    clock = FakeClock()
+    lines: List[str] = []
+    metrics = Metrics("Batch", clock=clock, now=lambda: 1.5, emit=lines.append)
+
+    # 同じ段階は合計する
+    for elapsed in [0.1, 0.2]:
+        with metrics.timer("TwitterFetch"):
+            clock.now += elapsed
+    metrics.count("PushesSent", 3)
+    metrics.count("PushesSent")
+    metrics.flush()
+
+    assert len(lines) == 1
+    emf = json.loads(lines[0])
+    assert emf["_aws"] == {
+        "Timestamp": 1500,
+        "CloudWatchMetrics": [
+            {
+                "Namespace": "DbdInfoBot",
+                "Dimensions": [["Function"]],
+                "Metrics": [
+                    {"Name": "PushesSent", "Unit": "Count"},
+                    {"Name": "TwitterFetchDuration", "Unit": "Milliseconds"},
+                ],
+            }
+        ],
+    }
+    assert emf["Function"] == "Batch"
+    assert emf["PushesSent"] == 4
+    assert emf["TwitterFetchDuration"] == pytest.approx(300)
+
+
+def test_metrics_flush_skips_empty_and_discarded() -> None:
+    lines: List[str] = []
+    metrics = Metrics("Webhook", emit=lines.append)
+    metrics.flush()
+    metrics.count("Events")
+    metrics.discard()
+    metrics.flush()
+    assert lines == []
+
+
+def test_instrument(capsys: pytest.CaptureFixture[str]) -> None:
+    @instrument("Webhook")
+    def handler() -> str:
+        get_metrics().count("Events", 2)
+        return "ok"
+
+    assert handler() == "ok"
+
+    emf = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert emf["Function"] == "Webhook"
+    assert emf["Events"] == 2
+    assert "InvocationDuration" in emf
+
+
+def test_instrument_flushes_on_exception(capsys: pytest.CaptureFixture[str]) -> None:
+    @instrument("Batch")
+    def handler() -> None:
+        get_metrics().count("Failures")
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        handler()
+
+    emf = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert emf["Failures"] == 1
+
+
+def test_metrics_per_thread(capsys: pytest.CaptureFixture[str]) -> None:
+    started = threading.Barrier(2)
+
+    @instrument("Webhook")
+    def handler(count: int) -> None:
+        get_metrics().count("Events", count)
+        # 両方の実行が始まってから計測を終える
+        started.wait()
+
+    threads = [threading.Thread(target=handler, args=(n,)) for n in [1, 2]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(json.loads(line)["Events"] for line in lines) == [1, 2]
+
+
+def test_instrument_restores_outer_metrics() -> None:
+    outer = get_metrics()
+
+    @instrument("Webhook")
+    def handler() -> Metrics:
+        return get_metrics()
+
+    assert handler() is not outer
+    assert get_metrics() is outer
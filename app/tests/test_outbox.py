@@ -0,0 +1,93 @@
+import json
+from pathlib import Path
+
+import boto3
+from app.src.delivery import Delivery, MessagePayload
+from app.src.env import Env
+from app.src.outbox import (
+    FAILED,
+    PENDING,
+    SENT,
+    BlobOutboxStore,
+    Outbox,
+    get_outbox_store,
+)
+from app.src.storage import FileBlobStore, S3BlobStore, SqliteBlobStore
+from linebot.models import TextSendMessage
+from moto import mock_s3
+
+
+def make_outbox() -> Outbox:
+    payload = MessagePayload.from_messages([TextSendMessage(text="引き換えコード")])
+    deliveries = [
+        Delivery(["U1", "U2"], payload, multicast=True),
+        Delivery(["Cabcde"], payload, multicast=False),
+    ]
+    return Outbox.from_deliveries(deliveries)
+
+
+def test_entry_round_trip() -> None:
+    payload = MessagePayload.from_messages([TextSendMessage(text="dummy")])
+    delivery = Delivery(["U1"], payload, multicast=True)
+
+    outbox = Outbox.from_deliveries([delivery])
+
+    assert outbox.to_delivery(outbox.entries[0]) == delivery
+
+
+def test_payload_stored_once() -> None:
+    outbox = make_outbox()
+
+    assert len(outbox.payloads) == 1
+    body = json.loads(outbox.dumps())
+    assert body["payloads"] == [[{"type": "text", "text": "引き換えコード"}]]
+    assert [entry["payload"] for entry in body["entries"]] == [0, 0]
+
+
+def test_pending() -> None:
+    outbox = make_outbox()
+    outbox.entries[0].state = SENT
+
+    assert outbox.pending() == [outbox.entries[1]]
+
+
+def test_dumps_and_loads() -> None:
+    outbox = make_outbox()
+    outbox.entries[1].state = FAILED
+
+    assert Outbox.loads(outbox.dumps()) == outbox
+
+
+def test_blob_outbox_store(tmp_path: Path) -> None:
+    store = BlobOutboxStore(FileBlobStore(str(tmp_path)), "test.outbox.json")
+    outbox = make_outbox()
+
+    assert store.load() is None
+    store.save(outbox)
+    assert store.load() == outbox
+    store.clear()
+    assert store.load() is None
+
+
+@mock_s3
+def test_s3_outbox_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = BlobOutboxStore(S3BlobStore("test"), "test.outbox.json")
+    outbox = make_outbox()
+
+    assert store.load() is None
+    store.save(outbox)
+    loaded = store.load()
+    assert loaded == outbox
+    assert loaded is not None and loaded.entries[0].state == PENDING
+    store.clear()
+    assert store.load() is None
+
+
+def test_get_outbox_store(tmp_path: Path) -> None:
+    env = Env(S3_KEY_NAME="test", STORAGE="sqlite", STORAGE_DIR=str(tmp_path))
+    store = get_outbox_store(env, "r-0")
+
+    assert isinstance(store, BlobOutboxStore)
+    assert isinstance(store.blobs, SqliteBlobStore)
+    assert store.key == "test.outbox.r-0.json"
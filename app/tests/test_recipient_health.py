@@ -0,0 +1,104 @@
+import boto3
+from app.src.env import Env
+from app.src.outbox import FAILED, PENDING, SENT, OutboxEntry
+from app.src.recipient_health import (
+    QUARANTINE_PERIOD,
+    QUARANTINE_THRESHOLD,
+    HealthState,
+    PrunedRecipient,
+    RecipientHealth,
+    load_health,
+    recipient_outcomes,
+    save_health,
+)
+from moto import mock_s3
+
+ENV = Env(S3_BUCKET_NAME="test", S3_KEY_NAME="test")
+
+
+def test_quarantine_then_prune() -> None:
+    health = HealthState()
+
+    for i in range(QUARANTINE_THRESHOLD - 1):
+        assert health.record("C1", 404, float(i)) is None
+        assert health.should_deliver("C1", float(i))
+
+    # 失敗が続いたら配信を止める
+    now = 100.0
+    assert health.record("C1", 404, now) is None
+    assert not health.should_deliver("C1", now)
+    assert not health.should_deliver("C1", now + QUARANTINE_PERIOD - 1)
+
+    # 期間が過ぎたらもう一度送り、それでも失敗したら削除する
+    later = now + QUARANTINE_PERIOD
+    assert health.should_deliver("C1", later)
+    pruned = health.record("C1", 403, later)
+    assert pruned == PrunedRecipient("C1", QUARANTINE_THRESHOLD + 1, 403, now, later)
+    assert health.pruned == [pruned]
+    assert "C1" not in health.recipients
+
+
+def test_success_and_transient_errors_do_not_count() -> None:
+    health = HealthState()
+    health.record("C1", 404, 0.0)
+    health.record("C1", 429, 1.0)
+    health.record("C1", 500, 2.0)
+    assert health.recipients["C1"].failures == 1
+    assert health.recipients["C1"].last_error == 500
+
+    # 成功したら記録を消す
+    health.record("C1", None, 3.0)
+    assert health.recipients == {}
+
+    # 一時的なエラーだけなら記録しない
+    health.record("C2", 500, 4.0)
+    assert health.recipients == {}
+
+
+def test_retain() -> None:
+    health = HealthState(
+        recipients={"C1": RecipientHealth(1), "C2": RecipientHealth(1)}
+    )
+    assert health.retain(["C1", "C3"])
+    assert list(health.recipients) == ["C1"]
+    assert not health.retain(["C1"])
+
+
+def test_recipient_outcomes() -> None:
+    entries = [
+        OutboxEntry(["U1", "U2"], 0, True, "k", FAILED, 400),
+        OutboxEntry(["C1"], 0, False, "k", FAILED, 404),
+        OutboxEntry(["C1"], 1, False, "k", SENT),
+        OutboxEntry(["C2"], 0, False, "k", FAILED, 403),
+        OutboxEntry(["C3"], 0, False, "k", PENDING),
+    ]
+
+    # multicastと未配信は数えず、1件でも成功した宛先は成功とする
+    assert recipient_outcomes(entries) == {"C1": None, "C2": 403}
+
+
+def test_recipient_outcomes_ignores_payload_errors() -> None:
+    entries = [
+        OutboxEntry(["C1"], 0, False, "k", FAILED, 400),
+        OutboxEntry(["C2"], 0, False, "k", FAILED, 400),
+        OutboxEntry(["C3"], 0, False, "k", FAILED, 404),
+        OutboxEntry(["C4"], 1, False, "k", FAILED, 400),
+    ]
+
+    # 同じメッセージの大半が同じエラーならメッセージの問題として宛先には数えない。
+    # 宛先が1つだけのメッセージは宛先の失敗として数える
+    assert recipient_outcomes(entries) == {"C3": 404, "C4": 400}
+
+
+@mock_s3
+def test_load_and_save_health() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    assert load_health(ENV) == HealthState()
+
+    health = HealthState(
+        recipients={"C1": RecipientHealth(2, 404, 1.0)},
+        pruned=[PrunedRecipient("C2", 4, 403, 1.0, 2.0)],
+    )
+    save_health(ENV, health)
+
+    assert load_health(ENV) == health
@@ -0,0 +1,75 @@
+import os
+
+from app.src.env import Env
+from app.src.http_client import PooledHttpClient
+from app.src.runtime import Runtime, get_runtime, reset_runtime
+from pytest_mock import MockerFixture
+
+
+def test_env_is_loaded_once(mocker: MockerFixture) -> None:
+    mock_get_env = mocker.patch("app.src.runtime.get_env", return_value=Env())
+    runtime = Runtime()
+
+    runtime.env
+    runtime.env
+
+    assert mock_get_env.call_count == 1
+
+
+def test_env_is_refreshed_after_ttl(mocker: MockerFixture) -> None:
+    mock_get_env = mocker.patch("app.src.runtime.get_env", return_value=Env())
+    now = [0.0]
+    runtime = Runtime(secrets_ttl=60, clock=lambda: now[0])
+
+    runtime.env
+    now[0] = 59
+    runtime.env
+    assert mock_get_env.call_count == 1
+
+    now[0] = 60
+    runtime.env
+    assert mock_get_env.call_count == 2
+
+
+def test_client_is_cached_by_key(mocker: MockerFixture) -> None:
+    factory = mocker.Mock(side_effect=lambda: object())
+    runtime = Runtime()
+
+    a = runtime.client(("line", "token_a"), factory)
+    assert runtime.client(("line", "token_a"), factory) is a
+    assert runtime.client(("line", "token_b"), factory) is not a
+    assert factory.call_count == 2
+
+
+def test_get_does_not_create_client() -> None:
+    runtime = Runtime()
+
+    assert runtime.get("queue") is None
+    queue = runtime.client("queue", lambda: object())
+    assert runtime.get("queue") is queue
+
+
+def test_get_runtime_is_shared() -> None:
+    os.environ["SECRETS_TTL"] = "300"
+    runtime = get_runtime()
+    del os.environ["SECRETS_TTL"]
+
+    assert get_runtime() is runtime
+    assert runtime.secrets_ttl == 300
+    reset_runtime()
+    assert get_runtime() is not runtime
+
+
+def test_pooled_http_client_reuses_session(mocker: MockerFixture) -> None:
+    client = PooledHttpClient(timeout=5)
+    mock_request = mocker.patch.object(client.session, "request")
+
+    client.post("https://api.line.me/v2/bot/message/push", data="{}")
+    client.get("https://api.line.me/v2/bot/info", timeout=1)
+
+    assert mock_request.mock_calls[0].args == (
+        "POST",
+        "https://api.line.me/v2/bot/message/push",
+    )
+    assert mock_request.mock_calls[0].kwargs["timeout"] == 5
+    assert mock_request.mock_calls[1].kwargs["timeout"] == 1
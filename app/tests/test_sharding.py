@@ -0,0 +1,139 @@
+import json
+import os
+from logging import ERROR
+from typing import Any, List
+
+import boto3
+from _pytest.logging import LogCaptureFixture
+from app.src.delivery import Delivery, MessagePayload
+from app.src.env import get_env
+from app.src.outbox import FAILED, PENDING, SENT, Outbox, get_outbox_store
+from app.src.sharding import (
+    MAX_SHARDS,
+    LambdaShardDispatcher,
+    LocalShardDispatcher,
+    ShardResult,
+    get_shard_result_store,
+    partition,
+)
+from linebot.models import TextSendMessage
+from moto import mock_s3
+from pytest_mock import MockerFixture
+
+
+def make_outbox(n: int) -> Outbox:
+    payload = MessagePayload.from_messages([TextSendMessage(text="dummy")])
+    return Outbox.from_deliveries(
+        [Delivery([f"C{i}"], payload, multicast=False) for i in range(n)]
+    )
+
+
+def mark_sent(
+    shard: str, outbox: Outbox, remaining_ms: int, rate_share: float
+) -> ShardResult:
+    return ShardResult(shard, [SENT] * len(outbox.entries))
+
+
+def crash(shard: str, outbox: Outbox, remaining_ms: int, rate_share: float) -> Any:
+    raise RuntimeError(shard)
+
+
+def test_partition() -> None:
+    outbox = make_outbox(6)
+    outbox.entries[0].state = SENT
+
+    # 未配信分だけを分ける
+    shards = partition(outbox, 2)
+    assert [[e.to[0] for e in shard.entries] for shard in shards] == [
+        ["C1"],
+        ["C2", "C3"],
+        ["C4", "C5"],
+    ]
+    # メッセージは共有する
+    assert all(shard.payloads is outbox.payloads for shard in shards)
+
+    assert len(partition(outbox, 10)) == 1
+    assert len(partition(make_outbox(MAX_SHARDS * 2 + 1), 1)) == MAX_SHARDS
+
+
+def test_shard_result() -> None:
+    result = ShardResult("r-0", [SENT, SENT, FAILED, PENDING], [None, None, 404, None])
+    assert (result.sent, result.failed, result.pending) == (2, 1, 1)
+    assert ShardResult.loads(result.dumps()) == result
+
+    # コーディネーターのジャーナルに書き戻す
+    outbox = make_outbox(4)
+    result.apply(outbox)
+    assert ShardResult.from_outbox("r-0", outbox) == result
+
+
+def test_local_shard_dispatcher(caplog: LogCaptureFixture) -> None:
+    shards = {"r-0": make_outbox(2), "r-1": make_outbox(3)}
+    dispatcher = LocalShardDispatcher(mark_sent)
+    dispatcher.start(shards, 300000)
+    results = dispatcher.wait(shards, lambda: 300000)
+    assert results == {
+        "r-0": ShardResult("r-0", [SENT] * 2),
+        "r-1": ShardResult("r-1", [SENT] * 3),
+    }
+
+    # 落ちたワーカーは結果が無い
+    dispatcher = LocalShardDispatcher(crash)
+    dispatcher.start(shards, 300000)
+    assert dispatcher.wait(shards, lambda: 300000) == {}
+    assert ("root", ERROR, "Shard r-0 failed") in caplog.record_tuples
+
+
+@mock_s3
+def test_lambda_shard_dispatcher(mocker: MockerFixture) -> None:
+    boto3.resource("s3").Bucket("test").create()
+    os.environ["S3_BUCKET_NAME"] = "test"
+    os.environ["S3_KEY_NAME"] = "test"
+    env = get_env()
+    mock_client = mocker.Mock()
+    mocker.patch("app.src.sharding.boto3.client", return_value=mock_client)
+    sleeps: List[float] = []
+
+    shards = {"r-0": make_outbox(2), "r-1": make_outbox(3)}
+    dispatcher = LambdaShardDispatcher(env, "arn", 30000, sleep=sleeps.append)
+    dispatcher.start(shards, 300000)
+
+    # ワーカーごとのジャーナルを保存して非同期に呼び出す
+    assert get_outbox_store(env, "r-1").load() == shards["r-1"]
+    payloads = [json.loads(c.kwargs["Payload"]) for c in mock_client.invoke.mock_calls]
+    assert payloads == [{"shard": "r-0", "shards": 2}, {"shard": "r-1", "shards": 2}]
+
+    # 時間切れまでに報告したシャードだけを集める
+    store = get_shard_result_store(env)
+    store.put(ShardResult("r-0", [SENT, FAILED]))
+    remaining = iter([60000, 0])
+    results = dispatcher.wait(shards, lambda: next(remaining))
+    assert results == {"r-0": ShardResult("r-0", [SENT, FAILED])}
+    assert len(sleeps) == 1
+    assert store.load("r-0") is None
+    # 待つのをやめたシャードのワーカーには、結果を引き取る相手がいないと伝わる
+    assert not store.put(ShardResult("r-1", [SENT] * 3))
+    assert store.blobs.get("test.shards/r-1.json") is None
+
+
+@mock_s3
+def test_lambda_shard_dispatcher_late_result(mocker: MockerFixture) -> None:
+    boto3.resource("s3").Bucket("test").create()
+    os.environ["S3_BUCKET_NAME"] = "test"
+    os.environ["S3_KEY_NAME"] = "test"
+    env = get_env()
+    mocker.patch("app.src.sharding.boto3.client")
+    shards = {"r-0": make_outbox(2)}
+    dispatcher = LambdaShardDispatcher(env, "arn", 30000, sleep=lambda _: None)
+    dispatcher.start(shards, 300000)
+    store = get_shard_result_store(env)
+
+    def remaining_ms() -> int:
+        # 時間切れと判断した直後に結果が届く
+        store.put(ShardResult("r-0", [SENT, SENT]))
+        return 0
+
+    assert dispatcher.wait(shards, remaining_ms) == {
+        "r-0": ShardResult("r-0", [SENT, SENT])
+    }
+    assert store.load("r-0") is None
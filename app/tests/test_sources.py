@@ -0,0 +1,44 @@
+import json
+import os
+from pathlib import Path
+
+from app.src.sources import Source, load_sources
+
+
+def test_load_sources_default() -> None:
+    sources = load_sources()
+
+    assert [source.screen_name for source in sources] == ["DeadbyBHVR_JP", "Ruby_Nea_"]
+    assert sources[1] == Source(
+        screen_name="Ruby_Nea_", keywords=("引き換えコード", "コード")
+    )
+
+
+def test_load_sources_from_path(tmp_path: Path) -> None:
+    path = tmp_path / "sources.json"
+    config = [
+        {
+            "screen_name": "dummy",
+            "keywords": ["test"],
+            "count": 50,
+            "include_rts": True,
+            "exclude_replies": True,
+            "timeout": 3,
+        }
+    ]
+    path.write_text(json.dumps(config))
+    os.environ["SOURCES_PATH"] = str(path)
+
+    sources = load_sources()
+    del os.environ["SOURCES_PATH"]
+
+    assert sources == [
+        Source(
+            screen_name="dummy",
+            keywords=("test",),
+            count=50,
+            include_rts=True,
+            exclude_replies=True,
+            timeout=3,
+        )
+    ]
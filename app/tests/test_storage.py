@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import boto3
+import pytest
+from app.src.env import Env
+from app.src.storage import (
+    BlobStore,
+    FileBlobStore,
+    S3BlobStore,
+    SqliteBlobStore,
+    get_blob_store,
+)
+from app.src.subscriber_store import SqliteSubscriberStore, get_subscriber_store
+from moto import mock_s3
+
+
+def check_blob_store(store: BlobStore) -> None:
+    assert store.get("test.state.json") is None
+
+    store.put("test.state.json", b"{}")
+    store.put("test.shards/run-0.json", b"[1]")
+    store.put("test.state.json", b'{"a": 1}')
+    assert store.get("test.state.json") == b'{"a": 1}'
+    assert store.get("test.shards/run-0.json") == b"[1]"
+
+    store.delete("test.shards/run-0.json")
+    store.delete("test.shards/run-0.json")
+    assert store.get("test.shards/run-0.json") is None
+
+    # 既にあれば書き込まない
+    assert not store.create("test.state.json", b"{}")
+    assert store.get("test.state.json") == b'{"a": 1}'
+    assert store.create("test.events/01H", b"1")
+    assert store.get("test.events/01H") == b"1"
+
+
+@mock_s3
+def test_s3_blob_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    check_blob_store(S3BlobStore("test"))
+
+
+def test_file_blob_store(tmp_path: Path) -> None:
+    check_blob_store(FileBlobStore(str(tmp_path)))
+    assert (tmp_path / "test.state.json").read_bytes() == b'{"a": 1}'
+
+
+def test_sqlite_blob_store(tmp_path: Path) -> None:
+    check_blob_store(SqliteBlobStore(str(tmp_path / "storage.db")))
+
+
+@pytest.mark.parametrize(
+    "storage, expected",
+    [("s3", S3BlobStore), ("local", FileBlobStore), ("sqlite", SqliteBlobStore)],
+)
+def test_get_blob_store(storage: str, expected: type, tmp_path: Path) -> None:
+    env = Env(S3_BUCKET_NAME="test", STORAGE=storage, STORAGE_DIR=str(tmp_path))
+    assert isinstance(get_blob_store(env), expected)
+    assert get_blob_store(env) is get_blob_store(env)
+
+
+def test_sqlite_shares_one_database(tmp_path: Path) -> None:
+    # SQLiteを選んだ時は全ての保存先を1つのデータベースに置く
+    env = Env(STORAGE="sqlite", STORAGE_DIR=str(tmp_path / "storage"))
+    blobs = get_blob_store(env)
+    store = get_subscriber_store(env)
+
+    assert isinstance(blobs, SqliteBlobStore) and isinstance(
+        store, SqliteSubscriberStore
+    )
+    assert store.path == blobs.path == str(tmp_path / "storage/storage.db")
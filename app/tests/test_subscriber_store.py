@@ -0,0 +1,148 @@
+import json
+from datetime import timedelta
+from pathlib import Path
+from typing import List
+
+import boto3
+import pytest
+from app.src.env import Env
+from app.src.storage import FileBlobStore
+from app.src.subscriber_store import (
+    BlobSubscriberStore,
+    ConcurrentUpdateError,
+    S3SubscriberStore,
+    SqliteSubscriberStore,
+    get_subscriber_store,
+)
+from moto import mock_s3
+from pytest_mock import MockerFixture
+
+
+def setup_mock_s3(content: str) -> None:
+    s3 = boto3.resource("s3")
+    s3.Bucket("test").create()
+    s3.Object("test", "test").put(Body=content.encode("utf-8"))
+
+
+def list_log_keys() -> List[str]:
+    bucket = boto3.resource("s3").Bucket("test")
+    return [obj.key for obj in bucket.objects.filter(Prefix="test.log/")]
+
+
+@mock_s3
+def test_s3_store_concurrent_updates() -> None:
+    setup_mock_s3('["abcde"]')
+    # 同じスナップショットを読んだ2つの実行から更新しても両方残る
+    store_a = S3SubscriberStore("test", "test")
+    store_b = S3SubscriberStore("test", "test")
+
+    store_a.add("fghij")
+    store_b.add("klmno")
+    store_b.add("abcde")
+    store_a.remove("abcde")
+
+    assert S3SubscriberStore("test", "test").members() == ["fghij", "klmno"]
+
+
+@mock_s3
+def test_s3_store_without_snapshot() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = S3SubscriberStore("test", "test")
+
+    store.add("abcde")
+
+    assert store.members() == ["abcde"]
+
+
+@mock_s3
+def test_s3_store_compact(mocker: MockerFixture) -> None:
+    setup_mock_s3('["abcde"]')
+    mocker.patch("app.src.subscriber_store.LOG_SETTLE_NS", 0)
+    store = S3SubscriberStore("test", "test")
+    store.add("fghij")
+    store.remove("abcde")
+    watermark = list_log_keys()[-1]
+
+    store.compact()
+    store.add("klmno")
+
+    obj = boto3.resource("s3").Object("test", "test").get()
+    assert json.loads(obj["Body"].read()) == ["fghij"]
+    assert obj["Metadata"] == {"log-watermark": watermark}
+    assert store.members() == ["fghij", "klmno"]
+
+
+@mock_s3
+def test_s3_store_compact_skips_unsettled_logs() -> None:
+    setup_mock_s3('["abcde"]')
+    store = S3SubscriberStore("test", "test")
+    store.add("fghij")
+
+    store.compact()
+
+    obj = boto3.resource("s3").Object("test", "test").get()
+    assert json.loads(obj["Body"].read()) == ["abcde"]
+    assert store.members() == ["abcde", "fghij"]
+
+
+@mock_s3
+def test_s3_store_compact_expires_old_logs(mocker: MockerFixture) -> None:
+    setup_mock_s3("[]")
+    mocker.patch("app.src.subscriber_store.LOG_SETTLE_NS", 0)
+    mocker.patch("app.src.subscriber_store.LOG_RETENTION", timedelta(hours=-1))
+    store = S3SubscriberStore("test", "test")
+    store.add("abcde")
+
+    store.compact()
+
+    assert list_log_keys() == []
+    assert store.members() == ["abcde"]
+
+
+@mock_s3
+def test_s3_store_compact_conflict(mocker: MockerFixture) -> None:
+    setup_mock_s3("[]")
+    mocker.patch("app.src.subscriber_store.LOG_SETTLE_NS", 0)
+    store = S3SubscriberStore("test", "test")
+    store.add("abcde")
+    # 読み込み後にスナップショットが書き換えられ続ける
+    mocker.patch.object(
+        store, "_write_snapshot", side_effect=ConcurrentUpdateError("dummy")
+    )
+
+    with pytest.raises(ConcurrentUpdateError):
+        store.compact()
+
+    assert store._write_snapshot.call_count == 3  # type: ignore
+
+
+def test_sqlite_store(tmp_path: Path) -> None:
+    store = SqliteSubscriberStore(str(tmp_path / "subscribers.db"))
+
+    store.add("abcde")
+    store.add("fghij")
+    store.add("abcde")
+    store.remove("klmno")
+    store.remove("abcde")
+
+    assert store.members() == ["fghij"]
+
+
+def test_blob_store(tmp_path: Path) -> None:
+    store = BlobSubscriberStore(FileBlobStore(str(tmp_path)), "test")
+
+    store.apply(["abcde", "fghij", "abcde"], [])
+    store.apply(["klmno"], ["abcde"])
+
+    assert store.members() == ["fghij", "klmno"]
+    # S3のスナップショットと同じ形式で保存する
+    assert json.loads((tmp_path / "test").read_text()) == ["fghij", "klmno"]
+
+
+@pytest.mark.parametrize(
+    "storage, expected",
+    [("local", BlobSubscriberStore), ("sqlite", SqliteSubscriberStore)],
+)
+def test_get_subscriber_store(storage: str, expected: type, tmp_path: Path) -> None:
+    env = Env(S3_KEY_NAME="test", STORAGE=storage, STORAGE_DIR=str(tmp_path))
+    assert isinstance(get_subscriber_store(env), expected)
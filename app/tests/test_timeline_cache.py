@@ -0,0 +1,145 @@
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+import boto3
+import pytest
+from app.src.env import Env
+from app.src.storage import FileBlobStore, S3BlobStore
+from app.src.timeline_cache import (
+    BlobSnapshotStore,
+    SnapshotStore,
+    TimelineCache,
+    get_timeline_cache,
+    next_shrine_reset,
+)
+from moto import mock_s3
+from tweepy.models import Status
+
+SHRINE = "今週のシュライン・オブ・シークレットはdummy!"
+
+
+def make_status(id: int, full_text: str, created_at: str) -> Status:
+    return Status.parse(
+        None, {"id": id, "full_text": full_text, "created_at": created_at}
+    )
+
+
+class MemoryStore(SnapshotStore):
+    def __init__(self) -> None:
+        self.snapshot: Any = None
+        self.loads = 0
+
+    def load(self) -> Any:
+        self.loads += 1
+        return self.snapshot
+
+    def save(self, snapshot: Dict[str, Any]) -> None:
+        self.snapshot = snapshot
+
+
+@pytest.mark.parametrize(
+    "after, expected",
+    [
+        # 月曜 -> 翌日の火曜
+        (datetime(2022, 2, 21, 23, 0), datetime(2022, 2, 22)),
+        # 火曜 0:00ちょうど -> 翌週の火曜
+        (datetime(2022, 2, 22, 0, 0), datetime(2022, 3, 1)),
+        (datetime(2022, 2, 24, 12, 0), datetime(2022, 3, 1)),
+    ],
+)
+def test_next_shrine_reset(after: datetime, expected: datetime) -> None:
+    assert next_shrine_reset(after.replace(tzinfo=timezone.utc)) == expected.replace(
+        tzinfo=timezone.utc
+    )
+
+
+def test_shrine_is_served_from_memory() -> None:
+    store = MemoryStore()
+    now = datetime(2022, 2, 23, tzinfo=timezone.utc)
+    TimelineCache(store, now=lambda: now).update(
+        {"DeadbyBHVR_JP": [make_status(1, SHRINE, "Tue Feb 22 00:00:00 +0000 2022")]}
+    )
+    store.loads = 0
+    cache = TimelineCache(store, now=lambda: now)
+
+    assert cache.shrine() == SHRINE
+    assert cache.shrine() == SHRINE
+    assert store.loads == 1
+
+
+def test_shrine_expires_at_weekly_reset() -> None:
+    store = MemoryStore()
+    now = [datetime(2022, 2, 28, 23, 59, tzinfo=timezone.utc)]
+    clock = [0.0]
+    cache = TimelineCache(store, clock=lambda: clock[0], now=lambda: now[0])
+    cache.update(
+        {"DeadbyBHVR_JP": [make_status(1, SHRINE, "Tue Feb 22 00:00:00 +0000 2022")]}
+    )
+    assert cache.shrine() == SHRINE
+
+    # 3/1 (火) 0:00に入れ替わる
+    now[0] = datetime(2022, 3, 1, tzinfo=timezone.utc)
+    clock[0] = 60
+    assert cache.shrine() is None
+
+
+def test_update_merges_timeline() -> None:
+    store = MemoryStore()
+    cache = TimelineCache(store)
+    created_at = "Tue Feb 22 00:00:00 +0000 2022"
+    cache.update({"Ruby_Nea_": [make_status(1, "a", created_at)]})
+
+    cache.update(
+        {
+            "Ruby_Nea_": [
+                make_status(3, "c", created_at),
+                make_status(2, "b", created_at),
+            ],
+            "DeadbyBHVR_JP": [],
+        }
+    )
+
+    timeline: List[Dict[str, Any]] = cache.timeline("Ruby_Nea_")
+    assert [status["id"] for status in timeline] == [3, 2, 1]
+    assert cache.timeline("DeadbyBHVR_JP") == []
+
+
+def test_put_shrine_keeps_newer() -> None:
+    store = MemoryStore()
+    now = datetime(2022, 2, 23, tzinfo=timezone.utc)
+    cache = TimelineCache(store, now=lambda: now)
+    cache.put_shrine(make_status(2, SHRINE, "Tue Feb 22 00:00:00 +0000 2022"))
+
+    cache.put_shrine(
+        make_status(1, "先週の" + SHRINE, "Tue Feb 15 00:00:00 +0000 2022")
+    )
+
+    assert store.snapshot["shrine"]["id"] == 2
+    assert cache.shrine() == SHRINE
+
+
+def test_blob_snapshot_store(tmp_path: Path) -> None:
+    store = BlobSnapshotStore(FileBlobStore(str(tmp_path)), "test.timeline.json")
+
+    assert store.load() is None
+    store.save({"timelines": {}, "shrine": None})
+    assert store.load() == {"timelines": {}, "shrine": None}
+
+
+@mock_s3
+def test_s3_snapshot_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = BlobSnapshotStore(S3BlobStore("test"), "test.timeline.json")
+
+    assert store.load() is None
+    store.save({"timelines": {}, "shrine": None})
+    assert store.load() == {"timelines": {}, "shrine": None}
+
+
+def test_get_timeline_cache_is_reused(tmp_path: Path) -> None:
+    env = Env(STORAGE="local", STORAGE_DIR=str(tmp_path))
+    cache = get_timeline_cache(env)
+
+    assert isinstance(cache.store, BlobSnapshotStore)
+    assert get_timeline_cache(env) is cache
@@ -0,0 +1,138 @@
+import json
+import os
+from logging import ERROR
+from pathlib import Path
+
+import boto3
+import pytest
+from _pytest.logging import LogCaptureFixture
+from app.src.storage import SqliteBlobStore
+from app.src.topics import (
+    DEFAULT_TOPICS_PATH,
+    BlobSubscriptionStore,
+    FileTopicConfig,
+    S3SubscriptionStore,
+    S3TopicConfig,
+    Topic,
+    TopicIndex,
+    load_topics,
+    parse_topics,
+)
+from moto import mock_s3
+from pytest_mock import MockerFixture
+
+TOPICS = [
+    Topic("コード", ("引き換えコード", "コード")),
+    Topic("聖堂", ("シュライン・オブ・シークレット",)),
+]
+
+
+def test_parse_topics() -> None:
+    assert parse_topics([{"name": "BP", "keywords": ["BP"]}]) == [Topic("BP", ("BP",))]
+    assert load_topics(DEFAULT_TOPICS_PATH)
+    assert parse_topics(
+        [{"name": "BP", "keywords": ["BP"], "high_priority": True}]
+    ) == [Topic("BP", ("BP",), high_priority=True)]
+
+    with pytest.raises(ValueError):
+        parse_topics([{"name": "BP", "keywords": ["BP"]}] * 2)
+    with pytest.raises(ValueError):
+        parse_topics([{"name": "BP", "keywords": []}])
+
+
+def test_topic_index_audiences() -> None:
+    subscriptions = {
+        "C2": ["コード"],
+        "C3": ["聖堂", "コード"],
+        # 無くなったトピックだけを選んでいたら全て配信する
+        "U1": ["消えたトピック"],
+    }
+    index = TopicIndex(TOPICS, ["C1", "C2", "C3", "U1"], subscriptions)
+    texts = [
+        "引き換えコード: DUMMY",
+        "今週のシュライン・オブ・シークレット",
+        "メンテナンスのお知らせ",
+    ]
+
+    assert index.topics_of(texts[0]) == ["コード"]
+    assert not index.is_high_priority(texts[0])
+    assert index.recipients == {"コード": ["C2", "C3"], "聖堂": ["C3"]}
+    assert index.audiences(texts) == [
+        ([0, 1, 2], ["C1", "U1"]),
+        ([0], ["C2"]),
+        ([0, 1], ["C3"]),
+    ]
+    assert index.audiences([]) == []
+
+
+def test_topic_index_merges_same_audience() -> None:
+    # 全てのツイートを受け取る送信元は、トピックを選んでいなくても同じ配信にまとめる
+    index = TopicIndex(TOPICS, ["C1", "C2"], {"C2": ["コード"]})
+    assert index.audiences(["引き換えコード: DUMMY"]) == [([0], ["C1", "C2"])]
+
+
+def test_file_topic_config_reloads(tmp_path: Path) -> None:
+    path = tmp_path / "topics.json"
+    path.write_text(json.dumps([{"name": "BP", "keywords": ["BP"]}]))
+    config = FileTopicConfig(str(path))
+    assert [t.name for t in config.topics()] == ["BP"]
+
+    path.write_text(json.dumps([{"name": "聖堂", "keywords": ["シュライン"]}]))
+    os.utime(path, ns=(0, 1))
+    assert [t.name for t in config.topics()] == ["聖堂"]
+
+
+@mock_s3
+def test_s3_topic_config_revalidates(
+    mocker: MockerFixture, caplog: LogCaptureFixture
+) -> None:
+    s3 = boto3.resource("s3")
+    s3.Bucket("test").create()
+    config = S3TopicConfig("test", "test.topics.json")
+
+    # 設定が無ければ同梱の設定を使う
+    assert config.topics() == load_topics(DEFAULT_TOPICS_PATH)
+
+    obj = s3.Object("test", "test.topics.json")
+    obj.put(Body=json.dumps([{"name": "BP", "keywords": ["BP"]}]).encode())
+    assert [t.name for t in config.topics()] == ["BP"]
+
+    # 変わっていなければ読み直さない
+    spy = mocker.spy(config.obj, "get")
+    assert [t.name for t in config.topics()] == ["BP"]
+    assert spy.call_args.kwargs == {"IfNoneMatch": config.etag}
+
+    # 壊れた設定は使わない
+    obj.put(Body=b"[{}]")
+    assert [t.name for t in config.topics()] == ["BP"]
+    assert caplog.record_tuples[-1] == (
+        "root",
+        ERROR,
+        "Invalid topic config: test.topics.json",
+    )
+
+
+@mock_s3
+def test_s3_subscription_store() -> None:
+    boto3.resource("s3").Bucket("test").create()
+    store = S3SubscriptionStore("test", "test.subscriptions.json")
+    assert store.load() == {}
+
+    store.set("C1", ["コード"])
+    store.set("C2", ["聖堂"])
+    store.set("C1", None)
+
+    assert S3SubscriptionStore("test", "test.subscriptions.json").load() == {
+        "C2": ["聖堂"]
+    }
+    assert store.get("C1") is None
+
+
+def test_blob_subscription_store(tmp_path: Path) -> None:
+    blobs = SqliteBlobStore(str(tmp_path / "storage.db"))
+    store = BlobSubscriptionStore(blobs, "test.subscriptions.json")
+    store.set("C1", ["コード", "聖堂"])
+
+    assert store.get("C1") == ["コード", "聖堂"]
+    store.set("C1", None)
+    assert store.load() == {}
@@ -1,6 +1,12 @@
 import { Stack, StackProps, Duration } from "aws-cdk-lib";
 import { Construct } from "constructs";
-import { ManagedPolicy, Role, ServicePrincipal } from "aws-cdk-lib/aws-iam";
+import {
+  ManagedPolicy,
+  Policy,
+  PolicyStatement,
+  Role,
+  ServicePrincipal,
+} from "aws-cdk-lib/aws-iam";
 import {
   Function,
   Code,
@@ -13,7 +19,13 @@ import { Asset } from "aws-cdk-lib/aws-s3-assets";
 import { StringParameter } from "aws-cdk-lib/aws-ssm";
 import { Topic } from "aws-cdk-lib/aws-sns";
 import { EmailSubscription } from "aws-cdk-lib/aws-sns-subscriptions";
-import { Alarm, ComparisonOperator } from "aws-cdk-lib/aws-cloudwatch";
+import {
+  Alarm,
+  ComparisonOperator,
+  Dashboard,
+  GraphWidget,
+  Metric,
+} from "aws-cdk-lib/aws-cloudwatch";
 import { SnsAction } from "aws-cdk-lib/aws-cloudwatch-actions";
 import { join } from "path";
 
@@ -72,7 +84,8 @@ export class CdkStack extends Stack {
       ),
       runtime: Runtime.PYTHON_3_9,
       handler: "src/lambda_webhook_handler.lambda_handler",
-      environment: lambdaEnv,
+      // イベントは自身の非同期実行で処理し、Webhookにはすぐ応答する
+      environment: { ...lambdaEnv, WEBHOOK_ASYNC: "true" },
       role: iamRoleForLambda,
       timeout: Duration.minutes(5),
       logRetention: RetentionDays.TWO_MONTHS,
@@ -103,6 +116,22 @@ export class CdkStack extends Stack {
     lineIdBucket.grantReadWrite(batchStack);
     lineIdBucket.grantReadWrite(webhookHandlerStack);
 
+    // 配信が時間内に終わらない場合にbatchが、受け付けたイベントの処理に
+    // webhookが自身を非同期で実行する。関数のARNを参照するので、関数が依存する
+    // ロールの既定のポリシーとは分けて循環参照を避ける
+    new Policy(this, "SelfInvokePolicy", {
+      roles: [iamRoleForLambda],
+      statements: [
+        new PolicyStatement({
+          actions: ["lambda:InvokeFunction"],
+          resources: [
+            webhookHandlerStack.functionArn,
+            batchStack.functionArn,
+          ],
+        }),
+      ],
+    });
+
     const toNotification = StringParameter.valueForStringParameter(
       this,
       "TO_NOTIFICATION",
@@ -144,5 +173,86 @@ export class CdkStack extends Stack {
       metric: batchMetric.metric(),
     });
     batchAlarm.addAlarmAction(new SnsAction(topic));
+
+    // アプリがEMFで出力する段階ごとの所要時間と件数
+    const appMetric = (
+      functionName: string,
+      metricName: string,
+      statistic: string,
+    ) =>
+      new Metric({
+        namespace: "DbdInfoBot",
+        metricName,
+        dimensionsMap: { Function: functionName },
+        statistic,
+        period: Duration.minutes(5),
+      });
+
+    new Dashboard(this, "DbdInfoBotDashboard", {
+      widgets: [
+        [
+          new GraphWidget({
+            title: "Batch stages p99 (ms)",
+            width: 12,
+            left: [
+              appMetric("Batch", "TwitterFetchDuration", "p99"),
+              appMetric("Batch", "OutboxWriteDuration", "p99"),
+              appMetric("Batch", "LinePushDuration", "p99"),
+              appMetric("Batch", "CheckpointDuration", "p99"),
+            ],
+          }),
+          new GraphWidget({
+            title: "Batch counts",
+            width: 12,
+            left: [
+              "TweetsFetched",
+              "TweetsMatched",
+              "Recipients",
+              "PushesSent",
+              "Retries",
+              "Failures",
+            ].map((name) => appMetric("Batch", name, "Sum")),
+          }),
+        ],
+        [
+          new GraphWidget({
+            title: "Webhook stages p99 (ms)",
+            width: 12,
+            left: [
+              appMetric("Webhook", "InvocationDuration", "p99"),
+              appMetric("Webhook", "VerifyDuration", "p99"),
+              appMetric("WebhookWorker", "ShrineDuration", "p99"),
+              appMetric("WebhookWorker", "ChatGPTDuration", "p99"),
+              appMetric("WebhookWorker", "ReplyDuration", "p99"),
+            ],
+          }),
+          new GraphWidget({
+            title: "Webhook events",
+            width: 12,
+            left: ["Events", "DuplicateEvents", "Failures"].map((name) =>
+              appMetric("WebhookWorker", name, "Sum"),
+            ),
+          }),
+        ],
+      ],
+    });
+
+    // 配信がタイムアウト(5分)に近づいている
+    const batchLatencyAlarm = new Alarm(this, "BatchLatencyAlarm", {
+      comparisonOperator: ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+      threshold: Duration.minutes(4).toMilliseconds(),
+      evaluationPeriods: 1,
+      metric: appMetric("Batch", "InvocationDuration", "p99"),
+    });
+    batchLatencyAlarm.addAlarmAction(new SnsAction(topic));
+
+    // LINEはWebhookの応答が遅いと再送するため、受付はすぐに返す
+    const webhookLatencyAlarm = new Alarm(this, "WebhookLatencyAlarm", {
+      comparisonOperator: ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+      threshold: 1000,
+      evaluationPeriods: 1,
+      metric: appMetric("Webhook", "InvocationDuration", "p99"),
+    });
+    webhookLatencyAlarm.addAlarmAction(new SnsAction(topic));
   }
 }